@@ -48,6 +48,13 @@ def kvm_binaries(tmp_path):
     with kvm_f.open(mode="wt") as fd:
         fd.write("aa")
     vl.KVM_BINARIES = (kvm_f,)
+    # No kvm, the test driver is the only domain type
+    vl.KVM_DEVICE = str(tmp_path / "no-kvm")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    vl.CACHE_DIR = str(tmp_path / "cache")
 
 
 @pytest.fixture(autouse=True)
@@ -0,0 +1,76 @@
+import hashlib
+import ipaddress
+from unittest.mock import Mock
+
+import libvirt
+import pytest
+from test_download import RangeHandler, server  # noqa: F401
+from test_xz import PARTS, multi_block_xz
+
+import virt_lightning.api as api
+import virt_lightning.virt_lightning as vl
+from virt_lightning.download import ResumeState
+
+
+def test_session(monkeypatch):
+    connect = Mock(side_effect=lambda uri: libvirt.open("test:///default"))
+    monkeypatch.setattr(api, "_connect_libvirt", connect)
+    configuration = Mock(libvirt_uri="test:///default")
+    with api.Session(configuration, pool_size=2) as session:
+        hv = session.hypervisor()
+        assert session.hypervisor() is hv
+        workers = [session.worker_hv() for _ in range(4)]
+        assert workers[0] is workers[2]
+        assert workers[0].conn is not workers[1].conn
+        assert workers[0].conn is not hv.conn
+        # The clones share the state of the hypervisor
+        assert workers[0]._ipam is hv._ipam
+    assert connect.call_count == 3
+    assert session._conn is None
+
+
+def test_fetch_distro_resumed_xz(server, tmp_path, monkeypatch):  # noqa: F811
+    data = multi_block_xz(*PARTS)
+    monkeypatch.setattr(RangeHandler, "content", data)
+    (tmp_path / "upstream").mkdir()
+    target_file = tmp_path / "upstream" / "distro.qcow2"
+    temp_file = target_file.with_suffix(".temp")
+    image_info = {"name": "distro", "qcow2_url": f"{server}.xz"}
+    monkeypatch.setattr(api, "get_image_index", lambda configuration: [image_info])
+    configuration = Mock(private_hub=[])
+
+    def fetch(sha256):
+        # Interrupted after the first block
+        temp_file.write_bytes(PARTS[0])
+        url = image_info["qcow2_url"]
+        state = ResumeState(temp_file, url, {"etag": '"1"'}, len(data))
+        with temp_file.open("rb") as fd:
+            state.save(fd.fileno(), {"blocks": 1})
+        image_info["sha256"] = sha256
+        api.fetch_distro(configuration, storage_dir=tmp_path, distro="distro")
+
+    with pytest.raises(api.ChecksumError):
+        fetch("0" * 64)
+    assert not temp_file.exists()
+    assert not target_file.exists()
+
+    # The checksum of the compressed file, the image is downloaded again
+    RangeHandler.requests.clear()
+    fetch(hashlib.sha256(data).hexdigest())
+    assert target_file.read_bytes() == b"".join(PARTS)
+    assert 0 in RangeHandler.requests[4:]
+
+
+def test_ssh_config():
+    record = vl.DomainRecord(
+        name="a",
+        username="b",
+        ipv4=ipaddress.ip_interface("1.0.0.5/24"),
+        context="default",
+        groups=[],
+    )
+    session = Mock()
+    session.hypervisor.return_value.list_domain_records.return_value = [record]
+    configuration = Mock(ssh_key_file="/home/b/.ssh/id_ed25519.pub")
+    config = api.ssh_config(configuration, session=session)
+    assert "IdentityFile /home/b/.ssh/id_ed25519\n" in config
@@ -0,0 +1,136 @@
+import xml.etree.ElementTree as ET  # noqa: N817
+from unittest.mock import Mock
+
+import pytest
+
+import virt_lightning.virt_lightning as vl
+from virt_lightning.booted import (
+    PADDING_NS,
+    SAVE_HEADER,
+    SAVE_MAGIC,
+    BootedTemplates,
+    clone_xml,
+    identity_xml,
+    read_save_header,
+    templatable,
+    template_key,
+)
+
+SAVED_XML = f"""<domain type="kvm">
+  <name>vl-template-abc</name>
+  <uuid>00000000-0000-0000-0000-000000000001</uuid>
+  <metadata>
+    <vl:instance xmlns:vl="{vl.METADATA_NS}" name="vl-template-abc"/>
+    <vlpad:padding xmlns:vlpad="{PADDING_NS}" value="xxxx"/>
+  </metadata>
+  <devices>
+    <disk type="file" device="disk"><source file="/vl/template-0.qcow2"/></disk>
+    <disk type="file" device="cdrom"><source file="/vl/seed-a.qcow2"/></disk>
+    <interface type="network">
+      <mac address="52:54:00:00:00:01"/>
+      <target dev="vnet3"/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def domain(name="a", user_data=None):
+    domain = Mock(
+        uuid="00000000-0000-0000-0000-000000000002",
+        metadata={"context": "default", "distro": "debian-12"},
+        nics=[{"mac": "52:54:00:00:00:02"}],
+        user_data=user_data or {"name": name, "packages": []},
+        distro="debian-12",
+        memory=1024,
+        vcpus=2,
+        **{"get_metadata.return_value": None},
+    )
+    # name is an argument of Mock()
+    domain.name = name
+    return domain
+
+
+def test_clone_xml():
+    root = ET.fromstring(
+        clone_xml(
+            SAVED_XML,
+            domain(),
+            {
+                "/vl/template-0.qcow2": "/vl/a-0.qcow2",
+                "/vl/seed-a.qcow2": "/vl/seed-b.qcow2",
+            },
+        )
+    )
+    assert root.find("./name").text == "a"
+    assert root.find("./uuid").text.endswith("2")
+    assert root.find(f"./metadata/{{{PADDING_NS}}}padding") is None
+    instance = root.find(f"./metadata/{{{vl.METADATA_NS}}}instance")
+    assert instance.attrib == {"context": "default", "distro": "debian-12"}
+    assert [s.attrib["file"] for s in root.findall("./devices/disk/source")] == [
+        "/vl/a-0.qcow2",
+        "/vl/seed-b.qcow2",
+    ]
+    assert root.find("./devices/interface/mac").attrib["address"].endswith("02")
+    assert root.find("./devices/interface/target") is None
+
+
+def test_identity_xml():
+    root = ET.fromstring(identity_xml(SAVED_XML, domain()))
+    assert root.find("./name").text == "a"
+    assert root.find("./uuid").text.endswith("2")
+    assert root.find(f"./metadata/{{{PADDING_NS}}}padding") is None
+    assert root.find("./devices/interface/mac").attrib["address"].endswith("02")
+    # The rest is passed to restoreFlags() and checked by libvirt
+    instance = root.find(f"./metadata/{{{vl.METADATA_NS}}}instance")
+    assert instance.attrib == {"name": "vl-template-abc"}
+    assert [s.attrib["file"] for s in root.findall("./devices/disk/source")] == [
+        "/vl/template-0.qcow2",
+        "/vl/seed-a.qcow2",
+    ]
+    assert root.find("./devices/interface/target") is not None
+
+
+def test_builder():
+    host = {
+        "name": "vm",
+        "distro": "debian-12",
+        "template": True,
+        "networks": [{"network": "vl", "ipv4": "192.168.123.5/24"}],
+    }
+    builder = BootedTemplates(Mock()).builder(host, "a" * 64)
+    assert builder["name"] == "vl-template-aaaaaaaaaaaa"
+    assert "template" not in builder
+    assert builder["networks"] == [{"network": "vl"}]
+    assert host["networks"][0]["ipv4"] == "192.168.123.5/24"
+
+
+def test_read_save_header():
+    header = SAVE_HEADER.pack(SAVE_MAGIC, 2, 4096, 1, 0, 3000)
+    assert SAVE_HEADER.size == 92
+    assert read_save_header(header) == 3000
+    assert read_save_header(SAVE_HEADER.pack(SAVE_MAGIC, 2, 4096, 1, 0, 0)) == 4096
+    with pytest.raises(ValueError):
+        read_save_header(SAVE_HEADER.pack(b"LibvirtQemudPart", 2, 4096, 1, 0, 0))
+
+
+def test_template_key():
+    host = {"distro": "debian-12"}
+    assert template_key(domain("a"), host) == template_key(domain("b"), host)
+    assert template_key(domain("a"), host) != template_key(
+        domain("a"), {**host, "default_bus_type": "sata"}
+    )
+    assert template_key(domain("a"), host) != template_key(
+        domain("a", {"packages": ["git"]}), host
+    )
+
+
+def test_templatable():
+    assert templatable({"distro": "debian-12"}, "virt-lightning")
+    assert not templatable(
+        {"distro": "debian-12", "disks": [{"size": 15}, {"size": 1}]},
+        "virt-lightning",
+    )
+    assert not templatable(
+        {"distro": "debian-12", "networks": [{"bridge": "br0"}]}, "virt-lightning"
+    )
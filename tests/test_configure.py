@@ -23,3 +23,17 @@ def test_load_default_config_file(monkeypatch, config_file):
         m.setattr(virt_lightning.configuration, "DEFAULT_CONFIGFILE", config_file)
         config = virt_lightning.configuration.Configuration()
         assert config.root_password == "boby"
+
+
+def test_warm_pool(monkeypatch, tmp_path):
+    config_file = tmp_path / "config.ini"
+    config_file.write_text("[main]\nwarm_pool = debian-12:2:1024, fedora-41:1:2048\n")
+    with monkeypatch.context() as m:
+        m.setattr(virt_lightning.configuration, "DEFAULT_CONFIGFILE", Path("a"))
+        config = virt_lightning.configuration.Configuration()
+        assert config.warm_pool == {}
+        config.load_file(config_file)
+        assert config.warm_pool == {
+            "debian-12": {"count": 2, "memory": 1024},
+            "fedora-41": {"count": 1, "memory": 2048},
+        }
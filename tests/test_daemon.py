@@ -0,0 +1,89 @@
+import asyncio
+import ipaddress
+import pathlib
+import socket
+from unittest.mock import Mock
+
+import pytest
+
+import virt_lightning.api as api
+import virt_lightning.virt_lightning as vl
+from virt_lightning.client import (
+    DaemonClient,
+    DaemonError,
+    InsecureSocketDirectoryError,
+    check_socket_directory,
+    connect,
+)
+from virt_lightning.daemon import Daemon, DomainIndex
+
+
+def test_domain_index(monkeypatch):
+    monkeypatch.setattr(
+        vl.DomainRecord,
+        "from_xml",
+        lambda xml: vl.DomainRecord(name=xml, context=xml[0]),
+    )
+    doms = [Mock(**{"name.return_value": n, "XMLDesc.return_value": n}) for n in "ab"]
+    conn = Mock(**{"listAllDomains.return_value": doms})
+    index = DomainIndex()
+    index.load(conn)
+    assert [r.name for r in index.records(context="a")] == ["a"]
+    index.remove("a")
+    assert [r.name for r in index.records()] == ["b"]
+
+
+def test_client(tmp_path, monkeypatch):
+    configuration = Mock(
+        libvirt_uri="test:///default", storage_pool="vl", ssh_key_file="id.pub"
+    )
+    daemon = Daemon(configuration, path=tmp_path / "vl.sock")
+    daemon.session = Mock()
+    record = vl.DomainRecord(
+        name="a", username="b", ipv4=ipaddress.ip_interface("1.0.0.2/24")
+    )
+    monkeypatch.setattr(api, "list_domains", lambda configuration, session: [record])
+    # The settings of the client are used by the daemon
+    monkeypatch.setattr(
+        api, "ssh_config", lambda configuration, session: configuration.ssh_key_file
+    )
+    client = DaemonClient(configuration, path=daemon.path)
+
+    async def serve(func, *args):
+        server = await asyncio.start_unix_server(daemon._handle, path=str(daemon.path))
+        async with server:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    domains = asyncio.run(serve(client.list_domains, configuration))
+    assert (domains[0].name, domains[0].username, domains[0].ipv4) == (
+        "a",
+        "b",
+        "1.0.0.2",
+    )
+
+    configuration.ssh_key_file = pathlib.Path("client.pub")
+    assert asyncio.run(serve(client.call, "ssh_config")) == "client.pub"
+
+    client.configuration = Mock(
+        libvirt_uri="qemu:///system", storage_pool="vl", ssh_key_file="id.pub"
+    )
+    with pytest.raises(DaemonError):
+        asyncio.run(serve(client.call, "list_domains"))
+
+
+def test_socket_directory(tmp_path, monkeypatch):
+    runtime_dir = tmp_path / "run"
+    runtime_dir.mkdir(mode=0o755)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(runtime_dir))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(runtime_dir / "virt-lightning.sock"))
+        with pytest.raises(InsecureSocketDirectoryError):
+            check_socket_directory(runtime_dir)
+        assert connect(Mock()) is None
+        runtime_dir.chmod(0o700)
+        check_socket_directory(runtime_dir)
+        assert connect(Mock())
+    # A symlink to a private directory
+    (tmp_path / "link").symlink_to(runtime_dir)
+    with pytest.raises(InsecureSocketDirectoryError):
+        check_socket_directory(tmp_path / "link")
@@ -1,3 +1,9 @@
+from unittest.mock import Mock
+
+import pytest
+
+import virt_lightning.virt_lightning as vl
+
 IF_XML = """
 <domain>
   <devices>
@@ -37,3 +43,111 @@ def test_vcpus(domain):
 def test_fqdn(domain):
     domain.fqdn = "my.test"
     assert domain.fqdn == "my.test"
+
+
+DOMAIN_XML = """
+<domain type='kvm' id='4'>
+  <name>vm1</name>
+  <uuid>cd5b4d6e-0bb2-4b30-9c09-9f6c3c1f0d7a</uuid>
+  <metadata>
+    <vl:distro xmlns:vl="distro" name="fedora-41"/>
+    <vl:context xmlns:vl="context" name="ci"/>
+    <vl:ipv4 xmlns:vl="ipv4" name="192.168.123.5/24"/>
+    <vl:groups xmlns:vl="groups" name="web,db"/>
+  </metadata>
+  <memory unit='KiB'>1048576</memory>
+  <vcpu current='1'>2</vcpu>
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:d7:92:5b'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def test_record_from_xml():
+    record = vl.DomainRecord.from_xml(DOMAIN_XML)
+    assert record.name == "vm1"
+    assert record.active
+    assert record.distro == "fedora-41"
+    assert record.context == "ci"
+    assert str(record.ipv4.ip) == "192.168.123.5"
+    assert record.ipv6 is None
+    assert record.groups == ["web", "db"]
+    assert record.memory == 1024
+    assert record.vcpus == 1
+    assert record.mac_addresses == ["52:54:00:d7:92:5b"]
+    with pytest.raises(AttributeError):
+        record.name = "vm2"
+
+
+def test_snapshot(domain):
+    domain.context = "something"
+    record = domain.snapshot()
+    assert record.name == "a"
+    assert record.distro == "b"
+    assert record.context == "something"
+    assert not record.active
+
+
+LEGACY_DOMAIN_XML = """
+<domain type='test'>
+  <name>legacy</name>
+  <memory>1048576</memory>
+  <os><type>hvm</type></os>
+  <metadata>
+    <vl:distro xmlns:vl="distro" name="fedora-41"/>
+    <vl:context xmlns:vl="context" name="ci"/>
+  </metadata>
+</domain>
+"""
+
+
+def test_record_from_xml_metadata():
+    xml = DOMAIN_XML.replace(
+        '<vl:distro xmlns:vl="distro" name="fedora-41"/>',
+        f'<vl:instance xmlns:vl="{vl.METADATA_NS}" distro="debian-13" username="a"/>',
+    )
+    record = vl.DomainRecord.from_xml(xml)
+    assert record.distro == "debian-13"
+    assert record.username == "a"
+    # the per-key elements are ignored once the new element is there
+    assert record.context is None
+
+
+def test_legacy_metadata(hv):
+    dom = hv.conn.defineXML(LEGACY_DOMAIN_XML)
+    domain = vl.LibvirtDomain(dom)
+    assert domain.distro == "fedora-41"
+    assert domain.context == "ci"
+
+    domain.context = "other"
+    domain = vl.LibvirtDomain(dom)
+    assert domain.distro == "fedora-41"
+    assert domain.context == "other"
+    dom.undefine()
+
+
+def test_batch_metadata(domain):
+    domain.define()
+    domain.dom = Mock(wraps=domain.dom)
+    with domain.batch_metadata():
+        domain.context = "ci"
+        domain.groups = ["a", "b"]
+    assert domain.dom.setMetadata.call_count == 1
+    domain = vl.LibvirtDomain(domain.dom)
+    assert domain.groups == ["a", "b"]
+    assert domain.distro == "b"
+
+
+def test_pending_domain(domain):
+    assert domain.dom is None
+    domain.memory = 512
+    domain.attach_network(
+        network="my_network", ipv4="1.0.0.9/24", nic_model="virtio"
+    )
+    assert domain.memory == 512
+    assert domain.nics[0]["mac"] == domain.mac_addresses[0]
+    assert domain.mac_addresses[0].startswith("52:54:00:")
+    assert domain.snapshot().uuid == domain.uuid
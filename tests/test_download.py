@@ -0,0 +1,193 @@
+import hashlib
+import http.server
+import itertools
+import lzma
+import os
+import re
+import threading
+
+import pytest
+from test_xz import PARTS, multi_block_xz
+
+import virt_lightning.download as download
+import virt_lightning.xz as xz
+from virt_lightning.download import (
+    RangeNotSupportedError,
+    ResumeState,
+    SegmentedDownload,
+    SparseWriter,
+    XzDownload,
+    disk_usage,
+    parse_checksums,
+    prefetch,
+    split,
+)
+
+CONTENT = os.urandom(300 * 1024)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    content = CONTENT
+    ranges = True
+    requests = []
+
+    def do_GET(self):  # noqa: N802
+        content = self.content
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and self.ranges:
+            first, last = int(match[1]), int(match[2])
+            self.requests.append(first)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(content)}")
+        else:
+            first, last = 0, len(content) - 1
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("ETag", '"1"')
+        self.end_headers()
+        self.wfile.write(content[first : last + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(RangeHandler, "requests", [])
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/image.qcow2"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_split(monkeypatch):
+    monkeypatch.setattr(download, "MIN_SEGMENT_SIZE", 10)
+    assert split(100, 4) == [(0, 24), (25, 49), (50, 74), (75, 99)]
+    assert split(101, 4) == [(0, 25), (26, 51), (52, 77), (78, 100)]
+    assert split(25, 4) == [(0, 12), (13, 24)]
+    assert split(5, 4) == [(0, 4)]
+
+
+def test_segmented_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "MIN_SEGMENT_SIZE", 64 * 1024)
+    progress = []
+    segmented = SegmentedDownload(
+        server, len(CONTENT), 4, progress_callback=lambda c, t: progress.append(c)
+    )
+    assert len(segmented.segments) == 4
+    segmented.run(tmp_path / "image.temp")
+    assert (tmp_path / "image.temp").read_bytes() == CONTENT
+    assert progress[-1] == len(CONTENT)
+    assert segmented.digests.matches(hashlib.sha256(CONTENT).hexdigest())
+
+    monkeypatch.setattr(RangeHandler, "ranges", False)
+    with pytest.raises(RangeNotSupportedError):
+        SegmentedDownload(server, len(CONTENT), 4).run(tmp_path / "image.temp")
+
+
+def test_segmented_download_resume(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "MIN_SEGMENT_SIZE", 64 * 1024)
+    temp_file = tmp_path / "image.temp"
+    state = ResumeState(temp_file, server, {"etag": '"1"'}, len(CONTENT))
+    segmented = SegmentedDownload(server, len(CONTENT), 2, state=state)
+    # The first segment and half of the second one were downloaded
+    half = len(CONTENT) // 2
+    temp_file.write_bytes(CONTENT[: half + 1000].ljust(len(CONTENT), b"\0"))
+    with temp_file.open("rb") as fd:
+        state.save(fd.fileno(), {"segments": segmented.segments, "done": [half, 1000]})
+
+    segmented.run(temp_file)
+    assert temp_file.read_bytes() == CONTENT
+    assert RangeHandler.requests == [half + 1000]
+    assert segmented.digests.matches(hashlib.sha256(CONTENT).hexdigest())
+
+    # Another version of the image
+    state = ResumeState(temp_file, server, {"etag": '"2"'}, len(CONTENT))
+    assert state.load() is None
+
+
+def test_xz_download_resume(server, tmp_path, monkeypatch):
+    data = multi_block_xz(*PARTS)
+    monkeypatch.setattr(RangeHandler, "content", data)
+    temp_file = tmp_path / "image.temp"
+    state = ResumeState(temp_file, server, {"etag": '"1"'}, len(data))
+    xz_download = XzDownload(server, len(data), state=state)
+    xz_download.run(temp_file)
+    assert temp_file.read_bytes() == b"".join(PARTS)
+    assert state.load() == {"blocks": 3}
+    assert xz_download.digests.matches(hashlib.sha256(data).hexdigest())
+    assert xz_download.digests.matches(hashlib.sha256(b"".join(PARTS)).hexdigest())
+
+    # Interrupted after the first block
+    temp_file.write_bytes(PARTS[0])
+    with temp_file.open("rb") as fd:
+        state.save(fd.fileno(), {"blocks": 1})
+    RangeHandler.requests.clear()
+    xz_download = XzDownload(server, len(data), state=state)
+    xz_download.run(temp_file)
+    assert temp_file.read_bytes() == lzma.decompress(data)
+    # The compressed data of the first block was not downloaded again
+    assert xz_download.digests.matches(hashlib.sha256(data).hexdigest()) is None
+    assert xz_download.digests.matches(hashlib.sha256(b"".join(PARTS)).hexdigest())
+    # The header, the footer and the index, then the blocks from the second one
+    index = xz.read_index(lambda offset, size: data[offset : offset + size], len(data))
+    offsets = [0, len(data) - 12, index.index_offset, index.blocks[1].offset]
+    assert RangeHandler.requests == offsets
+
+
+def test_parse_checksums():
+    digest = hashlib.sha256(b"image").hexdigest()
+    sums = f"{'0' * 64}  other.img\n{digest} *noble-server-cloudimg-amd64.img\n"
+    assert parse_checksums(sums, "noble-server-cloudimg-amd64.img") == digest
+    assert parse_checksums(sums, "missing.img") is None
+    bsd = f"# Fedora-Cloud\nSHA256 (Fedora-Cloud-41.qcow2) = {digest.upper()}\n"
+    assert parse_checksums(bsd, "Fedora-Cloud-41.qcow2") == digest
+    assert parse_checksums(f"{digest}\n", "alpine.qcow2") == digest
+
+
+def test_prefetch():
+    assert list(prefetch(range(100), 2)) == list(range(100))
+
+    def fail():
+        yield 1
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        list(prefetch(fail()))
+    # The consumer stops before the end
+    items = prefetch(itertools.count(), 2)
+    assert next(items) == 0
+    items.close()
+
+
+def test_xz_download_parallel(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    data = multi_block_xz(*PARTS)
+    monkeypatch.setattr(RangeHandler, "content", data)
+    xz_download = XzDownload(server, len(data))
+    xz_download.run(tmp_path / "image.temp")
+    assert (tmp_path / "image.temp").read_bytes() == b"".join(PARTS)
+    assert xz_download.digests.matches(hashlib.sha256(data).hexdigest())
+
+    index = xz.read_index(lambda offset, size: data[offset : offset + size], len(data))
+    assert xz_download._workers(index.blocks) == 3
+    # The blocks are too large to be decoded at once
+    monkeypatch.setattr(download, "DECODE_MEMORY", xz.CHUNK_SIZE)
+    assert xz_download._workers(index.blocks) == 1
+
+
+def test_sparse_writer(tmp_path):
+    zeros = bytes(4 * download.SPARSE_BLOCK_SIZE)
+    data = [b"a" * 1000 + zeros, zeros, b"b" * 100, zeros]
+    path = tmp_path / "image.temp"
+    with path.open("wb") as fd:
+        writer = SparseWriter(fd.fileno())
+        for chunk in data:
+            writer.write(chunk)
+        writer.truncate()
+    assert path.read_bytes() == b"".join(data)
+    size, allocated = disk_usage(path)
+    assert size == len(b"".join(data))
+    assert allocated < size
@@ -0,0 +1,79 @@
+import json
+from unittest.mock import MagicMock, Mock
+
+import virt_lightning.api as api
+from virt_lightning.golden import GOLDEN_CONTEXT, GoldenImages, provisioning_hash
+
+
+def test_provisioning_hash(tmp_path):
+    image = tmp_path / "debian-12.qcow2"
+    image.write_bytes(b"qcow")
+
+    def domain(**user_data):
+        return Mock(distro="debian-12", user_data={"runcmd": [], **user_data})
+
+    assert provisioning_hash(domain(), image) is None
+    key = provisioning_hash(domain(packages=["git"]), image)
+    assert key == provisioning_hash(domain(packages=["git"], name="b"), image)
+    assert key != provisioning_hash(domain(packages=["vim"]), image)
+    image.write_bytes(b"qcow2")
+    assert key != provisioning_hash(domain(packages=["git"]), image)
+
+
+def test_evict(tmp_path):
+    (tmp_path / "upstream").mkdir()
+    hv = MagicMock(**{"get_storage_dir.return_value": tmp_path})
+    goldens = GoldenImages(hv, Mock(golden_image_cache_size=1))
+    goldens.directory.mkdir()
+    index = {}
+    for last_used, key in enumerate(("a" * 64, "b" * 64, "c" * 64)):
+        goldens.path(key).write_bytes(b"x" * 8192)
+        index[key] = {"distro": "debian-12", "last_used": last_used}
+    goldens.index_file.write_text(json.dumps(index))
+    # a is the least recently used, but b is not used
+    volume = Mock(
+        **{
+            "XMLDesc.return_value": "<volume><backingStore><path>"
+            f"{goldens.path('a' * 64)}</path></backingStore></volume>"
+        }
+    )
+    hv.storage_pool_obj.listAllVolumes.return_value = [volume]
+    size = goldens.path("a" * 64).stat().st_blocks * 512
+    goldens.max_size = 2 * size
+
+    goldens.evict(keep="c" * 64)
+    assert sorted(json.loads(goldens.index_file.read_text())) == ["a" * 64, "c" * 64]
+    assert not goldens.path("b" * 64).exists()
+    assert goldens.get("a" * 64) == goldens.path("a" * 64)
+
+
+def test_save_keeps_the_address_of_the_vm(hv):
+    configuration = Mock(
+        network_name="my_network", root_password="root", ssh_key_file=None
+    )
+    host = {"name": "vm", "distro": "b", "networks": [{}]}
+    vm = api._define_domain(hv, host, "default", configuration)
+    vm.attach_disk(hv.create_disk("vm-0"))
+    vm.define()
+    goldens = GoldenImages(hv, Mock(golden_image_cache_size=1))
+    builder_host = goldens.builder(host, "a" * 64)
+    assert "ipv4" in host["networks"][0]
+    assert "ipv4" not in builder_host["networks"][0]
+    builder = api._define_domain(hv, builder_host, GOLDEN_CONTEXT, configuration)
+    builder.attach_disk(hv.create_disk(f"{builder.name}-0"))
+    builder.define()
+    assert builder.ipv4 != vm.ipv4
+    builder_ipv4 = builder.ipv4
+
+    builder.agent_run = Mock(return_value=0)
+    builder.dom = Mock(wraps=builder.dom, **{"shutdown.return_value": 0})
+    # The test driver cannot download a volume
+    stream = Mock()
+    stream.recvAll.side_effect = lambda handler, writer: handler(None, b"qcow2", writer)
+    hv.conn = Mock(wraps=hv.conn)
+    hv.conn.newStream.return_value = stream
+    hv.conn.storageVolLookupByPath.return_value = Mock()
+    goldens.save(builder, "a" * 64, 1.0)
+    assert goldens.get("a" * 64).read_bytes() == b"qcow2"
+    assert hv.get_ipam().is_allocated(vm.ipv4)
+    assert not hv.get_ipam().is_allocated(builder_ipv4)
@@ -1,6 +1,13 @@
+import ipaddress
+import xml.etree.ElementTree as ET  # noqa: N817
 from unittest.mock import Mock, patch
 
 import libvirt
+import pytest
+import yaml
+
+import virt_lightning.virt_lightning as vl
+from virt_lightning.iso import ISOImage
 
 
 def test_arch(hv):
@@ -15,6 +22,42 @@ def test_kvm_binary(hv):
     assert hv.kvm_binary.name == "kvm-dummy"
 
 
+def test_host_capabilities_cache(hv):
+    assert hv.domain_type == "test"
+    assert hv.host_capabilities.cache_file().exists()
+
+    other = vl.LibvirtHypervisor(hv.conn)
+    hv.conn.getCapabilities = Mock(side_effect=AssertionError)
+    assert other.arch == "i686"
+    assert other.kvm_binary.name == "kvm-dummy"
+
+    other.host_capabilities.invalidate()
+    with pytest.raises(AssertionError):
+        other.arch
+
+
+def test_host_capabilities_kvm_installed(hv, tmp_path, monkeypatch):
+    assert hv.domain_type == "test"
+    # The kvm module was loaded since
+    (tmp_path / "kvm").touch()
+    monkeypatch.setattr(vl, "KVM_DEVICE", str(tmp_path / "kvm"))
+    other = vl.LibvirtHypervisor(hv.conn)
+    hv.conn.getCapabilities = Mock(wraps=hv.conn.getCapabilities)
+    assert other.domain_type == "test"
+    assert hv.conn.getCapabilities.call_count == 1
+
+    vl.HostCapabilities.clear_cache()
+    assert not vl.HostCapabilities.cache_file().exists()
+
+
+def test_host_capabilities_without_kvm_binary(hv, monkeypatch):
+    monkeypatch.setattr(vl, "KVM_BINARIES", ())
+    vl.HostCapabilities.clear_cache()
+    other = vl.LibvirtHypervisor(hv.conn)
+    assert other.host_capabilities.values["kvm_binary"] is None
+    assert not vl.HostCapabilities.cache_file().exists()
+
+
 def test_init_storage_pool(hv):
     assert hv.conn.storagePoolLookupByName("foo_bar")
 
@@ -24,6 +67,56 @@ def test_create_domain(hv):
     assert domain
 
 
+def test_list_domain_records(hv, monkeypatch):
+    domain = hv.create_domain(name="ctx_a", distro="b")
+    domain.context = "ci"
+    domain.define()
+    hv.create_domain(name="ctx_b", distro="b").define()
+    # The context is read from the description of the domain
+    monkeypatch.setattr(vl, "_get_metadata", Mock(side_effect=AssertionError))
+
+    records = list(hv.list_domain_records(context="ci"))
+    assert [r.name for r in records] == ["ctx_a"]
+    assert records[0].distro == "b"
+    assert not records[0].active
+    assert [d.name for d in hv.list_domains(context="ci")] == ["ctx_a"]
+    assert len(list(hv.list_domain_records())) >= 2
+
+
+def test_define_domain_in_one_call(hv):
+    hv.conn = Mock(wraps=hv.conn)
+    domain = hv.create_domain(name="one_call", distro="b")
+    with domain.batch_metadata():
+        domain.vcpus = 1
+        domain.memory = 512
+        domain.context = "ci"
+        domain.attach_network(
+            network="my_network", ipv4="1.0.0.9/24", nic_model="virtio"
+        )
+    domain.attach_disk(hv.create_disk("one_call-0"))
+    assert hv.conn.defineXML.call_count == 0
+    domain.define()
+    assert hv.conn.defineXML.call_count == 1
+
+    record = hv.get_domain_by_name("one_call").snapshot()
+    assert record.vcpus == 1
+    assert record.memory == 512
+    assert record.context == "ci"
+    assert record.distro == "b"
+    assert record.mac_addresses == domain.mac_addresses
+    assert len(record.disks) == 1
+
+
+def test_allocate_mac_address(hv):
+    mac = vl._generate_mac_address("a", 0)
+    # Used by a DHCP host entry
+    hv.set_dhcp_entry(ipaddress.ip_interface("1.0.0.5/24"), mac)
+    first = hv.allocate_mac_address("a", 0)
+    assert first != mac
+    assert first == vl._generate_mac_address("a", 0, {mac})
+    assert hv.allocate_mac_address("a", 0) not in (mac, first)
+
+
 def test_distro_available(hv, tmpdir):
     hv.storage_pool_obj = hv.create_storage_pool("foo", tmpdir)
     assert hv.distro_available() == []
@@ -45,6 +138,16 @@ def test_create_disk(hv):
     assert isinstance(disk, libvirt.virStorageVol)
 
 
+def test_create_disk_with_invalid_backing_file(hv, tmp_path):
+    # Not mocked by the hv fixture
+    del hv.get_qcow_virtual_size
+    (tmp_path / "raw.qcow2").write_bytes(b"\0" * 512)
+    with pytest.raises(vl.qcow2.BackingFileError):
+        hv.create_disk("foo_raw", backing_file=tmp_path / "raw.qcow2")
+    with pytest.raises(vl.qcow2.BackingFileError):
+        hv.create_disk("foo_missing", backing_file=tmp_path / "missing.qcow2")
+
+
 def test_get_free_ipv4(hv):
     ipv4_1 = hv.get_free_ipv4()
     ipv4_2 = hv.get_free_ipv4()
@@ -53,6 +156,20 @@ def test_get_free_ipv4(hv):
     assert str(ipv4_2) == "1.0.0.6/24"
 
 
+def test_get_free_ipv6(hv):
+    assert hv.get_free_ipv6() is None
+
+    hv.create_network("dual_stack", "10.10.0.0/16", "fd00:10::/64")
+    hv.init_network("dual_stack", "10.10.0.0/16")
+    assert str(hv.get_free_ipv4()) == "10.10.0.5/16"
+    assert str(hv.get_free_ipv6()) == "fd00:10::5/64"
+
+
+def test_get_network_interface(hv):
+    assert str(hv.get_network_interface("my_network", "1.0.0.8")) == "1.0.0.8/24"
+    assert str(hv.get_network_interface("my_network", "1.0.0.8/25")) == "1.0.0.8/25"
+
+
 def test_create_disk_with_options(hv):
     disk = hv.create_disk("foo_all", size=3, backing_on=True)
     assert isinstance(disk, libvirt.virStorageVol)
@@ -90,3 +207,95 @@ def test_remove_domain_from_network(hv, domain):
     hv.network_obj.update = Mock()
     hv.remove_domain_from_network(domain)
     assert hv.network_obj.update.call_count == 2
+
+
+def test_network_reservations_batch(hv):
+    hv.network_obj.update = Mock()
+    with hv.reservations.batch():
+        hv.set_dns_entry(ipaddress.ip_interface("1.0.0.5/24"), ["a"])
+        hv.set_dhcp_entry(ipaddress.ip_interface("1.0.0.5/24"), "52:54:00:00:00:01")
+        hv.reservations.remove_hosts([ipaddress.ip_address("1.0.0.5")])
+        hv.set_dns_entry(ipaddress.ip_interface("1.0.0.6/24"), ["b"])
+        assert hv.network_obj.update.call_count == 0
+    assert hv.network_obj.update.call_count == 1
+
+    with hv.reservations.batch():
+        hv.set_dns_entry(ipaddress.ip_interface("1.0.0.7/24"), ["c"])
+        hv.reservations.discard()
+    assert hv.network_obj.update.call_count == 1
+
+
+def test_network_reservations_concurrent_changes(hv):
+    hv.set_dns_entry(ipaddress.ip_interface("1.0.0.6/24"), ["b"])
+    # Another vl process removed the entry, then added a conflicting one
+    hv.network_obj.update = Mock(side_effect=[libvirt.libvirtError("not found")])
+    hv.reservations.remove_hosts([ipaddress.ip_address("1.0.0.6")])
+    hv.network_obj.update = Mock(
+        side_effect=[libvirt.libvirtError("existing entry"), None, None]
+    )
+    hv.set_dns_entry(ipaddress.ip_interface("1.0.0.6/24"), ["c"])
+    commands = [c.args[0] for c in hv.network_obj.update.call_args_list]
+    assert commands == [
+        libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
+        libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+        libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
+    ]
+
+
+def test_nocloud_meta_data_ipv6(hv, domain):
+    hv.get_network_gateway = Mock(
+        side_effect=lambda network, version=4: ipaddress.ip_interface(
+            "fd00::1/64" if version == 6 else "1.0.0.1/24"
+        )
+    )
+    domain.attach_network(network="my_network", ipv4="1.0.0.9/24", ipv6="fd00::9/64")
+    image = hv.build_cloud_init_nocloud_image(domain)
+    meta_data = yaml.safe_load(image.root.children["meta-data"].data)
+    assert "iface eth0 inet6 static" in meta_data["network-interfaces"]
+    assert "address fd00::9\n" in meta_data["network-interfaces"]
+    assert "netmask 64\n" in meta_data["network-interfaces"]
+
+
+def test_attach_network_without_prefix(domain):
+    domain.attach_network(bridge="br0", ipv4="192.168.1.9")
+    assert str(domain.nics[0]["ipv4"]) == "192.168.1.9/24"
+
+
+def test_seed_cache(hv, monkeypatch):
+    hv.upload_iso = Mock(side_effect=lambda name, image: hv.create_disk(name))
+    first = ISOImage("cidata")
+    first.add_file("user-data", "#cloud-config\n")
+    assert hv.seed_cache.get(first).name() == hv.seed_cache.get(first).name()
+    assert hv.upload_iso.call_count == 1
+
+    monkeypatch.setattr(vl, "SEED_CACHE_MAX_SIZE", first.size)
+    second = ISOImage("cidata")
+    second.add_file("user-data", "#cloud-config\npackages: []\n")
+    volume = hv.seed_cache.get(second)
+    assert hv.upload_iso.call_count == 2
+    assert hv.seed_cache.volumes() == {volume.name()}
+
+
+def test_seed_of_a_domain_created_again(hv):
+    hv.upload_iso = Mock(side_effect=lambda name, image: hv.create_disk(name))
+
+    def deploy(metadata_format):
+        domain = hv.create_domain(name="seed", distro="b")
+        domain.meta_data_media_type = "cdrom"
+        domain.attach_network(
+            network="my_network", ipv4="1.0.0.9/24", mac="52:54:00:00:00:09"
+        )
+        hv.attach_cloud_init(domain, metadata_format)
+        domain.define()
+        seed = ET.fromstring(domain.dom.XMLDesc(0)).find("./devices/disk/source")
+        hv.clean_up(domain)
+        return seed.attrib["file"]
+
+    nocloud = {"provider": "nocloud"}
+    assert deploy(nocloud) == deploy(nocloud)
+    assert hv.upload_iso.call_count == 1
+    # A config-2 seed holds the UUID of the domain
+    deploy({})
+    deploy({})
+    assert hv.upload_iso.call_count == 3
+    assert len(hv.seed_cache.volumes()) == 1
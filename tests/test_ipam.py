@@ -0,0 +1,114 @@
+import ipaddress
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import virt_lightning.ipam as ipam_module
+from virt_lightning.ipam import AddressPoolExhaustedError, IPAllocator
+
+
+def test_allocate():
+    ipam = IPAllocator("192.168.123.0/24")
+    assert str(ipam.allocate()) == "192.168.123.5/24"
+    assert str(ipam.allocate()) == "192.168.123.6/24"
+
+
+def test_release_reuses_lowest_address():
+    ipam = IPAllocator("192.168.123.0/24")
+    first = ipam.allocate()
+    ipam.allocate()
+    ipam.release(first)
+    assert ipam.allocate() == first
+
+
+def test_reserve():
+    ipam = IPAllocator("192.168.123.0/24")
+    ipam.reserve("192.168.123.5")
+    assert ipam.is_allocated("192.168.123.5/24")
+    assert str(ipam.allocate()) == "192.168.123.6/24"
+    ipam.reserve("10.0.0.1")
+    assert not ipam.is_allocated("10.0.0.1")
+
+
+def test_exhausted():
+    ipam = IPAllocator("192.168.123.0/29")
+    assert str(ipam.allocate()) == "192.168.123.5/29"
+    assert str(ipam.allocate()) == "192.168.123.6/29"
+    with pytest.raises(AddressPoolExhaustedError):
+        ipam.allocate()
+
+
+def test_reconcile():
+    ipam = IPAllocator("192.168.123.0/24")
+    ipam.allocate()
+    ipam.reconcile([ipaddress.ip_address("192.168.123.5")])
+    assert str(ipam.allocate()) == "192.168.123.6/24"
+    ipam.reconcile([])
+    assert str(ipam.allocate()) == "192.168.123.5/24"
+
+
+def test_state_file(tmp_path, monkeypatch):
+    state_file = tmp_path / "ipam.json"
+    ipam = IPAllocator("192.168.123.0/24", state_file=state_file)
+    ipam.allocate()
+    ipam.allocate()
+
+    # Another running vl process
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    other = IPAllocator("192.168.123.0/24", state_file=state_file)
+    other.reconcile([])
+    assert str(other.allocate()) == "192.168.123.7/24"
+    monkeypatch.undo()
+    assert str(ipam.allocate()) == "192.168.123.8/24"
+    other.release("192.168.123.7")
+    assert str(ipam.allocate()) == "192.168.123.7/24"
+
+    # A third process reconciles after the first one is gone, the long-lived
+    # process only forgets the released addresses.
+    real_pid = os.getpid()
+    monkeypatch.setattr(ipam_module, "_is_running", lambda pid: pid != real_pid)
+    monkeypatch.setattr(os, "getpid", lambda: 3)
+    third = IPAllocator("192.168.123.0/24", state_file=state_file)
+    # The VMs of the first process are defined
+    third.reconcile([ipaddress.ip_address(f"192.168.123.{i}") for i in range(5, 9)])
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    assert str(other.allocate()) == "192.168.123.9/24"
+    third.release("192.168.123.6")
+    assert str(other.allocate()) == "192.168.123.6/24"
+    monkeypatch.undo()
+
+    # The allocations of a process that is gone are dropped
+    monkeypatch.setattr(ipam_module, "_is_running", lambda pid: False)
+    monkeypatch.setattr(os, "getpid", lambda: 2)
+    ipam = IPAllocator("192.168.123.0/24", state_file=state_file)
+    ipam.reconcile([])
+    assert str(ipam.allocate()) == "192.168.123.5/24"
+
+    ipam = IPAllocator("10.0.0.0/24", state_file=state_file)
+    ipam.reconcile([])
+    assert str(ipam.allocate()) == "10.0.0.5/24"
+
+
+def test_concurrent_allocations():
+    ipam = IPAllocator("10.0.0.0/16")
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        addresses = list(pool.map(lambda _: ipam.allocate(), range(500)))
+    assert len(set(addresses)) == 500
+
+
+def test_large_network():
+    ipam = IPAllocator("10.0.0.0/16")
+    addresses = [ipam.allocate() for _ in range(300)]
+    assert str(addresses[-1]) == "10.0.1.48/16"
+    assert ipam.is_allocated("10.0.1.48")
+    assert not ipam.is_allocated("10.0.255.254")
+    assert ipam.is_allocated("10.0.255.255")
+
+
+def test_ipv6_network():
+    ipam = IPAllocator("fd00:123::/64")
+    assert str(ipam.allocate()) == "fd00:123::5/64"
+    ipam.reserve("fd00:123::6")
+    assert str(ipam.allocate()) == "fd00:123::7/64"
+    assert not ipam.is_allocated("192.168.123.7")
@@ -0,0 +1,90 @@
+import struct
+
+import pytest
+
+from virt_lightning.iso import SECTOR_SIZE, ISOImage
+
+
+def read_directory(image, extent, size):
+    data = image[extent * SECTOR_SIZE : extent * SECTOR_SIZE + size]
+    entries = {}
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if not length:
+            offset += SECTOR_SIZE - offset % SECTOR_SIZE
+            continue
+        record = data[offset : offset + length]
+        name = record[33 : 33 + record[32]]
+        entries[name] = (
+            struct.unpack("<I", record[2:6])[0],
+            struct.unpack("<I", record[10:14])[0],
+            record,
+        )
+        offset += length
+    return entries
+
+
+def root_directory(image, sector):
+    record = image[sector * SECTOR_SIZE + 156 : sector * SECTOR_SIZE + 190]
+    return struct.unpack("<I", record[2:6])[0], struct.unpack("<I", record[10:14])[0]
+
+
+@pytest.fixture
+def cidata():
+    iso = ISOImage("cidata", timestamp=0)
+    iso.add_file("user-data", "#cloud-config\n")
+    iso.add_file("meta-data", "instance-id: iid-local01\n")
+    iso.add_file("network-config", "version: 1\n" * 500)
+    return iso
+
+
+def test_volume_descriptors(cidata):
+    image = b"".join(cidata.chunks())
+    assert len(image) == cidata.size
+    assert image[16 * SECTOR_SIZE : 16 * SECTOR_SIZE + 6] == b"\x01CD001"
+    assert image[16 * SECTOR_SIZE + 40 : 16 * SECTOR_SIZE + 46] == b"cidata"
+    assert image[17 * SECTOR_SIZE : 17 * SECTOR_SIZE + 6] == b"\x02CD001"
+    assert image[17 * SECTOR_SIZE + 88 : 17 * SECTOR_SIZE + 91] == b"%/E"
+    assert image[18 * SECTOR_SIZE : 18 * SECTOR_SIZE + 6] == b"\xffCD001"
+
+
+def test_joliet_names(cidata):
+    image = b"".join(cidata.chunks(chunk_size=1000))
+    entries = read_directory(image, *root_directory(image, 17))
+    extent, size, _ = entries["network-config;1".encode("utf-16-be")]
+    data = image[extent * SECTOR_SIZE : extent * SECTOR_SIZE + size]
+    assert data == b"version: 1\n" * 500
+
+
+def test_rock_ridge_names(cidata):
+    image = b"".join(cidata.chunks())
+    entries = read_directory(image, *root_directory(image, 16))
+    assert entries[b"\x00"][2][34:36] == b"SP"
+    extent, size, record = entries[b"user-data.;1"]
+    assert b"NM\x0e\x01\x00user-data" in record
+    assert image[extent * SECTOR_SIZE : extent * SECTOR_SIZE + size] == (
+        b"#cloud-config\n"
+    )
+
+
+def test_subdirectories():
+    iso = ISOImage("config-2")
+    iso.add_file("openstack/latest/meta_data.json", "{}")
+    image = b"".join(iso.chunks())
+    entries = read_directory(image, *root_directory(image, 17))
+    entries = read_directory(image, *entries["openstack".encode("utf-16-be")][:2])
+    entries = read_directory(image, *entries["latest".encode("utf-16-be")][:2])
+    extent, size, _ = entries["meta_data.json;1".encode("utf-16-be")]
+    assert image[extent * SECTOR_SIZE : extent * SECTOR_SIZE + size] == b"{}"
+
+
+def test_add_file_errors():
+    iso = ISOImage("cidata")
+    iso.add_file("user-data", "")
+    with pytest.raises(ValueError):
+        iso.add_file("user-data", "")
+    with pytest.raises(ValueError):
+        iso.add_file("user-data/foo", "")
+    with pytest.raises(ValueError):
+        iso.add_file("a" * 65, "")
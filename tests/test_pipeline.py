@@ -0,0 +1,43 @@
+import asyncio
+
+from virt_lightning.pipeline import DONE, Pipeline
+
+
+def test_items_move_independently():
+    events = []
+
+    async def first(item):
+        await asyncio.sleep(item / 10)
+
+    async def second(item):
+        pass
+
+    pipeline = Pipeline(
+        [("first", first), ("second", second)],
+        on_stage=lambda item, stage: events.append((item, stage)),
+    )
+    asyncio.run(pipeline.run([3, 1]))
+    assert events.index((1, DONE)) < events.index((3, "second"))
+    assert events.count((3, DONE)) == 1
+    assert not pipeline.errors
+
+
+def test_drop_and_errors():
+    seen = []
+    drained = []
+
+    async def check(item):
+        if item == "fail":
+            raise ValueError(item)
+        return item != "skip"
+
+    async def record(item):
+        seen.append(item)
+
+    pipeline = Pipeline(
+        [("check", check), ("record", record)], on_drained=drained.append
+    )
+    asyncio.run(pipeline.run(["skip", "fail", "ok"]))
+    assert seen == ["ok"]
+    assert [str(e) for e in pipeline.errors] == ["fail"]
+    assert drained == ["check", "record"]
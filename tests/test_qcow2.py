@@ -0,0 +1,71 @@
+import struct
+
+import pytest
+
+from virt_lightning.qcow2 import (
+    EXTENSION_BACKING_FORMAT,
+    InvalidImageError,
+    backing_chain,
+    read_header,
+)
+
+GB = 1024**3
+
+
+def qcow2_image(path, size, backing_file=None, version=3):
+    header_length = 104 if version == 3 else 72
+    extensions = b""
+    if backing_file:
+        extensions += struct.pack(">II", EXTENSION_BACKING_FORMAT, 5) + b"qcow2\0\0\0"
+    extensions += struct.pack(">II", 0, 0)
+    name = (backing_file or "").encode()
+    backing_offset = header_length + len(extensions) if name else 0
+    header = struct.pack(
+        ">4sIQIIQ", b"QFI\xfb", version, backing_offset, len(name), 16, size
+    )
+    header = header.ljust(header_length - 8, b"\0")
+    header += struct.pack(">II", 4, header_length) if version == 3 else b"\0" * 8
+    path.write_bytes(header + extensions + name)
+    return path
+
+
+def test_read_header(tmp_path):
+    header = read_header(qcow2_image(tmp_path / "base.qcow2", 2 * GB))
+    assert (header.version, header.virtual_size, header.cluster_size) == (
+        3,
+        2 * GB,
+        65536,
+    )
+    assert header.backing_file is None
+
+    header = read_header(qcow2_image(tmp_path / "a.qcow2", GB, "base.qcow2", 2))
+    assert (header.version, header.backing_file) == (2, "base.qcow2")
+
+    (tmp_path / "raw").write_bytes(b"\0" * 512)
+    with pytest.raises(InvalidImageError):
+        read_header(tmp_path / "raw")
+
+
+def test_read_header_cache(tmp_path):
+    path = qcow2_image(tmp_path / "base.qcow2", GB)
+    assert read_header(path) is read_header(path)
+    # A new image at the same path
+    qcow2_image(tmp_path / "new.qcow2", 2 * GB).rename(path)
+    assert read_header(path).virtual_size == 2 * GB
+
+
+def test_backing_chain(tmp_path):
+    qcow2_image(tmp_path / "base.qcow2", 2 * GB)
+    qcow2_image(tmp_path / "golden.qcow2", 2 * GB, str(tmp_path / "base.qcow2"))
+    qcow2_image(tmp_path / "vm.qcow2", 15 * GB, "golden.qcow2")
+    chain = backing_chain(tmp_path / "vm.qcow2")
+    assert [h.virtual_size for h in chain] == [15 * GB, 2 * GB, 2 * GB]
+    assert chain[1].backing_format == "qcow2"
+
+
+def test_backing_chain_stops_at_invalid_backing_file(tmp_path):
+    (tmp_path / "base.raw").write_bytes(b"\0" * 512)
+    qcow2_image(tmp_path / "vm.qcow2", GB, "base.raw")
+    qcow2_image(tmp_path / "orphan.qcow2", GB, "missing.qcow2")
+    assert len(backing_chain(tmp_path / "vm.qcow2")) == 1
+    assert len(backing_chain(tmp_path / "orphan.qcow2")) == 1
@@ -0,0 +1,101 @@
+import asyncio
+import socket
+import threading
+
+from virt_lightning.readiness import READY, TIMEOUT, AgentEvents, SSHProber
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_ready():
+    async def banner(reader, writer):
+        writer.write(b"SSH-2.0-OpenSSH\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(banner, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await SSHProber(port=port).wait("a", "127.0.0.1", timeout=5)
+
+    result = asyncio.run(run())
+    assert result.status == READY
+    assert result.ready
+    assert result.attempts == 1
+
+
+def test_timeout():
+    prober = SSHProber(timeout=1, port=free_port())
+    result = asyncio.run(prober.wait("a", "127.0.0.1"))
+    assert result.status == TIMEOUT
+    assert not result.ready
+    assert result.attempts > 1
+    assert isinstance(result.error, OSError)
+
+
+def test_concurrency_limit():
+    active = []
+    peak = []
+
+    async def slow_banner(reader, writer):
+        active.append(writer)
+        peak.append(len(active))
+        await asyncio.sleep(0.2)
+        writer.write(b"SSH-2.0-OpenSSH\r\n")
+        await writer.drain()
+        active.remove(writer)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(slow_banner, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        prober = SSHProber(max_concurrent=2, port=port)
+        async with server:
+            return await asyncio.gather(
+                *[prober.wait(str(i), "127.0.0.1", timeout=10) for i in range(5)]
+            )
+
+    results = asyncio.run(run())
+    assert all(r.ready for r in results)
+    assert max(peak) == 2
+
+
+def test_wait_for_agent():
+    async def banner(reader, writer):
+        writer.write(b"SSH-2.0-OpenSSH\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def resolve():
+        return "127.0.0.1"
+
+    async def run():
+        events = AgentEvents(asyncio.get_running_loop())
+        server = await asyncio.start_server(banner, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        threading.Timer(0.2, events.connected, args=["a"]).start()
+        async with server:
+            return await SSHProber(port=port).wait(
+                "a", None, timeout=5, agent=events.future("a"), resolve=resolve
+            )
+
+    result = asyncio.run(run())
+    assert result.ready
+    assert result.address == "127.0.0.1"
+    assert result.attempts == 1
+
+
+def test_no_probe_before_agent():
+    async def run():
+        events = AgentEvents(asyncio.get_running_loop())
+        prober = SSHProber(timeout=1, port=free_port())
+        return await prober.wait("a", "127.0.0.1", agent=events.future("a"))
+
+    result = asyncio.run(run())
+    assert result.status == TIMEOUT
+    assert result.attempts == 0
@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+from virt_lightning import scheduler
+
+
+def test_default_limits(tmp_path, monkeypatch):
+    for name in ("vda", "vdb", "loop0"):
+        (tmp_path / name).mkdir()
+    (tmp_path / "vda" / "device").mkdir()
+    (tmp_path / "vdb" / "device").mkdir()
+    monkeypatch.setattr(scheduler, "SYS_BLOCK_DIR", str(tmp_path))
+    monkeypatch.setattr(scheduler.os, "cpu_count", lambda: 2)
+    assert scheduler.default_limits() == {"rpc": 8, "cpu": 2, "io": 8}
+
+
+def test_limits_and_stats():
+    s = scheduler.Scheduler(rpc=3, io=1)
+    assert s.limits["rpc"] == 3
+    assert s.limits["io"] == 1
+
+    async def run():
+        return await asyncio.gather(*[s.run("io", time.sleep, 0.05) for _ in range(3)])
+
+    asyncio.run(run())
+    s.shutdown()
+    stats = s.stats()
+    assert stats["io"]["tasks"] == 3
+    assert stats["io"]["peak"] == 1
+    assert stats["io"]["busy"] >= 0.15
+    assert 0 < stats["io"]["utilization"] <= 1
+    assert stats["rpc"]["tasks"] == 0
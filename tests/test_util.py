@@ -1,6 +1,6 @@
 import pytest
 
-from virt_lightning.util import strtobool
+from virt_lightning.util import builder_host, strtobool
 
 
 @pytest.mark.parametrize(
@@ -76,3 +76,15 @@ def test_strtobool__value_error(str_value: str):
 def test_strtobool__type_error(str_value: str):
     with pytest.raises(TypeError):
         strtobool(str_value)
+
+
+def test_builder_host():
+    networks = [{"network": "vl", "ipv4": "192.168.123.5/24", "mac": "52:54:00:1"}]
+    host = {"name": "vm", "distro": "debian-12", "networks": networks, "disks": []}
+    builder = builder_host(host, "builder", excluded=("disks",))
+    assert builder == {
+        "name": "builder",
+        "distro": "debian-12",
+        "networks": [{"network": "vl"}],
+    }
+    assert host["networks"][0]["ipv4"] == "192.168.123.5/24"
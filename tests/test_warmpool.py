@@ -0,0 +1,67 @@
+from unittest.mock import MagicMock, Mock
+
+import virt_lightning.virt_lightning as vl
+from virt_lightning.warmpool import POOL_CONTEXT, WarmPool
+
+
+def pool(records=()):
+    hv = MagicMock(**{"list_domain_records.return_value": list(records)})
+    configuration = Mock(
+        warm_pool={"debian-12": {"count": 2, "memory": 1024}},
+        ssh_key_file="~/.ssh/id_ed25519.pub",
+    )
+    return WarmPool(hv, configuration)
+
+
+def test_missing():
+    record = vl.DomainRecord(name="vl-pool-debian-12-a", distro="debian-12", active=True)
+    hosts = pool([record]).missing()
+    assert len(hosts) == 1
+    assert hosts[0]["name"].startswith("vl-pool-debian-12-")
+    assert hosts[0]["memory"] == 1024
+
+
+def test_matches():
+    warm_pool = pool()
+    assert warm_pool.matches({"distro": "debian-12", "name": "a"})
+    assert warm_pool.matches({"distro": "debian-12", "memory": 1024})
+    assert not warm_pool.matches({"distro": "debian-12", "memory": 2048})
+    assert not warm_pool.matches({"distro": "debian-12", "disks": [{"size": 20}]})
+    assert not warm_pool.matches({"distro": "fedora-41"})
+
+
+def test_claim():
+    record = vl.DomainRecord(
+        name="vl-pool-debian-12-a", distro="debian-12", active=True, username="vl"
+    )
+    warm_pool = pool([record])
+    domain = warm_pool.claim({"distro": "debian-12", "name": "a"}, "default")
+    warm_pool.hv.list_domain_records.assert_called_with(context=POOL_CONTEXT)
+    domain.record_metadata.assert_called_with("name", "a")
+    assert domain.context == "default"
+    domain.add_authorized_keys.assert_not_called()
+    warm_pool.hv.set_dns_entry.assert_called_with(domain.ipv4, ["a"])
+    assert warm_pool.claimed == 1
+
+    assert not warm_pool.claim({"distro": "debian-12", "username": "b"}, "default")
+
+
+def test_claim_running_domain(hv, monkeypatch):
+    name = f"{vl.POOL_PREFIX}debian-12-a"
+    domain = hv.create_domain(name=name, distro="debian-12")
+    with domain.batch_metadata():
+        domain.context = POOL_CONTEXT
+        domain.record_metadata("username", "vl")
+        domain.attach_network(network="my_network", ipv4="1.0.0.9/24")
+    domain.attach_disk(hv.create_disk(f"{name}-0"))
+    domain.define()
+    domain.dom.create()
+    monkeypatch.setattr(vl.LibvirtDomain, "agent_exec", Mock())
+
+    configuration = Mock(warm_pool={"debian-12": {"count": 1, "memory": 1024}})
+    warm_pool = WarmPool(hv, configuration)
+    assert warm_pool.claim({"distro": "debian-12", "name": "a"}, "default")
+    # The live metadata of the running domain is updated
+    assert [r.name for r in hv.list_domain_records(context="default")] == ["a"]
+    assert hv.get_domain_by_name("a").dom.name() == name
+    assert not warm_pool.members()
@@ -0,0 +1,88 @@
+import lzma
+
+import pytest
+
+from virt_lightning import xz
+
+
+def multi_block_xz(*parts, check=lzma.CHECK_CRC64):
+    """Return a single .xz stream with a block per part."""
+    blocks = []
+    records = []
+    for part in parts:
+        stream = lzma.compress(part, format=lzma.FORMAT_XZ, check=check)
+        index_size, _ = xz.parse_stream_footer(stream[-xz.FOOTER_SIZE :])
+        index_offset = len(stream) - xz.FOOTER_SIZE - index_size
+        index = xz.parse_index(stream[index_offset : -xz.FOOTER_SIZE], check)
+        blocks.append(stream[xz.HEADER_SIZE : index_offset])
+        records.append((index.blocks[0].unpadded_size, len(part)))
+    index = xz.encode_index(records)
+    return (
+        xz.stream_header(check)
+        + b"".join(blocks)
+        + index
+        + xz.stream_footer(len(index), check)
+    )
+
+
+PARTS = [b"a" * 100000, bytes(range(256)) * 10, b"\0" * 3 * xz.CHUNK_SIZE]
+
+
+def test_read_index():
+    data = multi_block_xz(*PARTS)
+    assert lzma.decompress(data) == b"".join(PARTS)
+    index = xz.read_index(lambda offset, size: data[offset : offset + size], len(data))
+    assert index.check == lzma.CHECK_CRC64
+    assert [b.uncompressed_size for b in index.blocks] == [len(p) for p in PARTS]
+    assert index.blocks[1].uncompressed_offset == len(PARTS[0])
+    assert index.uncompressed_size == sum(len(p) for p in PARTS)
+
+    # Two concatenated streams
+    data += multi_block_xz(b"b")
+    with pytest.raises(xz.XzError):
+        xz.read_index(lambda offset, size: data[offset : offset + size], len(data))
+
+
+def test_block_decoder():
+    data = multi_block_xz(*PARTS, check=lzma.CHECK_CRC32)
+    index = xz.read_index(lambda offset, size: data[offset : offset + size], len(data))
+    for part, block in zip(PARTS, index.blocks):
+        block_data = data[block.offset : block.offset + block.size]
+        decoder = xz.BlockDecoder(block, index.check)
+        assert decoder.decode_bytes(block_data) == part
+        # The output is bounded
+        chunks = list(decoder.decode([block_data[:10], block_data[10:]]))
+        assert max(len(c) for c in chunks) <= xz.CHUNK_SIZE
+
+    block = index.blocks[0]
+    corrupted = bytearray(data[block.offset : block.offset + block.size])
+    corrupted[-1] ^= 1
+    with pytest.raises(lzma.LZMAError):
+        xz.BlockDecoder(block, index.check).decode_bytes(bytes(corrupted))
+
+
+def test_decompress():
+    data = lzma.compress(PARTS[0]) + multi_block_xz(*PARTS[1:])
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    output = list(xz.decompress(chunks))
+    assert b"".join(output) == b"".join(PARTS)
+    assert max(len(chunk) for chunk in output) <= xz.CHUNK_SIZE
+    with pytest.raises(xz.XzError):
+        list(xz.decompress(chunks[:-1]))
+
+
+def test_decompress_stream_padding():
+    # Accepted by lzma.LZMAFile and xz
+    data = lzma.compress(PARTS[0]) + b"\0" * 8 + lzma.compress(PARTS[1]) + b"\0" * 4
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    chunks.insert(-1, b"")
+    assert b"".join(xz.decompress(chunks)) == b"".join(PARTS[:2])
+    # The padding between two chunks
+    split = len(lzma.compress(PARTS[0])) + 2
+    assert b"".join(xz.decompress([data[:split], data[split:]])) == b"".join(
+        PARTS[:2]
+    )
+    with pytest.raises(xz.XzError):
+        list(xz.decompress([lzma.compress(PARTS[0]) + b"\0" * 3]))
+    with pytest.raises(xz.XzError):
+        list(xz.decompress([lzma.compress(PARTS[0]) + b"\0" + data]))
@@ -63,6 +63,35 @@ class Image:
         self.qcow2_url = qcow2_url
         self.meta: dict[str] = {}
         self.yaml_url: str = ""
+        self.checksum_urls: list[str] = []
+        self.sha256: str = ""
+        self.sha256sums_url: str = ""
+
+    def retrieve_checksum(self):
+        base_url, file_name = self.qcow2_url.rsplit("/", 1)
+        candidates = self.checksum_urls or [
+            f"{base_url}/SHA256SUMS",
+            f"{base_url}/CHECKSUM",
+            f"{base_url}/CHECKSUM.SHA256",
+            f"{self.qcow2_url}.sha256",
+        ]
+        for url in candidates:
+            resp = urllib3.request("GET", url, redirect=True)
+            if resp.status != 200:
+                continue
+            for line in resp.data.decode(errors="replace").split("\n"):
+                line = line.strip()
+                m = re.match(r"([0-9a-fA-F]{64})(?:\s+\*?(\S+))?$", line)
+                if m:
+                    digest, name = m.groups()
+                elif m := re.match(r"SHA256 \((.+)\) = ([0-9a-fA-F]{64})$", line):
+                    name, digest = m.groups()
+                else:
+                    continue
+                if name is None or name.rsplit("/", 1)[-1] == file_name:
+                    self.sha256 = digest.lower()
+                    self.sha256sums_url = url
+                    return
 
     def as_dict(self):
         return {
@@ -70,6 +99,8 @@ class Image:
             "qcow2_url": self.qcow2_url,
             "meta": self.meta,
             "yaml_url": self.yaml_url,
+            "sha256": self.sha256,
+            "sha256sums_url": self.sha256sums_url,
         }
 
     def __repr__(self):
@@ -88,7 +119,11 @@ def get_fedora_images() -> list[Image]:
         resp = urllib3.request("GET", base_url, redirect=True)
         m = re.search(">(Fedora-Cloud.*?qcow2)<", resp.data.decode())
         if m:
-            return Image(f"fedora-{version}", f"{base_url}/{m.group(1)}")
+            image = Image(f"fedora-{version}", f"{base_url}/{m.group(1)}")
+            checksum = re.search(">(Fedora-Cloud.*?CHECKSUM)<", resp.data.decode())
+            if checksum:
+                image.checksum_urls = [f"{base_url}/{checksum.group(1)}"]
+            return image
 
     return filter(lambda x: x, [get(v) for v in range(39, 60)])
 
@@ -193,6 +228,11 @@ images += get_bsd_images()
 images += get_alpine_images()
 images += get_freebsd_images()
 
+# The digests are published in images.json, vl pull verifies the images
+# without another request
+for image in images:
+    image.retrieve_checksum()
+
 index_md = ""
 images_redir = ""
 for image in sorted(images, key=lambda i: i.name):
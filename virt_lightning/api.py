@@ -2,23 +2,53 @@
 
 import asyncio
 import collections
+import contextlib
 import ipaddress
 import json
 import logging
-import lzma
 import pathlib
 import re
 import sys
+import threading
+import urllib.parse
 import urllib.request
-from concurrent.futures import ThreadPoolExecutor
 
 import libvirt
 import yaml
 
+import virt_lightning.qcow2 as qcow2
 import virt_lightning.virt_lightning as vl
+import virt_lightning.xz as xz
+from virt_lightning.booted import (
+    TEMPLATE_CONTEXT,
+    BootedTemplates,
+    TemplateError,
+    templatable,
+    template_key,
+)
 from virt_lightning.configuration import Configuration
+from virt_lightning.download import (
+    ChecksumError,
+    Digests,
+    RangeNotSupportedError,
+    ResumeState,
+    SegmentedDownload,
+    SparseWriter,
+    XzDownload,
+    accepts_ranges,
+    disk_usage,
+    parse_checksums,
+    prefetch,
+    read_chunks,
+    validator,
+)
+from virt_lightning.golden import GOLDEN_CONTEXT, GoldenImageError, GoldenImages
+from virt_lightning.pipeline import DONE, Pipeline
+from virt_lightning.readiness import AgentEvents, SSHProber
+from virt_lightning.scheduler import Scheduler
 from virt_lightning.symbols import get_symbols
 from virt_lightning.util import strtobool
+from virt_lightning.warmpool import POOL_CONTEXT, WarmPool
 
 BASE_URL = "https://virt-lightning.org"
 
@@ -33,6 +63,8 @@ libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
 symbols = get_symbols()
 
 MB = 1024 * 1000
+# The libvirt connections of the worker threads, per Session
+POOL_SIZE = 4
 
 
 class VMNotFoundError(Exception):
@@ -59,6 +91,11 @@ class CannotConnectToLibvirtError(Exception):
     pass
 
 
+class VMNotReachableError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
 def _register_aio_virt_impl(loop):
     # Ensure we may call shell.up() multiple times
     # from the same asyncio program.
@@ -90,10 +127,128 @@ def _connect_libvirt(uri):
         raise
 
 
-def _start_domain(hv, host, context, configuration):
-    distro = host["distro"]
+class Session:
+    """The libvirt connections and the initialized hypervisor of a caller.
+
+    A Session can be passed to the api functions to run them on the same
+    connection, the network and the storage pool are only initialized once:
+
+        with Session(configuration) as session:
+            up(virt_lightning_yaml, configuration, session=session)
+            print(ansible_inventory(configuration, session=session))
+
+    The worker threads get their own hypervisor from worker_hv(), on top of
+    a small pool of connections, since libvirtd only handles a few requests
+    at a time per client.
+    """
+
+    def __init__(self, configuration, pool_size=POOL_SIZE):
+        self.configuration = configuration
+        self.pool_size = pool_size
+        self._lock = threading.RLock()
+        self._conn = None
+        self._hv = None
+        self._network_ready = False
+        self._storage_ready = False
+        self._pool = []
+        self._workers = {}
+        self._next_worker = 0
+        self._events = {}
+        self._events_conns = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def conn(self):
+        with self._lock:
+            if not self._conn:
+                self._conn = _connect_libvirt(self.configuration.libvirt_uri)
+            return self._conn
+
+    def create_hypervisor(self, conn):
+        return vl.LibvirtHypervisor(conn)
+
+    def hypervisor(self, network=False, storage=False):
+        with self._lock:
+            if not self._hv:
+                self._hv = self.create_hypervisor(self.conn)
+            if network and not self._network_ready:
+                self._hv.init_network(
+                    self.configuration.network_name,
+                    self.configuration.network_cidr,
+                    self.configuration.network_ipv6_cidr,
+                )
+                self._network_ready = True
+                # The clones hold the previous network handle
+                self._workers = {}
+            if storage and not self._storage_ready:
+                self._hv.init_storage_pool(self.configuration.storage_pool)
+                self._storage_ready = True
+                self._workers = {}
+            return self._hv
+
+    def invalidate_network(self):
+        # The network was destroyed, the next caller creates it again
+        with self._lock:
+            self._network_ready = False
+
+    def worker_hv(self):
+        """A clone of the hypervisor, on the next connection of the pool."""
+        with self._lock:
+            hv = self.hypervisor()
+            if len(self._pool) < self.pool_size:
+                self._pool.append(_connect_libvirt(self.configuration.libvirt_uri))
+            conn = self._pool[self._next_worker % len(self._pool)]
+            self._next_worker += 1
+            if conn not in self._workers:
+                self._workers[conn] = hv.clone(conn)
+            return self._workers[conn]
+
+    def watch_guest_agents(self, loop):
+        # A dedicated connection, opened once the event loop is registered
+        with self._lock:
+            if loop not in self._events:
+                conn = _connect_libvirt(self.configuration.libvirt_uri)
+                self._events_conns.append(conn)
+                self._events[loop] = _watch_guest_agents(conn, loop)
+            return self._events[loop]
+
+    def close(self):
+        with self._lock:
+            conns = self._pool + self._events_conns
+            if self._conn:
+                conns.append(self._conn)
+            self._conn = None
+            self._hv = None
+            self._network_ready = self._storage_ready = False
+            self._pool = []
+            self._workers = {}
+            self._events = {}
+            self._events_conns = []
+        for conn in conns:
+            with contextlib.suppress(libvirt.libvirtError):
+                conn.close()
+
+
+def _session(configuration, session):
+    # A temporary session when the caller didn't pass one
+    if session:
+        return contextlib.nullcontext(session)
+    return Session(configuration)
+
+
+def _set_default_name(host):
     if "name" not in host:
-        host["name"] = re.sub(r"[^a-zA-Z0-9-]+", "", distro)
+        host["name"] = re.sub(r"[^a-zA-Z0-9-]+", "", host["distro"])
+
+
+def _define_domain(hv, host, context, configuration):
+    distro = host["distro"]
+    _set_default_name(host)
 
     domain = hv.get_domain_by_name(host["name"])
     if not domain:
@@ -127,21 +282,40 @@ def _start_domain(hv, host, context, configuration):
         "default_bus_type": host.get("default_bus_type"),
     }
     domain = hv.create_domain(name=host["name"], distro=distro)
-    hv.configure_domain(domain, user_config)
-    domain.context = context
-    networks = host.get("networks", [{}])
-    for i, network in enumerate(networks):
-        if "network" not in network:
-            network["network"] = configuration.network_name
-        if i == 0 and not network.get("ipv4"):
-            network["ipv4"] = hv.get_free_ipv4()
-        ipv4 = network.get("ipv4")
-        if ipv4:
-            network["mac"] = hv.reuse_mac_address(
-                network["network"], host["name"], ipaddress.ip_interface(ipv4)
-            )
-        domain.attach_network(**network)
+    with domain.batch_metadata():
+        hv.configure_domain(domain, user_config)
+        domain.context = context
+        networks = host.get("networks", [{}])
+        for i, network in enumerate(networks):
+            if "network" not in network:
+                network["network"] = configuration.network_name
+            if i == 0 and not network.get("ipv4"):
+                network["ipv4"] = hv.get_free_ipv4()
+            elif (
+                network.get("ipv4")
+                and network["network"] == configuration.network_name
+            ):
+                hv.get_ipam().reserve(network["ipv4"])
+            if (
+                i == 0
+                and not network.get("ipv6")
+                and network["network"] == configuration.network_name
+            ):
+                network["ipv6"] = hv.get_free_ipv6()
+            ipv4 = network.get("ipv4")
+            if ipv4 and not network.get("bridge"):
+                ipv4 = hv.get_network_interface(network["network"], ipv4)
+                network["ipv4"] = ipv4
+            if ipv4:
+                network["mac"] = hv.reuse_mac_address(
+                    network["network"], host["name"], ipaddress.ip_interface(ipv4)
+                )
+            domain.attach_network(**network)
+    return domain
+
 
+def _attach_disks(hv, domain, host, backing_file=None):
+    distro = host["distro"]
     if "root_disk_size" in host:
         logger.debug("The key 'root_disk_size' is deprecated. Use 'disks' instead")
 
@@ -155,11 +329,24 @@ def _start_domain(hv, host, context, configuration):
         if "disks" not in host and "root_disk_size" in host:
             size = int(host["root_disk_size"])
 
-        volume = hv.create_disk(
-            name=f"{host['name']}-{i}", backing_on=(distro if i == 0 else ""), size=size
-        )
+        if i == 0 and backing_file:
+            volume = hv.create_disk(
+                name=f"{host['name']}-{i}", backing_file=backing_file, size=size
+            )
+        else:
+            volume = hv.create_disk(
+                name=f"{host['name']}-{i}",
+                backing_on=(distro if i == 0 else ""),
+                size=size,
+            )
         domain.attach_disk(volume=volume)
 
+
+def _start_domain(hv, host, context, configuration):
+    domain = _define_domain(hv, host, context, configuration)
+    if not domain:
+        return
+    _attach_disks(hv, domain, host)
     hv.start(domain, metadata_format=host.get("metadata_format", {}))
     return domain
 
@@ -175,23 +362,33 @@ def _ensure_image_exists(hv, hosts):
                 raise ImageNotFoundLocallyError(distro) from None
 
 
-def up(virt_lightning_yaml, configuration, context="default", **kwargs):
-    """Create a list of VM."""
+class _Deployment:
+    def __init__(self, host):
+        _set_default_name(host)
+        self.host = host
+        self.domain = None
+        # The golden image of the root disk
+        self.backing = None
+        self.result = None
 
-    def _lifecycle_callback(conn, dom, state, reason, opaque):  # noqa: N802
-        if state == 1:
-            logger.info("%s %s QEMU agent found", symbols.CUSTOMS.value, dom.name())
+    def __str__(self):
+        return self.host["name"]
+
+
+def _check_readiness(results):
+    failed = sorted(r.name for r in results if not r.ready)
+    if failed:
+        raise VMNotReachableError(", ".join(failed))
 
-    loop = _register_aio_virt_impl(kwargs.get("loop"))
 
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+def _watch_guest_agents(conn, loop):
+    events = AgentEvents(loop)
 
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
+    def _lifecycle_callback(conn, dom, state, reason, opaque):  # noqa: N802
+        if state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+            logger.info("%s %s QEMU agent found", symbols.CUSTOMS.value, dom.name())
+            events.connected(dom.name())
 
-    _ensure_image_exists(hv, virt_lightning_yaml)
-    conn = _connect_libvirt(configuration.libvirt_uri)
     conn.setKeepAlive(interval=5, count=3)
     conn.domainEventRegisterAny(
         None,
@@ -199,29 +396,216 @@ def up(virt_lightning_yaml, configuration, context="default", **kwargs):
         _lifecycle_callback,
         None,
     )
+    return events
 
-    pool = ThreadPoolExecutor(max_workers=10)
 
-    async def deploy():
-        futures = []
-        for host in virt_lightning_yaml:
-            futures.append(
-                loop.run_in_executor(
-                    pool, _start_domain, hv, host, context, configuration
-                )
+def up(virt_lightning_yaml, configuration, context="default", **kwargs):
+    """Create a list of VM."""
+    loop = _register_aio_virt_impl(kwargs.get("loop"))
+    with _session(configuration, kwargs.get("session")) as session:
+        _up(session, loop, virt_lightning_yaml, configuration, context, **kwargs)
+
+
+def _up(session, loop, virt_lightning_yaml, configuration, context, **kwargs):
+    hv = session.hypervisor(network=True, storage=True)
+    events = session.watch_guest_agents(loop)
+
+    scheduler = Scheduler(
+        rpc=kwargs.get("rpc_workers") or configuration.rpc_workers,
+        cpu=kwargs.get("cpu_workers") or configuration.cpu_workers,
+        io=kwargs.get("io_workers") or configuration.io_workers,
+    )
+    prober = SSHProber(timeout=configuration.ssh_timeout)
+    # One download per distro, whatever the number of hosts
+    images = {}
+    # The DNS and DHCP entries of all the domains are applied at once, when
+    # the last domain has booted.
+    reservations = contextlib.ExitStack()
+    reservations.enter_context(hv.reservations.batch())
+    stage_callback = kwargs.get("stage_callback")
+
+    run = scheduler.run
+    # The RPC calls are spread over the connections of the session
+    worker = session.worker_hv
+    # The VMs of the pool are not claimed to fill the pool
+    pool = WarmPool(hv, configuration) if context != POOL_CONTEXT else None
+    templates = BootedTemplates(hv)
+    # One template build per profile, whatever the number of hosts
+    built = {}
+    goldens = GoldenImages(hv, configuration)
+    golden_builds = {}
+
+    async def claim(deployment):
+        if pool:
+            deployment.domain = await run("rpc", pool.claim, deployment.host, context)
+        if deployment.domain:
+            on_stage(deployment, DONE)
+            return False
+
+    async def image(deployment):
+        distro = deployment.host["distro"]
+        if distro not in images:
+            images[distro] = run("io", _ensure_image_exists, hv, [deployment.host])
+        await images[distro]
+
+    async def define(deployment):
+        deployment.domain = await run(
+            "rpc", _define_domain, worker(), deployment.host, context, configuration
+        )
+        return deployment.domain is not None
+
+    async def golden(deployment):
+        deployment.backing = await provision(deployment.domain, deployment.host)
+
+    async def provision(domain, host):
+        """Return the golden image the root disk of the domain backs onto."""
+        if not goldens.enabled:
+            return None
+        key = await run("io", goldens.key, domain)
+        if not key:
+            return None
+        if key not in golden_builds:
+            golden_builds[key] = asyncio.ensure_future(build_golden(host, key))
+        path = await golden_builds[key]
+        goldens.use(domain, key)
+        return path
+
+    async def build_golden(host, key):
+        path = await run("io", goldens.get, key)
+        if path:
+            return path
+        host = goldens.builder(host, key)
+        start = loop.time()
+        domain = await run(
+            "rpc", _define_domain, worker(), host, GOLDEN_CONTEXT, configuration
+        )
+        if not domain:
+            raise GoldenImageError(host["name"])
+        await boot_builder(domain, host)
+        return await run("rpc", goldens.save, domain, key, loop.time() - start)
+
+    async def boot_builder(domain, host, backing=None):
+        await run("io", _attach_disks, worker(), domain, host, backing)
+        image = await run(
+            "cpu", hv.build_cloud_init_image, domain, host.get("metadata_format", {})
+        )
+        await run("io", worker().attach_seed, domain, image)
+        await run("rpc", worker().boot, domain)
+        result = await domain.reachable(prober=prober, events=events)
+        if not result.ready:
+            raise VMNotReachableError(host["name"])
+
+    async def template(deployment):
+        host = deployment.host
+        if not host.get("template"):
+            return
+        if not templatable(host, configuration.network_name):
+            logger.warning("%s cannot be restored from a template", deployment)
+            return
+        start = loop.time()
+        key = template_key(deployment.domain, host)
+        if key not in built:
+            built[key] = asyncio.ensure_future(build_template(host, key))
+        entry = await built[key]
+        metadata_format = host.get("metadata_format", {})
+        image = await run(
+            "cpu", hv.build_cloud_init_image, deployment.domain, metadata_format
+        )
+        seed = await run("io", hv.upload_seed, deployment.domain, image)
+        await run("io", templates.restore, entry, deployment.domain, seed)
+        await run("rpc", templates.fix_identity, entry, deployment.domain)
+        deployment.result = await deployment.domain.reachable(prober=prober)
+        if deployment.result.ready:
+            elapsed = loop.time() - start
+            templates.record(key, elapsed)
+            logger.info(
+                "%s %s restored in %.1fs (cold boot: %.1fs)",
+                symbols.LIGHTNING.value,
+                deployment,
+                elapsed,
+                entry["cold_boot"],
             )
+        on_stage(deployment, DONE)
+        return False
+
+    async def build_template(host, key):
+        entry = templates.get(key)
+        if entry:
+            return entry
+        host = templates.builder(host, key)
+        domain = await run(
+            "rpc", _define_domain, worker(), host, TEMPLATE_CONTEXT, configuration
+        )
+        if not domain:
+            raise TemplateError(host["name"])
+        templates.prepare(domain)
+        backing = await provision(domain, host)
+        start = loop.time()
+        await boot_builder(domain, host, backing)
+        return await run("rpc", templates.save, domain, key, loop.time() - start)
+
+    async def disks(deployment):
+        await run(
+            "io",
+            _attach_disks,
+            worker(),
+            deployment.domain,
+            deployment.host,
+            deployment.backing,
+        )
+
+    async def seed(deployment):
+        metadata_format = deployment.host.get("metadata_format", {})
+        image = await run(
+            "cpu", hv.build_cloud_init_image, deployment.domain, metadata_format
+        )
+        await run("io", worker().attach_seed, deployment.domain, image)
 
-        domain_reachable_futures = []
-        for f in futures:
-            await f
-            domain = f.result()
-            if domain:
-                domain_reachable_futures.append(domain.reachable())
-        logger.info("%s ok Waiting...", symbols.HOURGLASS.value)
+    async def boot(deployment):
+        await run("rpc", worker().boot, deployment.domain)
 
-        await asyncio.gather(*domain_reachable_futures)
+    async def probe(deployment):
+        deployment.result = await deployment.domain.reachable(
+            prober=prober, events=events
+        )
 
-    loop.run_until_complete(deploy())
+    def on_stage(deployment, stage):
+        logger.debug("%s: %s", deployment, stage)
+        if stage_callback:
+            stage_callback(str(deployment), stage)
+
+    def on_drained(stage):
+        if stage == "boot":
+            reservations.close()
+            logger.info("%s ok Waiting...", symbols.HOURGLASS.value)
+
+    pipeline = Pipeline(
+        [
+            ("claim", claim),
+            ("image", image),
+            ("define", define),
+            ("golden", golden),
+            ("template", template),
+            ("disks", disks),
+            ("seed", seed),
+            ("boot", boot),
+            ("probe", probe),
+        ],
+        on_stage=on_stage,
+        on_drained=on_drained,
+    )
+    deployments = [_Deployment(host) for host in virt_lightning_yaml]
+    try:
+        with reservations:
+            loop.run_until_complete(pipeline.run(deployments))
+    finally:
+        scheduler.shutdown()
+        scheduler.log_stats()
+    if pool and pool.claimed:
+        pool.refill_in_background()
+    if pipeline.errors:
+        raise pipeline.errors[0]
+    _check_readiness([d.result for d in deployments if d.result])
     logger.info("%s You are all set", symbols.THUMBS_UP.value)
 
 
@@ -229,212 +613,259 @@ def start(
     configuration, context="default", enable_console=False, console_fd=None, **kwargs
 ):
     """Start a single VM."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
-    host = {
-        k: kwargs[k] for k in ["name", "distro", "memory", "vcpus"] if kwargs.get(k)
-    }
-    if kwargs.get("disk"):
-        host.update({"disks": [{"size": x} for x in kwargs["disk"]]})
-    _ensure_image_exists(hv, [host])
-    domain = _start_domain(hv, host, context, configuration)
-    if not domain:
-        return
-
-    loop = _register_aio_virt_impl(loop=kwargs.get("loop"))
-
-    if enable_console:
-        import time
-
-        if console_fd is None:
-            console_fd = sys.stdout
-
-        time.sleep(4)
-        stream = conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
-        console = domain.dom.openConsole(None, stream, 0)
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(network=True, storage=True)
+        host = {
+            k: kwargs[k] for k in ["name", "distro", "memory", "vcpus"] if kwargs.get(k)
+        }
+        if kwargs.get("disk"):
+            host.update({"disks": [{"size": x} for x in kwargs["disk"]]})
+        _set_default_name(host)
+        pool = WarmPool(hv, configuration)
+        domain = pool.claim(host, context)
+        if domain:
+            pool.refill_in_background()
+            return domain
+        _ensure_image_exists(hv, [host])
+        loop = _register_aio_virt_impl(loop=kwargs.get("loop"))
+        if kwargs.get("template"):
+            host["template"] = True
+            _up(session, loop, [host], configuration, context)
+            return hv.get_domain_by_name(host["name"])
+        events = session.watch_guest_agents(loop)
+        domain = _start_domain(hv, host, context, configuration)
+        if not domain:
+            return
+
+        if enable_console:
+            import time
+
+            if console_fd is None:
+                console_fd = sys.stdout
+
+            time.sleep(4)
+            stream = session.conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
+            console = domain.dom.openConsole(None, stream, 0)
+
+            def stream_callback(stream, events, _):
+                content = stream.recv(1024 * 1024).decode("utf-8", errors="ignore")
+                console_fd.write(content)
+
+            stream.eventAddCallback(
+                libvirt.VIR_STREAM_EVENT_READABLE, stream_callback, console
+            )
 
-        def stream_callback(stream, events, _):
-            content = stream.recv(1024 * 1024).decode("utf-8", errors="ignore")
-            console_fd.write(content)
+        async def deploy():
+            return await domain.reachable(
+                prober=SSHProber(timeout=configuration.ssh_timeout), events=events
+            )
 
-        stream.eventAddCallback(
-            libvirt.VIR_STREAM_EVENT_READABLE, stream_callback, console
+        _check_readiness([loop.run_until_complete(deploy())])
+        logger.info(  # noqa: T001
+            (
+                "\033[0m\n**** System is online ****\n"
+                "To connect use:\n"
+                "  vl console %s (virsh console)"
+                "  vl ssh %s"
+            ),
+            domain.name,
+            domain.name,
         )
-
-    async def deploy():
-        await domain.reachable()
-
-    loop.run_until_complete(deploy())
-    logger.info(  # noqa: T001
-        (
-            "\033[0m\n**** System is online ****\n"
-            "To connect use:\n"
-            "  vl console %s (virsh console)"
-            "  vl ssh %s"
-        ),
-        domain.name,
-        domain.name,
-    )
-    return domain
+        return domain
+
+
+def warm_pool(configuration, **kwargs):
+    """Start the missing VMs of the warm pool."""
+    with WarmPool.filling() as locked:
+        if not locked:
+            logger.info("The warm pool is already being filled.")
+            return
+        with _session(configuration, kwargs.get("session")) as session:
+            hv = session.hypervisor(network=True, storage=True)
+            hosts = WarmPool(hv, configuration).missing()
+            if hosts:
+                up(hosts, configuration, context=POOL_CONTEXT, session=session)
+
+
+def templates(configuration, **kwargs):
+    """List the booted templates, with their cold boot and restore times."""
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(storage=True)
+        results = []
+        for key, entry in BootedTemplates(hv).entries().items():
+            restores = entry["restores"]
+            results.append(
+                {
+                    "key": key[:12],
+                    "distro": entry["distro"],
+                    "cold_boot": entry["cold_boot"],
+                    "restore": sum(restores) / len(restores) if restores else None,
+                    "restores": len(restores),
+                }
+            )
+        return sorted(results, key=lambda r: (r["distro"], r["key"]))
 
 
 def stop(configuration, **kwargs):
     """Stop and delete a given VM."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
-    domain = hv.get_domain_by_name(kwargs["name"])
-    if not domain:
-        vm_list = [d.name for d in hv.list_domains()]
-        if vm_list:
-            logger.info(
-                "No VM called %s in: %s", kwargs.get("name"), ", ".join(vm_list)
-            )
-        else:
-            logger.info("No running VM.")
-        raise VMNotFoundError(kwargs["name"])
-    hv.clean_up(domain)
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(network=True, storage=True)
+        domain = hv.get_domain_by_name(kwargs["name"])
+        if not domain:
+            vm_list = [d.name for d in hv.list_domains()]
+            if vm_list:
+                logger.info(
+                    "No VM called %s in: %s", kwargs.get("name"), ", ".join(vm_list)
+                )
+            else:
+                logger.info("No running VM.")
+            raise VMNotFoundError(kwargs["name"])
+        hv.clean_up(domain)
 
 
 def ansible_inventory(configuration, context="default", **kwargs):
     """Generate an Ansible inventory based on the running VM."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-
-    ssh_cmd_template = (
-        "{name} ansible_host={ipv4} ansible_user={username} "
-        "{additional_nics}"
-        "ansible_python_interpreter={python_interpreter} "
-        'ansible_ssh_common_args="-o UserKnownHostsFile=/dev/null '
-        "-o GSSAPIAuthentication=no -o GSSAPIKeyExchange=no "
-        '-o StrictHostKeyChecking=no"\n'
-    )
-
-    output = ""
-    groups = collections.defaultdict(list)
-    for domain in hv.list_domains():
-        if domain.context != context:
-            continue
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor()
+
+        ssh_cmd_template = (
+            "{name} ansible_host={ipv4} ansible_user={username} "
+            "{additional_nics}"
+            "ansible_python_interpreter={python_interpreter} "
+            'ansible_ssh_common_args="-o UserKnownHostsFile=/dev/null '
+            "-o GSSAPIAuthentication=no -o GSSAPIKeyExchange=no "
+            '-o StrictHostKeyChecking=no"\n'
+        )
 
-        for group in domain.groups:
-            groups[group].append(domain)
+        output = ""
+        groups = collections.defaultdict(list)
+        for domain in hv.list_domain_records(context=context):
+            for group in domain.groups:
+                groups[group].append(domain)
 
-        template = ssh_cmd_template
+            template = ssh_cmd_template
 
-        output += template.format(
-            name=domain.name,
-            username=domain.username,
-            ipv4=domain.ipv4.ip,
-            additional_nics=domain.additional_nics or "",
-            python_interpreter=domain.python_interpreter,
-        )  # noqa: T001
+            output += template.format(
+                name=domain.name,
+                username=domain.username,
+                ipv4=domain.ipv4.ip,
+                additional_nics=domain.additional_nics or "",
+                python_interpreter=domain.python_interpreter,
+            )  # noqa: T001
 
-    for group_name, domains in groups.items():
-        output += f"\n[{group_name}]\n"
-        for domain in domains:
-            output += domain.name + "\n"
-    return output
+        for group_name, domains in groups.items():
+            output += f"\n[{group_name}]\n"
+            for domain in domains:
+                output += domain.name + "\n"
+        return output
 
 
 def ssh_config(configuration, context="default", **kwargs):
     """Generate an SSH configuration based on the running VM."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-
-    ssh_host_template = (
-        "Host {name}\n"
-        "     Hostname {ipv4}\n"
-        "     User {username}\n"
-        "     IdentityFile {ssh_key_file}\n"
-    )
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor()
+
+        ssh_host_template = (
+            "Host {name}\n"
+            "     Hostname {ipv4}\n"
+            "     User {username}\n"
+            "     IdentityFile {ssh_key_file}\n"
+        )
 
-    output = ""
-    groups = {}
-    for domain in hv.list_domains():
-        for group in domain.groups:
-            groups[group].append(domain)
+        output = ""
+        groups = {}
+        for domain in hv.list_domain_records():
+            for group in domain.groups:
+                groups[group].append(domain)
 
-        if domain.context != context:
-            continue
+            if domain.context != context:
+                continue
 
-        template = ssh_host_template
+            template = ssh_host_template
 
-        output += template.format(
-            name=domain.name,
-            username=domain.username,
-            ipv4=domain.ipv4.ip,
-            ssh_key_file=domain.ssh_key,
-        )
+            output += template.format(
+                name=domain.name,
+                username=domain.username,
+                ipv4=domain.ipv4.ip,
+                # The private key
+                ssh_key_file=str(configuration.ssh_key_file).removesuffix(".pub"),
+            )
 
-    for group_name, domains in groups.items():
-        output += f"\n[{group_name}]"
-        for domain in domains:
-            output += domain.name
-    return output
+        for group_name, domains in groups.items():
+            output += f"\n[{group_name}]"
+            for domain in domains:
+                output += domain.name
+        return output
 
 
 def status(configuration, context="default", name=None, **kwargs):
     """Returns the status of the VM of the envionment."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-
-    for domain in hv.list_domains():
-        if context and context != domain.context:
-            continue
-        name = domain.name
-        if not domain.ipv4:  # Not a VL managed VM
-            continue
-        yield {
-            "name": name,
-            "ipv4": domain.ipv4 and str(domain.ipv4.ip),
-            "context": domain.context,
-            "username": domain.username,
-            "distro": domain.distro,
-        }
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor()
+
+        for domain in hv.list_domain_records(context=context or None):
+            name = domain.name
+            if not domain.ipv4:  # Not a VL managed VM
+                continue
+            yield {
+                "name": name,
+                "ipv4": domain.ipv4 and str(domain.ipv4.ip),
+                "context": domain.context,
+                "username": domain.username,
+                "distro": domain.distro,
+            }
 
 
 def exec_ssh(configuration, name=None, **kwargs):
     """Open an SSH connection on a host."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    domain = hv.get_domain_by_name(name)
-    if not domain:
-        raise VMNotFoundError(name)
-    domain.exec_ssh()
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor()
+        domain = hv.get_domain_by_name(name)
+        if not domain:
+            raise VMNotFoundError(name)
+        domain.exec_ssh()
 
 
 def list_domains(configuration, name=None, **kwargs):
     """Return a list Python-libvirt instance of the running libvirt VM."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    return sorted(hv.list_domains())
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor()
+        return sorted(hv.list_domain_records())
 
 
 def down(configuration, context="default", **kwargs):
     """Stop and remove a running environment."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
-    for domain in hv.list_domains():
-        if domain.context != context:
-            continue
-        logger.info("%s purging %s", symbols.TRASHBIN.value, domain.name)
-        hv.clean_up(domain)
-
-    if strtobool(configuration.network_auto_clean_up):
-        hv.network_obj.destroy()
-
-
-def images(configuration, **kwargs):
-    """Return a list of VM images that are available on the system."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_storage_pool(configuration.storage_pool)
-    return hv.distro_available()
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(network=True, storage=True)
+        network_auto_clean_up = strtobool(configuration.network_auto_clean_up)
+        with hv.reservations.batch():
+            for domain in hv.list_domains(context=context):
+                logger.info("%s purging %s", symbols.TRASHBIN.value, domain.name)
+                hv.clean_up(domain)
+            if network_auto_clean_up:
+                # No need to update a network that is about to be destroyed
+                hv.reservations.discard()
+
+        if network_auto_clean_up:
+            hv.network_obj.destroy()
+            session.invalidate_network()
+
+
+def images(configuration, details=False, **kwargs):
+    """Return a list of VM images that are available on the system.
+
+    With details, return the qcow2 headers of each image and of its backing
+    files instead.
+    """
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(storage=True)
+        if not details:
+            return hv.distro_available()
+        upstream = hv.get_storage_dir() / "upstream"
+        return {
+            distro: qcow2.backing_chain(upstream / f"{distro}.qcow2")
+            for distro in hv.distro_available()
+        }
 
 
 def list_remote_images(configuration, **kwargs):
@@ -449,10 +880,9 @@ def list_remote_images(configuration, **kwargs):
 
 def storage_dir(configuration, **kwargs):
     """Return the location of the VM image storage directory."""
-    conn = _connect_libvirt(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_storage_pool(configuration.storage_pool)
-    return hv.get_storage_dir()
+    with _session(configuration, kwargs.get("session")) as session:
+        hv = session.hypervisor(storage=True)
+        return hv.get_storage_dir()
 
 
 class RedirectFilter(urllib.request.HTTPRedirectHandler):
@@ -463,6 +893,58 @@ class RedirectFilter(urllib.request.HTTPRedirectHandler):
         )
 
 
+def _download_stream(r, temp_file, is_xz_compressed, progress_callback):
+    digests = Digests(compressed=is_xz_compressed)
+    # The network, the decompression and the disk run in their own threads
+    chunks = prefetch(read_chunks(r, digests.downloaded))
+    if is_xz_compressed:
+        logger.info("Detected xz-compressed content, decompressing during download...")
+        chunks = prefetch(xz.decompress(chunks))
+        length = None
+    else:
+        length = int(r.headers.get("Content-Length", 0))
+        logger.debug("Size: %s", length)
+
+    with temp_file.open("wb") as fd:
+        writer = SparseWriter(fd.fileno())
+        for chunk in chunks:
+            writer.write(chunk)
+            digests.decompressed.update(chunk)
+            if progress_callback:
+                progress_callback(writer.offset, length)
+        writer.truncate()
+    return digests
+
+
+def _published_checksum(image_info):
+    sums_url = image_info.get("sha256sums_url")
+    if not sums_url:
+        return None
+    path = urllib.parse.urlparse(image_info["qcow2_url"]).path
+    with urllib.request.urlopen(sums_url) as r:
+        return parse_checksums(r.read().decode(), path.rsplit("/", 1)[-1])
+
+
+def _verify_checksum(image_info, digests, distro):
+    """Compare the digests of a download with its published SHA-256.
+
+    Return False if no checksum is published, None if the compressed data of a
+    resumed download is unknown and it may match, raise ChecksumError if it
+    differs.
+    """
+    expected = image_info.get("sha256")
+    if not expected or digests.matches(expected) is False:
+        # The image behind a "latest" URL may be newer than the index
+        expected = _published_checksum(image_info) or expected
+    if not expected:
+        logger.debug("No checksum published for %s", distro)
+        return False
+    matches = digests.matches(expected)
+    if matches is False:
+        raise ChecksumError(distro)
+    return matches
+
+
 def fetch_distro(
     configuration, progress_callback=None, storage_dir=None, custom_url=None, **kwargs
 ):
@@ -523,26 +1005,60 @@ def fetch_distro(
         content_type.lower() == "application/x-xz" or download_url.endswith(".xz")
     )
 
-    if is_xz_compressed:
-        logger.info("Detected xz-compressed content, decompressing during download...")
-        # Wrap the response in an LZMA decompressor
-        response_stream = lzma.LZMAFile(r, "rb")  # noqa: SIM115
-        length = None
-    else:
-        response_stream = r
-        length = int(r.headers.get("Content-Length", 0))
-        logger.debug("Size: %s", length)
-
-    chunk_size = MB * 1
-    bytes_downloaded = 0
-    with temp_file.open("wb") as fd:
-        while chunk := response_stream.read(chunk_size):
-            fd.write(chunk)
-            bytes_downloaded += len(chunk)
-            if progress_callback:
-                progress_callback(bytes_downloaded, length)
-
+    # The ranges are requested from the final URL, after the redirections
+    url = r.geturl()
+    length = int(r.headers.get("Content-Length") or 0)
+    state = ResumeState(temp_file, download_url, validator(r), length)
+
+    def download_image(r):
+        if not accepts_ranges(r):
+            state.remove()
+            return _download_stream(r, temp_file, is_xz_compressed, progress_callback)
+        r.close()
+        if is_xz_compressed:
+            download = XzDownload(url, length, progress_callback, state=state)
+        else:
+            download = SegmentedDownload(
+                url,
+                length,
+                configuration.download_segments,
+                progress_callback,
+                state=state,
+            )
+        try:
+            download.run(temp_file)
+            return download.digests
+        except (RangeNotSupportedError, xz.XzError) as e:
+            logger.debug("Cannot download %s by ranges (%s), single stream", url, e)
+            state.remove()
+            r = urllib.request.urlopen(download_url)
+            return _download_stream(r, temp_file, is_xz_compressed, progress_callback)
+
+    # The image only reaches upstream/ once it's verified
+    try:
+        digests = download_image(r)
+        if _verify_checksum(image_info, digests, kwargs["distro"]) is None:
+            logger.info(
+                "Cannot verify the resumed download of %s, downloading it again",
+                kwargs["distro"],
+            )
+            temp_file.unlink()
+            state.remove()
+            digests = download_image(urllib.request.urlopen(download_url))
+            _verify_checksum(image_info, digests, kwargs["distro"])
+    except ChecksumError:
+        temp_file.unlink()
+        state.remove()
+        raise
     temp_file.rename(target_file)
+    state.remove()
+    size, allocated = disk_usage(target_file)
+    logger.info(
+        "Image %s: %dMB, %dMB allocated on the disk",
+        kwargs["distro"],
+        size // MB,
+        allocated // MB,
+    )
 
     # Handle YAML file for distro index downloads (if not custom URL)
     if image_info.get("meta"):
@@ -572,12 +1088,12 @@ def get_image_index(configuration):
 
 def fetch(configuration=None, progress_callback=None, hv=None, **kwargs):
     """Retrieve a VM image from Internet."""
-    if hv is None:
-        conn = _connect_libvirt(configuration.libvirt_uri)
-        hv = vl.LibvirtHypervisor(conn)
-        hv.init_storage_pool(configuration.storage_pool)
-
     configuration = configuration if configuration is not None else Configuration()
+    if hv is None:
+        with _session(configuration, kwargs.get("session")) as session:
+            storage_dir = session.hypervisor(storage=True).get_storage_dir()
+    else:
+        storage_dir = hv.get_storage_dir()
 
     distro = kwargs.get("distro")
     custom_url = kwargs.get("url")
@@ -589,7 +1105,7 @@ def fetch(configuration=None, progress_callback=None, hv=None, **kwargs):
     fetch_distro(
         configuration=configuration,
         progress_callback=progress_callback,
-        storage_dir=hv.get_storage_dir(),
+        storage_dir=storage_dir,
         custom_url=custom_url,
         **kwargs,
     )
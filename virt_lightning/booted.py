@@ -0,0 +1,337 @@
+import hashlib
+import json
+import logging
+import pathlib
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET  # noqa: N817
+
+import libvirt
+
+import virt_lightning.virt_lightning as vl
+from virt_lightning.symbols import get_symbols
+from virt_lightning.util import builder_host
+
+logger = logging.getLogger("virt_lightning")
+symbols = get_symbols()
+
+# The context of the VMs booted to build a template
+TEMPLATE_CONTEXT = "vl-template"
+TEMPLATE_PREFIX = "vl-template-"
+# The header of a libvirt save image: magic, version, length of the XML
+# and of the cookie, was_running, compressed, offset of the cookie, unused
+SAVE_HEADER = struct.Struct("=16s5I56x")
+SAVE_MAGIC = b"LibvirtQemudSave"
+# Room left in the XML of a save image, for the longer values of a clone
+PADDING_NS = "https://virt-lightning.org/xmlns/padding/1.0"
+PADDING_SIZE = 8192
+# The host keys that change the saved state
+KEY_HOST_KEYS = (
+    "default_bus_type",
+    "default_nic_model",
+    "meta_data_media_type",
+    "metadata_format",
+)
+# Number of restore times kept per template
+HISTORY = 20
+CLOUD_INIT_TIMEOUT = 600
+
+PREPARE_SCRIPT = """
+cloud-init status --wait >/dev/null 2>&1
+sync
+echo 3 > /proc/sys/vm/drop_caches
+"""
+# Run through the guest agent once the clone is restored, the guest still
+# has the MAC, address and hostname of the template.
+IDENTITY_SCRIPT = """
+set -e
+iface=$(ip -o link | awk -F': ' 'tolower($0) ~ /{old_mac}/ {{print $2; exit}}')
+iface=${{iface%%@*}}
+ip link set dev "$iface" address {mac}
+ip -4 addr flush dev "$iface" scope global
+ip -4 addr add {ipv4} dev "$iface"
+ip -4 route replace default via {gateway} dev "$iface"
+hostnamectl set-hostname {name} || hostname {name}
+"""
+IDENTITY_SCRIPT_IPV6 = """
+ip -6 addr flush dev "$iface" scope global
+ip -6 addr add {ipv6} dev "$iface"
+"""
+
+ET.register_namespace("vlpad", PADDING_NS)
+
+
+class TemplateError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
+def template_key(domain, host):
+    """Return the key of the booted template the domain can be restored from."""
+    user_data = {
+        k: v for k, v in domain.user_data.items() if k not in ("fqdn", "name")
+    }
+    profile = {
+        "distro": domain.distro,
+        "memory": domain.memory,
+        "vcpus": domain.vcpus,
+        "user_data": user_data,
+        "golden": domain.get_metadata("golden"),
+        **{k: host.get(k) for k in KEY_HOST_KEYS},
+    }
+    return hashlib.sha256(
+        json.dumps(profile, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def templatable(host, network_name):
+    """A template has a single disk and a single NIC, on the vl network."""
+    networks = host.get("networks", [{}])
+    return (
+        len(host.get("disks", [{}])) == 1
+        and len(networks) == 1
+        and not networks[0].get("bridge")
+        and networks[0].get("network", network_name) == network_name
+    )
+
+
+def read_save_header(data):
+    """Return the room left for the XML in a libvirt save image."""
+    magic, _, data_len, _, _, cookie_offset = SAVE_HEADER.unpack(data)
+    if magic != SAVE_MAGIC:
+        raise ValueError("not a libvirt save image")
+    return cookie_offset or data_len
+
+
+def identity_xml(xml, domain):
+    """Give the XML of a template save image the identity of the domain.
+
+    Only the name, the UUID and the MAC are changed: libvirt refuses a
+    different value in the XML passed to restoreFlags(), so they are
+    rewritten in the save image itself.
+    """
+    root = ET.fromstring(xml)
+    root.find("./name").text = domain.name
+    root.find("./uuid").text = domain.uuid
+    metadata = root.find("./metadata")
+    for elt in metadata.findall(f"{{{PADDING_NS}}}padding"):
+        metadata.remove(elt)
+    interface = root.find("./devices/interface")
+    interface.find("./mac").attrib["address"] = domain.nics[0]["mac"]
+    return ET.tostring(root, encoding="unicode")
+
+
+def clone_xml(xml, domain, paths):
+    """Adapt the XML of a template save image to the domain.
+
+    The devices are kept as they are, since they have to match the saved
+    state. paths maps the volumes of the template to those of the domain.
+    """
+    root = ET.fromstring(identity_xml(xml, domain))
+    metadata = root.find("./metadata")
+    for elt in metadata.findall(f"{{{vl.METADATA_NS}}}instance"):
+        metadata.remove(elt)
+    ET.SubElement(metadata, f"{{{vl.METADATA_NS}}}instance", domain.metadata)
+    for source in root.findall("./devices/disk/source[@file]"):
+        source.attrib["file"] = paths.get(source.attrib["file"], source.attrib["file"])
+    interface = root.find("./devices/interface")
+    # The name of the tap device is chosen by libvirt
+    for target in interface.findall("./target"):
+        interface.remove(target)
+    return ET.tostring(root, encoding="unicode")
+
+
+class BootedTemplates:
+    """Domains booted once and saved with their memory, per profile.
+
+    A domain of the same profile is restored from the save image, on top
+    of a new overlay of the template disk, so the guest doesn't boot
+    again. The rest of the XML is passed to restoreFlags() and checked by
+    libvirt, but libvirt only restores a save image with the name, the
+    UUID and the MACs it was saved with. These are rewritten in a copy of
+    the image, in the room left by a padding element. The identity of the
+    guest is then fixed through the guest agent.
+    """
+
+    def __init__(self, hv):
+        self.hv = hv
+        self._lock = threading.Lock()
+
+    @property
+    def index_file(self):
+        return self.hv.get_storage_dir() / "upstream" / ".templates.json"
+
+    def _load(self):
+        try:
+            return json.loads(self.index_file.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _dump(self, index):
+        tmp = self.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(index, indent=2))
+        tmp.replace(self.index_file)
+
+    def entries(self):
+        return self._load()
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry and all(
+            pathlib.Path(entry[k]).exists() for k in ("save", "disk", "seed")
+        ):
+            return entry
+        return None
+
+    def builder(self, host, key):
+        """Return the host booted to build the template of key."""
+        return builder_host(
+            host, f"{TEMPLATE_PREFIX}{key[:12]}", excluded=("template",)
+        )
+
+    def prepare(self, domain):
+        """Make room in the XML the domain is saved with."""
+        metadata = domain._config_root().find("./metadata")
+        ET.SubElement(
+            metadata, f"{{{PADDING_NS}}}padding", {"value": "x" * PADDING_SIZE}
+        )
+
+    def save(self, domain, key, cold_boot):
+        """Save the booted domain as the template of key."""
+        code = domain.agent_run(
+            "/bin/sh", ["-c", PREPARE_SCRIPT], timeout=CLOUD_INIT_TIMEOUT
+        )
+        if code is None:
+            raise TemplateError(domain.name)
+        root = ET.fromstring(domain.dom.XMLDesc(0))
+        # The root disk is attached first and the seed last
+        sources = [s.attrib["file"] for s in root.findall("./devices/disk/source")]
+        path = self.hv.get_storage_dir() / f"{domain.name}.save"
+        entry = {
+            "distro": domain.distro,
+            "save": str(path),
+            "disk": sources[0],
+            "seed": sources[-1],
+            "mac": domain.nics[0]["mac"],
+            "cold_boot": cold_boot,
+            "restores": [],
+        }
+        domain.dom.saveFlags(str(path), None, libvirt.VIR_DOMAIN_SAVE_RUNNING)
+        domain.dom.undefine()
+        self.hv.remove_domain_from_network(domain)
+        self.hv.get_ipam().release(domain.ipv4)
+        if domain.ipv6:
+            self.hv.get_ipam(version=6).release(domain.ipv6)
+        self.hv.storage_pool_obj.refresh()
+        with self._lock:
+            index = self._load()
+            index[key] = entry
+            self._dump(index)
+        logger.info(
+            "%s %s saved as a template (%.1fs)",
+            symbols.CUSTOMS.value,
+            domain.distro,
+            cold_boot,
+        )
+        return entry
+
+    def _download(self, volume, offset, length):
+        stream = self.hv.conn.newStream(0)
+        volume.download(stream, offset, length, 0)
+        data = b""
+        while len(data) < length:
+            chunk = stream.recv(length - len(data))
+            if not chunk:
+                break
+            data += chunk
+        stream.finish()
+        return data
+
+    def _upload(self, volume, offset, data):
+        stream = self.hv.conn.newStream(0)
+        volume.upload(stream, offset, len(data), 0)
+        stream.send(data)
+        stream.finish()
+
+    def _copy_image(self, entry, name):
+        pool = self.hv.storage_pool_obj
+        template = pool.storageVolLookupByName(pathlib.Path(entry["save"]).name)
+        root = ET.fromstring("<volume><target><format type='raw'/></target></volume>")
+        ET.SubElement(root, "name").text = name
+        ET.SubElement(root, "capacity").text = str(template.info()[1])
+        xml = ET.tostring(root).decode()
+        try:
+            # A reflink when the file system supports it
+            return pool.createXMLFrom(
+                xml, template, libvirt.VIR_STORAGE_VOL_CREATE_REFLINK
+            )
+        except libvirt.libvirtError:
+            return pool.createXMLFrom(xml, template, 0)
+
+    def restore(self, entry, domain, seed):
+        """Restore the template as the domain, the guest keeps running."""
+        disk = self.hv.create_disk(f"{domain.name}-0", backing_file=entry["disk"])
+        try:
+            saved = self.hv.conn.saveImageGetXMLDesc(entry["save"], 0)
+            xml = clone_xml(
+                saved, domain, {entry["disk"]: disk.path(), entry["seed"]: seed.path()}
+            )
+            image = self._copy_image(entry, f"{domain.name}.save")
+            try:
+                room = read_save_header(self._download(image, 0, SAVE_HEADER.size))
+                data = identity_xml(saved, domain).encode() + b"\0"
+                if len(data) > room:
+                    raise TemplateError(domain.name)
+                self._upload(image, SAVE_HEADER.size, data.ljust(room, b"\0"))
+                # libvirt checks the ABI stability of xml against the image
+                self.hv.conn.restoreFlags(
+                    image.path(), xml, libvirt.VIR_DOMAIN_SAVE_RUNNING
+                )
+            finally:
+                image.delete()
+        except Exception:
+            disk.delete()
+            raise
+        # Restored as a transient domain
+        dom = self.hv.conn.lookupByName(domain.name)
+        domain.dom = self.hv.conn.defineXML(
+            dom.XMLDesc(libvirt.VIR_DOMAIN_XML_MIGRATABLE)
+        )
+        domain._xml = None
+
+    def fix_identity(self, entry, domain):
+        """Give the restored guest the MAC, the addresses and the name of the domain."""
+        script = IDENTITY_SCRIPT.format(
+            old_mac=entry["mac"].lower(),
+            mac=domain.nics[0]["mac"],
+            ipv4=domain.ipv4,
+            gateway=self.hv.gateway.ip,
+            name=domain.name,
+        )
+        if domain.ipv6:
+            script += IDENTITY_SCRIPT_IPV6.format(ipv6=domain.ipv6)
+        # The agent may take a moment to answer after the restore
+        deadline = time.monotonic() + vl.AGENT_TIMEOUT
+        while True:
+            try:
+                domain.dom.setTime(flags=libvirt.VIR_DOMAIN_TIME_SYNC)
+                code = domain.agent_run("/bin/sh", ["-c", script])
+                break
+            except libvirt.libvirtError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        if code != 0:
+            raise TemplateError(domain.name)
+        self.hv.add_domain_to_network(domain)
+
+    def record(self, key, seconds):
+        with self._lock:
+            index = self._load()
+            if key not in index:
+                return
+            restores = index[key]["restores"]
+            restores.append(seconds)
+            del restores[:-HISTORY]
+            self._dump(index)
@@ -0,0 +1,180 @@
+import importlib
+import json
+import logging
+import os
+import pathlib
+import socket
+import stat
+
+logger = logging.getLogger("virt_lightning")
+
+# The api functions served by `vl daemon`, they only read its indexes
+METHODS = (
+    "ansible_inventory",
+    "images",
+    "list_domains",
+    "ssh_config",
+    "status",
+    "storage_dir",
+)
+# The settings of the client that the daemon uses to answer its requests
+SETTINGS = ("ssh_key_file",)
+TIMEOUT = 5
+
+
+def socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = f"/tmp/virt-lightning-{os.getuid()}"  # noqa: S108
+    return pathlib.Path(runtime_dir) / "virt-lightning.sock"
+
+
+class DaemonError(Exception):
+    pass
+
+
+class InsecureSocketDirectoryError(Exception):
+    def __init__(self, path):
+        self.path = path
+
+
+def check_socket_directory(path):
+    """Refuse a directory that another user may own or write to.
+
+    The directory of the /tmp fallback may have been created by someone else.
+    """
+    st = os.lstat(path)
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.getuid()
+        or stat.S_IMODE(st.st_mode) != 0o700
+    ):
+        raise InsecureSocketDirectoryError(path)
+
+
+class RemoteDomain:
+    """The fields of a DomainRecord sent by the daemon."""
+
+    __slots__ = ("context", "distro", "ipv4", "name", "username")
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.get(k))
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def exec_ssh(self):
+        os.execlp(
+            "ssh",
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            f"{self.username}@{self.ipv4}",
+        )
+
+
+class DaemonClient:
+    """The read-only api functions, answered by `vl daemon`.
+
+    The requests and the responses are JSON documents, one per line. A call
+    falls back to virt_lightning.api if the daemon cannot answer, libvirt
+    is only imported then.
+    """
+
+    def __init__(self, configuration, path=None, timeout=TIMEOUT):
+        self.configuration = configuration
+        self.path = path or socket_path()
+        self.timeout = timeout
+
+    def call(self, method, **params):
+        request = {
+            "method": method,
+            "params": params,
+            "libvirt_uri": self.configuration.libvirt_uri,
+            "storage_pool": self.configuration.storage_pool,
+            "settings": self._settings(),
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(str(self.path))
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as fd:
+                line = fd.readline()
+        if not line:
+            raise DaemonError("connection closed by the daemon")
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response["result"]
+
+    def _settings(self):
+        settings = {}
+        for k in SETTINGS:
+            # e.g: the pathlib.Path of the default SSH key
+            value = getattr(self.configuration, k)
+            settings[k] = value if value is None else str(value)
+        return settings
+
+    def _fallback(self, method, **kwargs):
+        api = importlib.import_module("virt_lightning.api")
+        return getattr(api, method)(self.configuration, **kwargs)
+
+    def _call(self, method, **kwargs):
+        params = {k: kwargs[k] for k in ("context", "name") if k in kwargs}
+        try:
+            return self.call(method, **params)
+        except (OSError, ValueError, DaemonError) as e:
+            logger.debug("vl daemon failed to answer %s: %s", method, e)
+        return self._fallback(method, **kwargs)
+
+    def ansible_inventory(self, configuration, **kwargs):
+        return self._call("ansible_inventory", **kwargs)
+
+    def ssh_config(self, configuration, **kwargs):
+        return self._call("ssh_config", **kwargs)
+
+    def status(self, configuration, **kwargs):
+        return self._call("status", **kwargs)
+
+    def images(self, configuration, **kwargs):
+        if kwargs.get("details"):
+            # The images are read from the disk, not from libvirt
+            return self._fallback("images", **kwargs)
+        return self._call("images", **kwargs)
+
+    def storage_dir(self, configuration, **kwargs):
+        return self._call("storage_dir", **kwargs)
+
+    def list_domains(self, configuration, **kwargs):
+        try:
+            domains = self.call("list_domains")
+        except (OSError, ValueError, DaemonError) as e:
+            logger.debug("vl daemon failed to answer list_domains: %s", e)
+            return self._fallback("list_domains", **kwargs)
+        return [RemoteDomain(**d) for d in domains]
+
+    def exec_ssh(self, configuration, name=None, **kwargs):
+        for domain in self.list_domains(configuration):
+            if domain.name == name:
+                domain.exec_ssh()
+        # Not in the index, let the api raise VMNotFoundError
+        self._fallback("exec_ssh", name=name, **kwargs)
+
+
+def connect(configuration):
+    """Return a DaemonClient if `vl daemon` is running, or None."""
+    path = socket_path()
+    try:
+        check_socket_directory(path.parent)
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    except InsecureSocketDirectoryError:
+        logger.warning("Ignoring vl daemon, %s is not private", path.parent)
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+    return DaemonClient(configuration, path=path)
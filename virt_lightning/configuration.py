@@ -15,10 +15,18 @@ DEFAULT_CONFIGURATION = {
         "storage_pool": "virt-lightning",
         "network_name": "virt-lightning",
         "network_cidr": "192.168.123.0/24",
+        "network_ipv6_cidr": "",
         "network_auto_clean_up": True,
         "ssh_key_file": "",
+        "ssh_timeout": 600,
         "private_hub": "",
         "custom_image_list": "",
+        "rpc_workers": "",
+        "cpu_workers": "",
+        "io_workers": "",
+        "warm_pool": "",
+        "golden_image_cache_size": 0,
+        "download_segments": 4,
     }
 }
 
@@ -36,6 +44,10 @@ class AbstractConfiguration(metaclass=ABCMeta):
     def network_cidr(self):
         pass
 
+    @abstractproperty
+    def network_ipv6_cidr(self):
+        pass
+
     @abstractproperty
     def network_auto_clean_up(self):
         pass
@@ -48,6 +60,10 @@ class AbstractConfiguration(metaclass=ABCMeta):
     def ssh_key_file(self):
         pass
 
+    @abstractproperty
+    def ssh_timeout(self):
+        pass
+
     @abstractproperty
     def storage_pool(self):
         pass
@@ -56,6 +72,30 @@ class AbstractConfiguration(metaclass=ABCMeta):
     def custom_image_list(self):
         pass
 
+    @abstractproperty
+    def rpc_workers(self):
+        pass
+
+    @abstractproperty
+    def cpu_workers(self):
+        pass
+
+    @abstractproperty
+    def io_workers(self):
+        pass
+
+    @abstractproperty
+    def warm_pool(self):
+        pass
+
+    @abstractproperty
+    def golden_image_cache_size(self):
+        pass
+
+    @abstractproperty
+    def download_segments(self):
+        pass
+
     def __repr__(self):
         return (
             f"Configuration(libvirt_uri={self.libvirt_uri}, username={self.username})"
@@ -64,6 +104,7 @@ class AbstractConfiguration(metaclass=ABCMeta):
 
 class Configuration(AbstractConfiguration):
     def __init__(self):
+        self.config_file = None
         self.data = configparser.ConfigParser()
         self.data["main"] = DEFAULT_CONFIGURATION["main"]
         if DEFAULT_CONFIGFILE.expanduser().exists():
@@ -72,6 +113,10 @@ class Configuration(AbstractConfiguration):
     def __get(self, key):
         return self.data.get("main", key)
 
+    def __get_int(self, key):
+        value = self.__get(key)
+        return int(value) if value else None
+
     @property
     def libvirt_uri(self):
         return self.__get("libvirt_uri")
@@ -84,6 +129,10 @@ class Configuration(AbstractConfiguration):
     def network_cidr(self):
         return self.__get("network_cidr")
 
+    @property
+    def network_ipv6_cidr(self):
+        return self.__get("network_ipv6_cidr")
+
     @property
     def network_auto_clean_up(self):
         return self.__get("network_auto_clean_up")
@@ -102,6 +151,10 @@ class Configuration(AbstractConfiguration):
 
         return found
 
+    @property
+    def ssh_timeout(self):
+        return self.__get_int("ssh_timeout")
+
     @property
     def storage_pool(self):
         return self.__get("storage_pool")
@@ -114,5 +167,38 @@ class Configuration(AbstractConfiguration):
     def custom_image_list(self):
         return self.__get("custom_image_list")
 
+    @property
+    def rpc_workers(self):
+        return self.__get_int("rpc_workers")
+
+    @property
+    def cpu_workers(self):
+        return self.__get_int("cpu_workers")
+
+    @property
+    def io_workers(self):
+        return self.__get_int("io_workers")
+
+    @property
+    def warm_pool(self):
+        # e.g: debian-12:2:1024,fedora-41:1:2048
+        pools = {}
+        for entry in self.__get("warm_pool").split(","):
+            if not entry.strip():
+                continue
+            distro, count, memory = entry.strip().split(":")
+            pools[distro] = {"count": int(count), "memory": int(memory)}
+        return pools
+
+    @property
+    def golden_image_cache_size(self):
+        # An empty value disables the cache, like the default
+        return self.__get_int("golden_image_cache_size") or 0
+
+    @property
+    def download_segments(self):
+        return self.__get_int("download_segments")
+
     def load_file(self, config_file):
         self.data.read_string(config_file.read_text())
+        self.config_file = config_file
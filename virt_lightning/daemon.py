@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+
+import libvirt
+
+import virt_lightning.api as api
+import virt_lightning.virt_lightning as vl
+from virt_lightning.client import (
+    METHODS,
+    SETTINGS,
+    check_socket_directory,
+    socket_path,
+)
+
+logger = logging.getLogger("virt_lightning")
+
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+
+
+class DaemonAlreadyRunningError(Exception):
+    def __init__(self, path):
+        self.path = path
+
+
+class DomainIndex:
+    """The DomainRecord of every domain, kept current by the libvirt events."""
+
+    def __init__(self):
+        self._records = {}
+
+    def load(self, conn):
+        self._records = {}
+        for dom in conn.listAllDomains(0):
+            self.update(dom)
+
+    def update(self, dom):
+        try:
+            self._records[dom.name()] = vl.DomainRecord.from_xml(dom.XMLDesc(0))
+        except libvirt.libvirtError as e:
+            # Already undefined, the next event removes it
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+
+    def remove(self, name):
+        self._records.pop(name, None)
+
+    def records(self, context=None):
+        return [
+            record
+            for record in self._records.values()
+            if context is None or record.context == context
+        ]
+
+
+class IndexedHypervisor(vl.LibvirtHypervisor):
+    """A hypervisor reading the domains and the images from the indexes."""
+
+    def __init__(self, conn, domains):
+        super().__init__(conn)
+        self.domains = domains
+        self._storage_dir = None
+        self._images = []
+        self._images_mtime = None
+
+    def list_domain_records(self, context=None, flags=0):
+        return iter(self.domains.records(context))
+
+    def get_storage_dir(self):
+        if not self._storage_dir:
+            self._storage_dir = super().get_storage_dir()
+        return self._storage_dir
+
+    def distro_available(self):
+        # The images are only listed again once a file is added or removed
+        mtime = (self.get_storage_dir() / "upstream").stat().st_mtime_ns
+        if mtime != self._images_mtime:
+            self._images = super().distro_available()
+            self._images_mtime = mtime
+        return self._images
+
+
+class DaemonSession(api.Session):
+    def __init__(self, configuration, domains):
+        super().__init__(configuration)
+        self.domains = domains
+
+    def create_hypervisor(self, conn):
+        return IndexedHypervisor(conn, self.domains)
+
+
+class RequestConfiguration:
+    """The configuration of the daemon, with the settings of a client."""
+
+    def __init__(self, configuration, settings):
+        self._configuration = configuration
+        self._settings = {k: v for k, v in settings.items() if k in SETTINGS}
+
+    def __getattr__(self, k):
+        if k in self._settings:
+            return self._settings[k]
+        return getattr(self._configuration, k)
+
+
+def _serialize(method, result):
+    if method == "list_domains":
+        return [
+            {
+                "name": record.name,
+                "username": record.username,
+                "ipv4": record.ipv4 and str(record.ipv4.ip),
+                "distro": record.distro,
+                "context": record.context,
+            }
+            for record in result
+        ]
+    if method == "status":
+        return list(result)
+    if method == "storage_dir":
+        return str(result)
+    return result
+
+
+class Daemon:
+    """Serve the read-only api functions on a Unix socket.
+
+    The daemon keeps a libvirt connection open, with keepalive, and opens a
+    new one when it's lost. The domains are indexed once and kept current
+    by the lifecycle and metadata events, so a request doesn't do any
+    libvirt call.
+    """
+
+    def __init__(self, configuration, path=None):
+        self.configuration = configuration
+        self.path = path or socket_path()
+        self.domains = DomainIndex()
+        self.session = None
+        self._reconnecting = None
+
+    def connect(self):
+        session = DaemonSession(self.configuration, self.domains)
+        try:
+            session.hypervisor(storage=True)
+            conn = session.conn
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            conn.registerCloseCallback(self._closed, None)
+            # Registered before the domains are loaded, so no change is missed
+            conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle, None
+            )
+            conn.domainEventRegisterAny(
+                None,
+                libvirt.VIR_DOMAIN_EVENT_ID_METADATA_CHANGE,
+                self._metadata_changed,
+                None,
+            )
+            self.domains.load(conn)
+        except libvirt.libvirtError:
+            session.close()
+            raise
+        self.session = session
+
+    def _lifecycle(self, conn, dom, event, detail, opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.domains.remove(dom.name())
+        else:
+            self.domains.update(dom)
+
+    def _metadata_changed(self, conn, dom, mtype, nsuri, opaque):
+        self.domains.update(dom)
+
+    def _closed(self, conn, reason, opaque):
+        logger.warning("The libvirt connection is closed (reason: %s)", reason)
+        self.session = None
+        if not self._reconnecting or self._reconnecting.done():
+            self._reconnecting = asyncio.ensure_future(self._reconnect(conn))
+
+    async def _reconnect(self, conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                self.connect()
+            except libvirt.libvirtError as e:
+                logger.warning("Cannot reconnect to libvirt: %s", e)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            else:
+                logger.info("Reconnected to %s", self.configuration.libvirt_uri)
+                return
+
+    def answer(self, request):
+        method = request.get("method")
+        if method not in METHODS:
+            return {"error": f"unknown method: {method}"}
+        if request.get("libvirt_uri") != self.configuration.libvirt_uri or (
+            request.get("storage_pool") != self.configuration.storage_pool
+        ):
+            return {"error": "the daemon runs with another configuration"}
+        if not self.session:
+            return {"error": "not connected to libvirt"}
+        params = request.get("params") or {}
+        configuration = RequestConfiguration(
+            self.configuration, request.get("settings") or {}
+        )
+        try:
+            result = getattr(api, method)(
+                configuration, session=self.session, **params
+            )
+            return {"result": _serialize(method, result)}
+        except Exception as e:
+            logger.debug("%s failed: %s", method, e)
+            return {"error": str(e)}
+
+    async def _handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = self.answer(json.loads(line))
+                except ValueError:
+                    response = {"error": "invalid request"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _remove_stale_socket(self):
+        if not self.path.is_socket():
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(self.path))
+            except OSError:
+                self.path.unlink()
+            else:
+                raise DaemonAlreadyRunningError(self.path)
+
+    def run(self, loop=None):
+        loop = api._register_aio_virt_impl(loop)
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        check_socket_directory(self.path.parent)
+        self._remove_stale_socket()
+        self.connect()
+        server = loop.run_until_complete(
+            asyncio.start_unix_server(self._handle, path=str(self.path))
+        )
+        os.chmod(self.path, 0o600)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, loop.stop)
+        logger.info("Listening on %s", self.path)
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.path.unlink(missing_ok=True)
+            if self.session:
+                self.session.close()
@@ -0,0 +1,460 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import urllib.request
+
+from virt_lightning import xz
+
+logger = logging.getLogger("virt_lightning")
+
+CHUNK_SIZE = 1024 * 1024
+# A smaller file is downloaded in a single stream
+MIN_SEGMENT_SIZE = 16 * CHUNK_SIZE
+# The progress of a download is saved every CHECKPOINT_SIZE bytes
+CHECKPOINT_SIZE = 64 * CHUNK_SIZE
+# The lines of a SHA256SUMS file, "<digest>  <name>" or "SHA256 (<name>) = <digest>"
+CHECKSUM_LINE = re.compile(r"^([0-9a-fA-F]{64})(?:\s+\*?(.+))?$")
+CHECKSUM_BSD_LINE = re.compile(r"^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$")
+# The number of chunks a stage of the pipeline runs ahead of the next one
+PREFETCH_SIZE = 8
+# The memory used by the blocks decoded at once, the blocks of a file made
+# of larger blocks are decoded one after the other
+DECODE_MEMORY = 1024 * CHUNK_SIZE
+_END = object()
+# The granularity of the holes of the images, a qcow2 cluster by default
+SPARSE_BLOCK_SIZE = 64 * 1024
+_ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+
+class RangeNotSupportedError(Exception):
+    def __init__(self, url):
+        self.url = url
+
+
+class IncompleteDownloadError(Exception):
+    def __init__(self, url):
+        self.url = url
+
+
+class ChecksumError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
+class Digests:
+    """The SHA-256 of a download, as it's downloaded and once decompressed."""
+
+    def __init__(self, compressed=False):
+        self.downloaded = hashlib.sha256()
+        self.decompressed = hashlib.sha256() if compressed else self.downloaded
+
+    def matches(self, expected):
+        """Return None if the downloaded data is unknown and may match."""
+        digests = [self.downloaded, self.decompressed]
+        if expected.lower() in (d.hexdigest() for d in digests if d):
+            return True
+        if self.downloaded is None:
+            return None
+        return False
+
+
+def read_chunks(r, digest=None):
+    while chunk := r.read(CHUNK_SIZE):
+        if digest:
+            digest.update(chunk)
+        yield chunk
+
+
+def parse_checksums(text, name):
+    """Return the SHA-256 of name in a SHA256SUMS file, or None."""
+    for line in text.splitlines():
+        line = line.strip()
+        if match := CHECKSUM_LINE.match(line):
+            digest, entry = match.groups()
+        elif match := CHECKSUM_BSD_LINE.match(line):
+            entry, digest = match.groups()
+        else:
+            continue
+        # A file with a single digest doesn't always name the file
+        if entry is None or entry.rsplit("/", 1)[-1] == name:
+            return digest.lower()
+    return None
+
+
+def accepts_ranges(response):
+    return response.headers.get("Accept-Ranges", "").lower() == "bytes" and int(
+        response.headers.get("Content-Length") or 0
+    )
+
+
+def validator(response):
+    """Return what identifies the version of the file, or None."""
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    # A weak ETag doesn't guarantee the same bytes
+    if etag and not etag.startswith("W/"):
+        return {"etag": etag}
+    if last_modified:
+        return {"last_modified": last_modified}
+    return None
+
+
+def split(length, segments):
+    """Return the (first, last) byte of each segment."""
+    segments = max(1, min(segments, length // MIN_SEGMENT_SIZE))
+    size = -(-length // segments)
+    return [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+
+
+class SparseWriter:
+    """Write data to a file, leaving holes for the blocks of zeros.
+
+    The zero blocks are seeked past instead of written, so the file is
+    sparse but has the same content. It must not have data there already.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.offset = 0
+
+    def pwrite(self, data, offset):
+        view = memoryview(data)
+        # The start of the current run of non-zero blocks
+        start = None
+        for pos in range(0, len(view), SPARSE_BLOCK_SIZE):
+            # Comparing bytes is a memcmp, unlike a memoryview
+            block = bytes(view[pos : pos + SPARSE_BLOCK_SIZE])
+            if block == _ZERO_BLOCK[: len(block)]:
+                if start is not None:
+                    os.pwrite(self.fd, view[start:pos], offset + start)
+                    start = None
+            elif start is None:
+                start = pos
+        if start is not None:
+            os.pwrite(self.fd, view[start:], offset + start)
+
+    def write(self, data):
+        self.pwrite(data, self.offset)
+        self.offset += len(data)
+
+    def truncate(self):
+        """Set the size of the file, it may end with a hole."""
+        os.ftruncate(self.fd, self.offset)
+
+
+def disk_usage(path):
+    """Return the size of a file and the size allocated on the disk."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_blocks * 512
+
+
+def prefetch(iterable, size=PREFETCH_SIZE):
+    """Iterate over iterable in a thread, at most size items ahead.
+
+    Each stage of a pipeline, e.g. the network, the decompression and the
+    disk, then runs in its own thread, connected by a bounded queue.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stop.is_set():
+                    return
+            items.put((_END, None))
+        except Exception as e:
+            items.put((None, e))
+        finally:
+            # e.g: the thread of another prefetch
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock the thread if the queue is full
+        while thread.is_alive():
+            with contextlib.suppress(queue.Empty):
+                items.get(timeout=0.1)
+
+
+def _hash_range(digest, fd, start, end):
+    while start < end:
+        data = os.pread(fd, min(CHUNK_SIZE, end - start), start)
+        if not data:
+            break
+        digest.update(data)
+        start += len(data)
+
+
+def _read_range(url, first, last):
+    request = urllib.request.Request(url, headers={"Range": f"bytes={first}-{last}"})
+    r = urllib.request.urlopen(request)
+    if r.status != 206:
+        r.close()
+        raise RangeNotSupportedError(url)
+    return r
+
+
+class ResumeState:
+    """The sidecar file of a partial download, <temp file>.json.
+
+    It records the URL, the validator and the length of the file, with the
+    progress saved once the data is on disk. A download only resumes from
+    it if the file on the server is still the same.
+    """
+
+    def __init__(self, temp_file, url, validator, length):
+        self.temp_file = temp_file
+        self.path = temp_file.with_name(temp_file.name + ".json")
+        self.identity = {"url": url, "validator": validator, "length": length}
+
+    def load(self):
+        """Return the saved progress, or None if the download starts again."""
+        if not self.identity["validator"] or not self.temp_file.exists():
+            return None
+        try:
+            state = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return None
+        if state.get("identity") != self.identity:
+            logger.info("The image has changed on the server, download it again")
+            return None
+        return state.get("progress")
+
+    def save(self, fd, progress):
+        if not self.identity["validator"]:
+            return
+        # The progress never refers to data that's not on the disk yet
+        os.fdatasync(fd)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"identity": self.identity, "progress": progress}))
+        tmp.replace(self.path)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+class SegmentedDownload:
+    """Download a file as several byte ranges, each one in its own thread.
+
+    Each segment is written at its offset of the preallocated file with
+    pwrite, so the segments don't need to be merged. An interrupted
+    download resumes from the progress saved in the ResumeState.
+
+    The SHA-256 follows the contiguous data from the start of the file: the
+    chunks of the first segment are hashed as they arrive, those of the
+    next segments are read back from the page cache once they are reached.
+    """
+
+    def __init__(self, url, length, segments, progress_callback=None, state=None):
+        self.url = url
+        self.length = length
+        self.segments = split(length, segments)
+        self.progress_callback = progress_callback
+        self.state = state
+        self.done = [0] * len(self.segments)
+        self.digests = Digests()
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._hashed = 0
+
+    def _hash(self, fd, offset=None, chunk=b""):
+        digest = self.digests.downloaded
+        if offset == self._hashed:
+            digest.update(chunk)
+            self._hashed += len(chunk)
+        for (first, _), done in zip(self.segments, self.done):
+            if first <= self._hashed < first + done:
+                _hash_range(digest, fd, self._hashed, first + done)
+                self._hashed = first + done
+
+    def _progress(self, fd, index, offset, chunk):
+        size = len(chunk)
+        with self._lock:
+            self.done[index] += size
+            self._hash(fd, offset, chunk)
+            self._unsaved += size
+            if self.state and self._unsaved >= CHECKPOINT_SIZE:
+                self.state.save(fd, {"segments": self.segments, "done": self.done})
+                self._unsaved = 0
+            if self.progress_callback:
+                self.progress_callback(sum(self.done), self.length)
+
+    def _fetch(self, fd, index):
+        first, last = self.segments[index]
+        offset = first + self.done[index]
+        if offset > last:
+            return
+        writer = SparseWriter(fd)
+        with _read_range(self.url, offset, last) as r:
+            while chunk := r.read(CHUNK_SIZE):
+                writer.pwrite(chunk, offset)
+                self._progress(fd, index, offset, chunk)
+                offset += len(chunk)
+        if offset != last + 1:
+            raise IncompleteDownloadError(self.url)
+
+    def _resume(self):
+        progress = self.state and self.state.load()
+        segments = [list(segment) for segment in self.segments]
+        if not progress or progress.get("segments") != segments:
+            return False
+        self.done = progress["done"]
+        logger.info("Resume the download at %d%%", sum(self.done) * 100 / self.length)
+        return True
+
+    def run(self, path):
+        logger.debug("Downloading %s in %d segments", self.url, len(self.segments))
+        # The file is read back to compute its digest
+        if self._resume():
+            fd = os.open(path, os.O_RDWR)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        # A sparse file, the zeros of the image are not written
+        os.ftruncate(fd, self.length)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(len(self.segments)) as pool:
+                futures = [
+                    pool.submit(self._fetch, fd, index)
+                    for index in range(len(self.segments))
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            # e.g: the segments that were already complete before a resume
+            self._hash(fd)
+        finally:
+            if self.state:
+                with self._lock:
+                    self.state.save(fd, {"segments": self.segments, "done": self.done})
+            os.close(fd)
+
+
+class XzDownload:
+    """Download and decompress a .xz file, one block after the other.
+
+    The index at the end of the file gives the offsets of the blocks, so an
+    interrupted download resumes from the last block on the disk. A file
+    compressed in a single block starts again from the beginning.
+
+    The network, the decompression and the disk are the stages of a
+    pipeline. The blocks of a multi-block file are decoded in parallel by a
+    thread pool, lzma releases the GIL, and written in order.
+    """
+
+    def __init__(self, url, length, progress_callback=None, state=None):
+        self.url = url
+        self.length = length
+        self.progress_callback = progress_callback
+        self.state = state
+        self.digests = Digests(compressed=True)
+        # The header, the index and the footer of the stream, by offset
+        self._parts = {}
+
+    def _read(self, offset, size):
+        with _read_range(self.url, offset, offset + size - 1) as r:
+            self._parts[offset] = r.read()
+            return self._parts[offset]
+
+    def _chunks(self, r, size):
+        while size:
+            chunk = r.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise IncompleteDownloadError(self.url)
+            size -= len(chunk)
+            if self.digests.downloaded:
+                self.digests.downloaded.update(chunk)
+            yield chunk
+
+    def _decode(self, r, blocks, check):
+        """Yield the uncompressed data of the blocks, then None once decoded."""
+        for block in blocks:
+            decoder = xz.BlockDecoder(block, check)
+            chunks = prefetch(self._chunks(r, block.size))
+            yield from prefetch(decoder.decode(chunks))
+            yield None
+
+    def _decode_parallel(self, r, blocks, check, workers):
+        def read_blocks(pool):
+            for block in blocks:
+                data = b"".join(self._chunks(r, block.size))
+                decoder = xz.BlockDecoder(block, check)
+                yield pool.submit(decoder.decode_bytes, data)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            # The reader is at most a few blocks ahead of the decoders
+            for future in prefetch(read_blocks(pool), workers):
+                yield future.result()
+                yield None
+
+    def _workers(self, blocks):
+        largest = max(block.uncompressed_size for block in blocks)
+        workers = min(os.cpu_count() or 1, len(blocks), DECODE_MEMORY // (largest or 1))
+        return max(workers, 1)
+
+    def run(self, path):
+        index = xz.read_index(self._read, self.length)
+        total = index.uncompressed_size
+        progress = self.state and self.state.load()
+        start = progress.get("blocks", 0) if progress else 0
+        blocks = index.blocks[start:]
+        if start:
+            fd = os.open(path, os.O_RDWR)
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.digests.downloaded.update(self._parts[0])
+        # The zero blocks are holes of the file
+        os.ftruncate(fd, total)
+        if start:
+            logger.info("Resume the download at block %d/%d", start, len(index.blocks))
+            # The compressed blocks before the resume are not on the disk
+            self.digests.downloaded = None
+            end = blocks[0].uncompressed_offset if blocks else total
+            _hash_range(self.digests.decompressed, fd, 0, end)
+        try:
+            if not blocks:
+                return
+            writer = SparseWriter(fd)
+            workers = self._workers(blocks)
+            logger.debug("Decoding %d xz blocks in %d threads", len(blocks), workers)
+            with _read_range(self.url, blocks[0].offset, index.index_offset - 1) as r:
+                if workers > 1:
+                    decoded = self._decode_parallel(r, blocks, index.check, workers)
+                else:
+                    decoded = self._decode(r, blocks, index.check)
+                offset = blocks[0].uncompressed_offset
+                for data in decoded:
+                    if data is None:
+                        start += 1
+                        if self.state:
+                            self.state.save(fd, {"blocks": start})
+                        continue
+                    writer.pwrite(data, offset)
+                    self.digests.decompressed.update(data)
+                    offset += len(data)
+                    if self.progress_callback:
+                        self.progress_callback(offset, total)
+            if self.digests.downloaded:
+                self.digests.downloaded.update(self._parts[index.index_offset])
+                self.digests.downloaded.update(
+                    self._parts[self.length - xz.FOOTER_SIZE]
+                )
+        finally:
+            os.close(fd)
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import xml.etree.ElementTree as ET  # noqa: N817
+
+import libvirt
+
+from virt_lightning.download import SparseWriter
+from virt_lightning.symbols import get_symbols
+from virt_lightning.util import builder_host
+
+logger = logging.getLogger("virt_lightning")
+symbols = get_symbols()
+
+# The context of the VMs booted to build a golden image
+GOLDEN_CONTEXT = "vl-golden"
+GOLDEN_PREFIX = "vl-golden-"
+# The cloud-init keys that only run once per instance
+PROVISIONING_KEYS = ("packages", "runcmd", "write_files")
+CLOUD_INIT_TIMEOUT = 1800
+SHUTDOWN_TIMEOUT = 120
+GB = 1024**3
+
+# The next boot is a new instance for cloud-init
+CLEAN_SCRIPT = """
+cloud-init status --wait >/dev/null 2>&1
+cloud-init clean --logs --machine-id || cloud-init clean --logs
+sync
+"""
+
+
+class GoldenImageError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
+def provisioning_hash(domain, distro_image):
+    """Return the hash of the provisioning steps of the domain, or None."""
+    steps = {k: domain.user_data.get(k) for k in PROVISIONING_KEYS}
+    if not any(steps.values()):
+        return None
+    stat = distro_image.stat()
+    # A new image of the distro is another base
+    steps["distro"] = [domain.distro, stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(
+        json.dumps(steps, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class GoldenImages:
+    """Root disks with the provisioning steps of cloud-init already done.
+
+    A golden image is the root disk of a builder VM, once cloud-init has
+    run and its instance state is cleaned. It backs onto the distro image,
+    and the VMs with the same distro and provisioning back onto it. The
+    least recently used images are removed once the cache is larger than
+    golden_image_cache_size.
+    """
+
+    def __init__(self, hv, configuration):
+        self.hv = hv
+        self.max_size = configuration.golden_image_cache_size * GB
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @property
+    def directory(self):
+        return self.hv.get_storage_dir() / "upstream" / "golden"
+
+    @property
+    def index_file(self):
+        return self.hv.get_storage_dir() / "upstream" / ".golden.json"
+
+    def _load(self):
+        try:
+            return json.loads(self.index_file.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _dump(self, index):
+        tmp = self.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(index, indent=2))
+        tmp.replace(self.index_file)
+
+    def key(self, domain):
+        distro_image = self.hv.get_storage_dir() / "upstream" / f"{domain.distro}.qcow2"
+        return provisioning_hash(domain, distro_image)
+
+    def path(self, key):
+        return self.directory / f"{key[:16]}.qcow2"
+
+    def get(self, key):
+        """Return the golden image of key, or None."""
+        path = self.path(key)
+        if not path.exists():
+            return None
+        with self._lock:
+            index = self._load()
+            if key in index:
+                index[key]["last_used"] = time.time()
+                self._dump(index)
+        return path
+
+    def builder(self, host, key):
+        """Return the host booted to build the golden image of key."""
+        return builder_host(
+            host, f"{GOLDEN_PREFIX}{key[:12]}", excluded=("disks", "template")
+        )
+
+    def use(self, domain, key):
+        """Skip the provisioning steps the golden image already has."""
+        for k in PROVISIONING_KEYS:
+            domain.user_data[k] = []
+        domain.record_metadata("golden", key[:16])
+
+    def save(self, domain, key, duration):
+        """Keep the root disk of the builder domain as the golden image of key."""
+        code = domain.agent_run(
+            "/bin/sh", ["-c", CLEAN_SCRIPT], timeout=CLOUD_INIT_TIMEOUT
+        )
+        if code is None:
+            raise GoldenImageError(domain.name)
+        domain.dom.shutdown()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while domain.dom.state()[0] != libvirt.VIR_DOMAIN_SHUTOFF:
+            if time.monotonic() > deadline:
+                raise GoldenImageError(domain.name)
+            time.sleep(1)
+
+        root = ET.fromstring(domain.dom.XMLDesc(0))
+        source = root.find("./devices/disk[@device='disk']/source").attrib["file"]
+        volume = self.hv.conn.storageVolLookupByPath(source)
+        self.directory.mkdir(exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_suffix(".tmp")
+        # Through libvirt, the volume belongs to the libvirt user
+        stream = self.hv.conn.newStream(0)
+        volume.download(stream, 0, 0, 0)
+        with tmp.open("wb") as fd:
+            # The unused clusters are zeros, they stay holes in the copy
+            writer = SparseWriter(fd.fileno())
+            stream.recvAll(lambda _, data, writer: writer.write(data), writer)
+            writer.truncate()
+        stream.finish()
+        tmp.replace(path)
+        self.hv.clean_up(domain)
+
+        with self._lock:
+            index = self._load()
+            index[key] = {
+                "distro": domain.distro,
+                "path": str(path),
+                "build_time": duration,
+                "last_used": time.time(),
+            }
+            self._dump(index)
+        logger.info(
+            "%s golden image of %s ready (%.1fs)",
+            symbols.CUSTOMS.value,
+            domain.distro,
+            duration,
+        )
+        self.evict(keep=key)
+        return path
+
+    def _backing_files(self):
+        pool = self.hv.storage_pool_obj
+        pool.refresh()
+        paths = set()
+        for volume in pool.listAllVolumes():
+            root = ET.fromstring(volume.XMLDesc(0))
+            paths.update(p.text for p in root.findall("./backingStore/path"))
+        return paths
+
+    def evict(self, keep=None):
+        """Remove the least recently used images over the size limit."""
+        with self._lock:
+            index = self._load()
+            sizes = {}
+            for key, entry in index.items():
+                try:
+                    sizes[key] = self.path(key).stat().st_blocks * 512
+                except FileNotFoundError:
+                    sizes[key] = 0
+            total = sum(sizes.values())
+            if total <= self.max_size:
+                return
+            in_use = self._backing_files()
+            for key in sorted(index, key=lambda k: index[k]["last_used"]):
+                if total <= self.max_size:
+                    break
+                if key == keep or str(self.path(key)) in in_use:
+                    continue
+                logger.debug("Evict the golden image %s", self.path(key))
+                self.path(key).unlink(missing_ok=True)
+                total -= sizes[key]
+                del index[key]
+            self._dump(index)
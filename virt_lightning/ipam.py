@@ -0,0 +1,228 @@
+import contextlib
+import fcntl
+import ipaddress
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("virt_lightning")
+
+# The network address, the gateway and the next few addresses are never
+# given to a VM.
+RESERVED_HOSTS = 5
+# Only the beginning of very large networks (e.g: an IPv6 /64) is used for
+# the allocations.
+MAX_POOL_SIZE = 2**20
+# The releases kept in the state file. A process that missed an older one
+# only keeps the address allocated.
+MAX_RELEASES = 1024
+
+
+class AddressPoolExhaustedError(Exception):
+    def __init__(self, network):
+        self.network = network
+
+
+class IPAllocator:
+    """Thread-safe address allocator for one network.
+
+    The allocation state is a map with one byte per address of the network,
+    the lookup of the next free address is done with bytearray.find() from a
+    hint that points on the lowest address that may be free.
+
+    The state file records the addresses allocated by the vl processes, with
+    the PID of each process (0 for a defined VM), and the last releases,
+    numbered by a serial. It's
+    read and written under a file lock by each change, so two processes never
+    allocate the same address. Only an explicit release frees an address
+    in the map of the other processes.
+    """
+
+    def __init__(self, network, state_file=None):
+        self.network = ipaddress.ip_network(network, strict=False)
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._size = min(self.network.num_addresses, MAX_POOL_SIZE)
+        self._first = min(RESERVED_HOSTS, self._size)
+        self._end = self._size
+        if self.network.version == 4 and self._size == self.network.num_addresses:
+            # the broadcast address
+            self._end = max(self._size - 1, self._first)
+        self._map = bytearray(self._size)
+        # The allocations recorded in the state file, offset -> PID
+        self._owners = {}
+        # The releases recorded in the state file, offset -> serial
+        self._releases = {}
+        self._serial = 0
+        self._reset()
+
+    def _reset(self):
+        self._map[:] = bytes(self._size)
+        self._map[0 : self._first] = b"\x01" * self._first
+        self._map[self._end :] = b"\x01" * (self._size - self._end)
+        self._hint = self._first
+
+    def _offset(self, address):
+        ip = ipaddress.ip_interface(address).ip
+        if ip.version != self.network.version or ip not in self.network:
+            return None
+        offset = int(ip) - int(self.network.network_address)
+        return offset if offset < self._size else None
+
+    def _interface(self, offset):
+        ip = self.network.network_address + offset
+        return ipaddress.ip_interface(f"{ip}/{self.network.prefixlen}")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            if not self.state_file:
+                yield
+                return
+            lock_file = self.state_file.with_suffix(".lock")
+            with lock_file.open("a") as fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    yield
+                    self._save()
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _sync(self):
+        """Merge the allocations and the releases of the other processes."""
+        owners, releases, serial = self._load()
+        for offset, release_serial in releases.items():
+            if release_serial > self._serial and offset not in owners:
+                self._map[offset] = 0
+                self._hint = min(self._hint, offset)
+        for offset in owners:
+            self._map[offset] = 1
+        self._owners = owners
+        self._releases = releases
+        self._serial = serial
+
+    def allocate(self):
+        with self._transaction():
+            offset = self._map.find(0, self._hint)
+            if offset == -1:
+                raise AddressPoolExhaustedError(self.network)
+            self._map[offset] = 1
+            self._owners[offset] = os.getpid()
+            self._releases.pop(offset, None)
+            self._hint = offset + 1
+        return self._interface(offset)
+
+    def reserve(self, address):
+        offset = self._offset(address)
+        if offset is None:
+            return
+        with self._transaction():
+            if self._map[offset]:
+                logger.debug("Address %s is already in use", address)
+            self._map[offset] = 1
+            if self._first <= offset < self._end:
+                self._owners[offset] = os.getpid()
+                self._releases.pop(offset, None)
+
+    def release(self, address):
+        offset = self._offset(address)
+        if offset is None or not self._first <= offset < self._end:
+            return
+        with self._transaction():
+            self._map[offset] = 0
+            self._owners.pop(offset, None)
+            self._serial += 1
+            self._releases[offset] = self._serial
+            self._hint = min(self._hint, offset)
+
+    def is_allocated(self, address):
+        offset = self._offset(address)
+        return offset is not None and bool(self._map[offset])
+
+    def reconcile(self, addresses):
+        """Rebuild the allocation state from the addresses really in use.
+
+        The allocations of the other running vl processes are kept, their
+        VMs may not be defined yet. The addresses in use are recorded with
+        the PID 0, so the processes that missed their allocation learn them.
+        The other allocations are dropped without a release, the processes
+        that already know them keep them.
+        """
+        with self._transaction():
+            previous = set(self._allocated())
+            self._reset()
+            owners = {
+                offset: pid
+                for offset, pid in self._owners.items()
+                if pid and pid != os.getpid() and _is_running(pid)
+            }
+            for address in addresses:
+                offset = self._offset(address)
+                if offset is None:
+                    continue
+                self._map[offset] = 1
+                if self._first <= offset < self._end:
+                    owners.setdefault(offset, 0)
+            for offset in owners:
+                self._map[offset] = 1
+            self._owners = owners
+            stale = previous - set(self._allocated())
+            if stale:
+                logger.debug("IPAM: releasing %d stale allocation(s)", len(stale))
+
+    def _allocated(self):
+        offset = self._map.find(1, self._first)
+        while offset != -1 and offset < self._end:
+            yield offset
+            offset = self._map.find(1, offset + 1)
+
+    def _load(self):
+        try:
+            state = json.loads(self.state_file.read_text())
+        except FileNotFoundError:
+            return {}, {}, self._serial
+        except (OSError, ValueError):
+            logger.debug("IPAM: cannot read %s, ignoring it", self.state_file)
+            return {}, {}, self._serial
+        if state.get("network") != str(self.network):
+            return {}, {}, self._serial
+
+        def offsets(values):
+            return {
+                int(offset): value
+                for offset, value in values.items()
+                if self._first <= int(offset) < self._end
+            }
+
+        owners = offsets(state.get("owners", {}))
+        releases = offsets(state.get("releases", {}))
+        return owners, releases, max(state.get("serial", 0), self._serial)
+
+    def _save(self):
+        releases = dict(
+            sorted(self._releases.items(), key=lambda i: i[1])[-MAX_RELEASES:]
+        )
+        state = {
+            "network": str(self.network),
+            "owners": self._owners,
+            "releases": releases,
+            "serial": self._serial,
+        }
+        temp_file = self.state_file.with_suffix(".temp")
+        try:
+            temp_file.write_text(json.dumps(state))
+            temp_file.replace(self.state_file)
+        except OSError:
+            logger.debug("IPAM: cannot write %s", self.state_file)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
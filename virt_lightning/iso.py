@@ -0,0 +1,374 @@
+import hashlib
+import re
+import struct
+import time
+
+SECTOR_SIZE = 2048
+CHUNK_SIZE = 64 * 1024
+# The system area, then the primary and the Joliet volume descriptors and
+# the set terminator.
+FIRST_FREE_SECTOR = 19
+
+RRIP_ID = b"RRIP_1991A"
+RRIP_DESCRIPTION = (
+    b"THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE "
+    b"SYSTEM SEMANTICS"
+)
+RRIP_SOURCE = (
+    b"PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  SEE PUBLISHER "
+    b"IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION."
+)
+MAX_NAME_LENGTH = 64
+
+
+def _both16(value):
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+
+def _both32(value):
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+
+def _sectors(size):
+    return -(-size // SECTOR_SIZE)
+
+
+def _pad(data, size=SECTOR_SIZE):
+    return bytes(data) + bytes(-len(data) % size)
+
+
+def _text(value, length, encoding="ascii"):
+    padding = " " * length
+    return (value + padding).encode(encoding)[:length]
+
+
+def _record_datetime(timestamp):
+    tm = time.gmtime(timestamp)
+    return struct.pack(
+        "7B",
+        tm.tm_year - 1900,
+        tm.tm_mon,
+        tm.tm_mday,
+        tm.tm_hour,
+        tm.tm_min,
+        tm.tm_sec,
+        0,
+    )
+
+
+def _volume_datetime(timestamp):
+    return time.strftime("%Y%m%d%H%M%S00", time.gmtime(timestamp)).encode() + b"\x00"
+
+
+def _directory_record(identifier, extent, size, is_dir, recorded, system_use=b""):
+    header_size = 33 + len(identifier)
+    record = bytearray(header_size + (header_size % 2))
+    record[2:10] = _both32(extent)
+    record[10:18] = _both32(size)
+    record[18:25] = recorded
+    record[25] = 0x02 if is_dir else 0x00
+    record[28:32] = _both16(1)
+    record[32] = len(identifier)
+    record[33:header_size] = identifier
+    record += system_use + bytes(len(system_use) % 2)
+    record[0] = len(record)
+    return bytes(record)
+
+
+def _rock_ridge_px(mode, nlink, serial):
+    return (
+        b"PX\x2c\x01"
+        + _both32(mode)
+        + _both32(nlink)
+        + _both32(0)
+        + _both32(0)
+        + _both32(serial)
+    )
+
+
+def _rock_ridge_tf(recorded):
+    # modify, access and attributes change times
+    return b"TF\x1a\x01\x0e" + recorded * 3
+
+
+def _rock_ridge_nm(name):
+    return b"NM" + bytes([5 + len(name), 1, 0]) + name
+
+
+def _rock_ridge_er():
+    return (
+        b"ER"
+        + bytes(
+            [
+                8 + len(RRIP_ID) + len(RRIP_DESCRIPTION) + len(RRIP_SOURCE),
+                1,
+                len(RRIP_ID),
+                len(RRIP_DESCRIPTION),
+                len(RRIP_SOURCE),
+                1,
+            ]
+        )
+        + RRIP_ID
+        + RRIP_DESCRIPTION
+        + RRIP_SOURCE
+    )
+
+
+def _primary_identifier(node):
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", node.name)[:30]
+    if node.is_dir:
+        return name.encode("ascii")
+    if "." not in name:
+        name += "."
+    return f"{name};1".encode("ascii")
+
+
+def _joliet_identifier(node):
+    name = node.name if node.is_dir else f"{node.name};1"
+    return name.encode("utf-16-be")
+
+
+class _Node:
+    def __init__(self, name, parent=None, data=None):
+        self.name = name
+        self.parent = parent
+        self.data = data
+        self.children = {}
+
+    @property
+    def is_dir(self):
+        return self.data is None
+
+
+class ISOImage:
+    """A small ISO9660 image with the Joliet and Rock Ridge extensions.
+
+    This is enough to build the cloud-init seed images (config-2 or cidata)
+    without an external genisoimage/mkisofs. The image is never written on
+    disk, chunks() streams it from the in-memory file contents.
+    """
+
+    def __init__(self, volume_id, publisher="", timestamp=None):
+        self.volume_id = volume_id
+        self.publisher = publisher
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.root = _Node("")
+        self._layout = None
+
+    def add_file(self, path, data):
+        if isinstance(data, str):
+            data = data.encode()
+        *dirs, name = path.strip("/").split("/")
+        node = self.root
+        for d in dirs:
+            node = node.children.setdefault(d, _Node(d, parent=node))
+            if not node.is_dir:
+                raise ValueError(f"{path}: {d} is a file")
+        for n in (*dirs, name):
+            if len(n) > MAX_NAME_LENGTH:
+                raise ValueError(f"{path}: {n} is too long")
+        if name in node.children:
+            raise ValueError(f"{path}: already exists")
+        node.children[name] = _Node(name, parent=node, data=bytes(data))
+        self._layout = None
+
+    def digest(self):
+        """Hash of the volume ID and of the files, the timestamp is ignored."""
+        digest = hashlib.sha256(self.volume_id.encode())
+        nodes = [("", self.root)]
+        for path, node in nodes:
+            for name, child in sorted(node.children.items()):
+                nodes.append((f"{path}/{name}", child))
+                if not child.is_dir:
+                    digest.update(f"{path}/{name}".encode() + b"\x00")
+                    digest.update(len(child.data).to_bytes(8, "little"))
+                    digest.update(child.data)
+        return digest.hexdigest()
+
+    @property
+    def size(self):
+        return self._get_layout()["sectors"] * SECTOR_SIZE
+
+    def _walk(self, identifier):
+        dirs = [self.root]
+        for d in dirs:
+            dirs += [c for c in self._children(d, identifier) if c.is_dir]
+        return dirs
+
+    @staticmethod
+    def _children(node, identifier):
+        return sorted(node.children.values(), key=identifier)
+
+    def _files(self):
+        nodes = [self.root]
+        for node in nodes:
+            nodes += self._children(node, _primary_identifier)
+        return [n for n in nodes if not n.is_dir]
+
+    def _get_layout(self):
+        if self._layout:
+            return self._layout
+        # The size of the path tables and of the directories does not
+        # depend on the final locations, so a first pass is done with
+        # empty locations.
+        self._layout = {"extents": {}, "ce": 0}
+        self._layout["serials"] = {
+            id(n): i + 1 for i, n in enumerate(self._walk(_primary_identifier))
+        }
+        for f in self._files():
+            self._layout["serials"][id(f)] = len(self._layout["serials"]) + 1
+        views = {"primary": _primary_identifier, "joliet": _joliet_identifier}
+        sector = FIRST_FREE_SECTOR
+        for view, identifier in views.items():
+            dirs = self._walk(identifier)
+            self._layout[view] = dirs
+            path_table_size = len(self._path_table(view, "<"))
+            self._layout[f"{view}_path_table_size"] = path_table_size
+            for byte_order in "<>":
+                self._layout[f"{view}_path_table{byte_order}"] = sector
+                sector += _sectors(path_table_size)
+        for view in views:
+            for d in self._layout[view]:
+                size = len(self._directory(d, view))
+                self._layout["extents"][(view, id(d))] = (sector, size)
+                sector += _sectors(size)
+        # The Rock Ridge continuation area, readers like libarchive expect it
+        # after the root directory.
+        self._layout["ce"] = sector
+        sector += 1
+        for f in self._files():
+            self._layout["extents"][(None, id(f))] = (sector, len(f.data))
+            sector += _sectors(len(f.data))
+        self._layout["sectors"] = sector
+        return self._layout
+
+    def _extent(self, view, node):
+        if not node.is_dir:
+            view = None
+        return self._layout["extents"].get((view, id(node)), (0, 0))
+
+    def _path_table(self, view, byte_order):
+        identifier = _primary_identifier if view == "primary" else _joliet_identifier
+        dirs = self._layout[view]
+        numbers = {id(d): i + 1 for i, d in enumerate(dirs)}
+        path_table = bytearray()
+        for d in dirs:
+            name = identifier(d) if d.parent else b"\x00"
+            parent = numbers[id(d.parent)] if d.parent else 1
+            extent, _ = self._extent(view, d)
+            path_table += struct.pack(
+                f"{byte_order}BBIH", len(name), 0, extent, parent
+            )
+            path_table += name + bytes(len(name) % 2)
+        return bytes(path_table)
+
+    def _system_use(self, view, node, name=None, root=False):
+        if view != "primary":
+            return b""
+        serial = self._layout["serials"][id(node)]
+        if node.is_dir:
+            nlink = 2 + len([c for c in node.children.values() if c.is_dir])
+            px = _rock_ridge_px(0o40555, nlink, serial)
+        else:
+            px = _rock_ridge_px(0o100444, 1, serial)
+        system_use = px + _rock_ridge_tf(_record_datetime(self.timestamp))
+        if root:
+            er = _rock_ridge_er()
+            sp = b"SP\x07\x01\xbe\xef\x00"
+            ce = b"CE\x1c\x01" + _both32(self._layout["ce"]) + _both32(0)
+            system_use = sp + ce + _both32(len(er)) + system_use
+        if name:
+            system_use += _rock_ridge_nm(name.encode())
+        return system_use
+
+    def _directory(self, node, view):
+        identifier = _primary_identifier if view == "primary" else _joliet_identifier
+        recorded = _record_datetime(self.timestamp)
+        parent = node.parent or node
+        records = [
+            _directory_record(
+                b"\x00",
+                *self._extent(view, node),
+                True,
+                recorded,
+                self._system_use(view, node, root=node is self.root),
+            ),
+            _directory_record(
+                b"\x01",
+                *self._extent(view, parent),
+                True,
+                recorded,
+                self._system_use(view, parent),
+            ),
+        ]
+        for child in self._children(node, identifier):
+            records.append(
+                _directory_record(
+                    identifier(child),
+                    *self._extent(view, child),
+                    child.is_dir,
+                    recorded,
+                    self._system_use(view, child, name=child.name),
+                )
+            )
+        directory = bytearray()
+        for record in records:
+            if len(directory) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                directory += bytes(-len(directory) % SECTOR_SIZE)
+            directory += record
+        return _pad(directory)
+
+    def _volume_descriptor(self, view):
+        joliet = view == "joliet"
+        encoding = "utf-16-be" if joliet else "ascii"
+        descriptor = bytearray(SECTOR_SIZE)
+        descriptor[0] = 2 if joliet else 1
+        descriptor[1:7] = b"CD001\x01"
+        descriptor[8:40] = _text("LINUX", 32, encoding)
+        descriptor[40:72] = _text(self.volume_id, 32, encoding)
+        descriptor[80:88] = _both32(self._layout["sectors"])
+        if joliet:
+            # UCS-2 Level 3
+            descriptor[88:91] = b"%/E"
+        descriptor[120:124] = _both16(1)
+        descriptor[124:128] = _both16(1)
+        descriptor[128:132] = _both16(SECTOR_SIZE)
+        descriptor[132:140] = _both32(self._layout[f"{view}_path_table_size"])
+        descriptor[140:144] = struct.pack("<I", self._layout[f"{view}_path_table<"])
+        descriptor[148:152] = struct.pack(">I", self._layout[f"{view}_path_table>"])
+        descriptor[156:190] = _directory_record(
+            b"\x00",
+            *self._extent(view, self.root),
+            True,
+            _record_datetime(self.timestamp),
+        )
+        descriptor[190:318] = _text("", 128, encoding)
+        descriptor[318:446] = _text(self.publisher, 128, encoding)
+        descriptor[446:574] = _text("", 128, encoding)
+        descriptor[574:702] = _text("VIRT-LIGHTNING", 128, encoding)
+        descriptor[702:813] = _text("", 111, encoding)
+        created = _volume_datetime(self.timestamp)
+        descriptor[813:830] = created
+        descriptor[830:847] = created
+        descriptor[847:864] = b"0" * 16 + b"\x00"
+        descriptor[864:881] = created
+        descriptor[881] = 1
+        return bytes(descriptor)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        self._get_layout()
+        header = bytearray(16 * SECTOR_SIZE)
+        header += self._volume_descriptor("primary")
+        header += self._volume_descriptor("joliet")
+        header += _pad(b"\xffCD001\x01")
+        for view in ("primary", "joliet"):
+            for byte_order in "<>":
+                header += _pad(self._path_table(view, byte_order))
+        for view in ("primary", "joliet"):
+            for d in self._layout[view]:
+                header += self._directory(d, view)
+        header += _pad(_rock_ridge_er())
+        pieces = [header] + [_pad(f.data) for f in self._files()]
+        for piece in pieces:
+            for i in range(0, len(piece), chunk_size):
+                yield bytes(piece[i : i + chunk_size])
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("virt_lightning")
+
+DONE = "done"
+
+
+class Pipeline:
+    """Move a set of items through a list of stages, each item on its own.
+
+    The stages are connected by asyncio queues and each stage has one worker
+    per item, so a slow item never holds the other ones. A stage is a
+    coroutine function called with the item, it can return False to drop
+    the item. An exception also drops the item, it's kept in errors.
+    """
+
+    def __init__(self, stages, on_stage=None, on_drained=None):
+        self.stages = stages
+        self.on_stage = on_stage
+        self.on_drained = on_drained
+        self.errors = []
+
+    def _notify(self, item, stage):
+        if self.on_stage:
+            self.on_stage(item, stage)
+
+    async def _worker(self, index, queues):
+        name, func = self.stages[index]
+        while True:
+            item = await queues[index].get()
+            try:
+                self._notify(item, name)
+                keep = await func(item)
+            except Exception as e:
+                logger.debug("%s failed during the %s stage: %s", item, name, e)
+                self.errors.append(e)
+                keep = False
+            if keep is not False:
+                if index + 1 < len(self.stages):
+                    queues[index + 1].put_nowait(item)
+                else:
+                    self._notify(item, DONE)
+            queues[index].task_done()
+
+    async def run(self, items):
+        queues = [asyncio.Queue() for _ in self.stages]
+        workers = [
+            asyncio.ensure_future(self._worker(index, queues))
+            for index in range(len(self.stages))
+            for _ in items
+        ]
+        for item in items:
+            queues[0].put_nowait(item)
+        try:
+            # The items only move forward, once a queue is drained the
+            # previous stages are too.
+            for (name, _), queue in zip(self.stages, queues):
+                await queue.join()
+                if self.on_drained:
+                    self.on_drained(name)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
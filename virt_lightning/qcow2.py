@@ -0,0 +1,141 @@
+import functools
+import os
+import pathlib
+import struct
+
+QCOW2_MAGIC = b"QFI\xfb"
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size
+HEADER = struct.Struct(">4sIQIIQ")
+# Version 3 adds the incompatible, compatible and autoclear features, the
+# refcount order and the header length to the 72 bytes of version 2
+HEADER_V2_LENGTH = 72
+HEADER_LENGTH = struct.Struct(">I")
+HEADER_LENGTH_OFFSET = 100
+EXTENSION = struct.Struct(">II")
+EXTENSION_END = 0
+EXTENSION_BACKING_FORMAT = 0xE2792ACA
+# The header, its extensions and the backing file name are in the first
+# cluster, 64KiB by default
+READ_SIZE = 64 * 1024
+MAX_CHAIN_LENGTH = 16
+
+
+class InvalidImageError(Exception):
+    def __init__(self, path):
+        self.path = path
+
+
+class BackingFileError(Exception):
+    def __init__(self, path):
+        self.path = path
+
+
+class Qcow2Header:
+    def __init__(
+        self,
+        path,
+        version,
+        virtual_size,
+        cluster_size,
+        backing_file=None,
+        backing_format=None,
+    ):
+        self.path = path
+        self.version = version
+        self.virtual_size = virtual_size
+        self.cluster_size = cluster_size
+        self.backing_file = backing_file
+        self.backing_format = backing_format
+
+    def __repr__(self):
+        return (
+            f"Qcow2Header(path={self.path}, version={self.version}, "
+            f"virtual_size={self.virtual_size}, backing_file={self.backing_file})"
+        )
+
+
+def parse_header(path, data, read=None):
+    """Parse the qcow2 header at the start of data.
+
+    read(offset, length) is called if the backing file name is not in data.
+    """
+    if len(data) < HEADER_V2_LENGTH:
+        raise InvalidImageError(path)
+    magic, version, backing_offset, backing_size, cluster_bits, size = (
+        HEADER.unpack_from(data)
+    )
+    if magic != QCOW2_MAGIC or version not in (2, 3):
+        raise InvalidImageError(path)
+
+    backing_file = None
+    if backing_offset:
+        end = backing_offset + backing_size
+        if end <= len(data):
+            name = data[backing_offset:end]
+        elif read:
+            name = read(backing_offset, backing_size)
+        else:
+            raise InvalidImageError(path)
+        backing_file = name.decode()
+
+    backing_format = None
+    offset = HEADER_V2_LENGTH
+    if version == 3:
+        (offset,) = HEADER_LENGTH.unpack_from(data, HEADER_LENGTH_OFFSET)
+    while offset + EXTENSION.size <= len(data):
+        kind, length = EXTENSION.unpack_from(data, offset)
+        offset += EXTENSION.size
+        if kind == EXTENSION_END:
+            break
+        if kind == EXTENSION_BACKING_FORMAT:
+            backing_format = data[offset : offset + length].decode()
+        # The extensions are padded to 8 bytes
+        offset += (length + 7) & ~7
+
+    return Qcow2Header(
+        path,
+        version,
+        virtual_size=size,
+        cluster_size=1 << cluster_bits,
+        backing_file=backing_file,
+        backing_format=backing_format,
+    )
+
+
+@functools.lru_cache(maxsize=128)
+def _read_header(path, inode, mtime):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return parse_header(
+            path,
+            os.pread(fd, READ_SIZE, 0),
+            read=lambda offset, length: os.pread(fd, length, offset),
+        )
+    finally:
+        os.close(fd)
+
+
+def read_header(path):
+    """Return the Qcow2Header of an image, only read again once it changes."""
+    path = str(path)
+    stat = os.stat(path)
+    return _read_header(path, stat.st_ino, stat.st_mtime_ns)
+
+
+def backing_chain(path):
+    """Return the header of the image, then those of its qcow2 backing files.
+
+    The chain stops at a backing file that is missing or is not a qcow2 image.
+    """
+    chain = [read_header(path)]
+    while len(chain) < MAX_CHAIN_LENGTH:
+        header = chain[-1]
+        if not header.backing_file or header.backing_format not in (None, "qcow2"):
+            break
+        # A relative name is relative to the directory of the image
+        backing_file = pathlib.Path(header.path).parent / header.backing_file
+        try:
+            chain.append(read_header(backing_file))
+        except (FileNotFoundError, InvalidImageError):
+            break
+    return chain
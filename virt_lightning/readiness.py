@@ -0,0 +1,147 @@
+import asyncio
+import contextlib
+import logging
+import random
+
+logger = logging.getLogger("virt_lightning")
+
+READY = "ready"
+TIMEOUT = "timeout"
+
+DEFAULT_TIMEOUT = 600
+# The maximum number of probes in flight, whatever the number of VMs
+MAX_CONCURRENT_PROBES = 32
+CONNECT_TIMEOUT = 5
+INITIAL_DELAY = 0.5
+MAX_DELAY = 10
+
+
+class ReadinessResult:
+    __slots__ = ("name", "address", "status", "elapsed", "attempts", "error")
+
+    def __init__(self, name, address, status, elapsed, attempts, error=None):
+        self.name = name
+        self.address = address
+        self.status = status
+        # The time to the SSH banner, or to the deadline
+        self.elapsed = elapsed
+        self.attempts = attempts
+        self.error = error
+
+    @property
+    def ready(self):
+        return self.status == READY
+
+    def __repr__(self):
+        return (
+            f"ReadinessResult(name={self.name}, status={self.status}, "
+            f"elapsed={self.elapsed:.1f}s, attempts={self.attempts})"
+        )
+
+
+class SSHProber:
+    """Wait for the SSH banner of a set of VMs.
+
+    A failed probe is retried after an exponential backoff with some jitter,
+    so many booting VMs don't probe the bridge in lockstep. The probes of all
+    the VMs share the same concurrency limit, and each VM has a deadline.
+    """
+
+    def __init__(
+        self, timeout=DEFAULT_TIMEOUT, max_concurrent=MAX_CONCURRENT_PROBES, port=22
+    ):
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.port = port
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use, so it belongs to the running event loop
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def probe(self, address):
+        async with self.semaphore:
+            reader, writer = await asyncio.open_connection(address, self.port)
+            try:
+                data = await reader.read(10)
+            finally:
+                writer.close()
+        return data.startswith(b"SSH")
+
+    async def wait(self, name, address, timeout=None, agent=None, resolve=None):
+        """Wait for the SSH banner of a VM.
+
+        agent is an optional future resolved once the guest agent of the VM
+        is connected, the probes only start then. resolve() is then awaited
+        to get the address reported by the agent, if any.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + (timeout or self.timeout)
+        delay = INITIAL_DELAY
+        attempts = 0
+        error = None
+        waiting_agent = agent is not None
+        slow_tick = False
+        while True:
+            if waiting_agent and agent.done():
+                waiting_agent = False
+                logger.debug("%s: guest agent connected", name)
+                if resolve:
+                    address = await resolve() or address
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.debug("%s: no SSH banner after %d probes", name, attempts)
+                return ReadinessResult(
+                    name, address, TIMEOUT, loop.time() - start, attempts, error
+                )
+            if address and (not waiting_agent or slow_tick):
+                attempts += 1
+                try:
+                    if await asyncio.wait_for(
+                        self.probe(address), min(CONNECT_TIMEOUT, remaining)
+                    ):
+                        return ReadinessResult(
+                            name, address, READY, loop.time() - start, attempts
+                        )
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = e
+                remaining = max(deadline - loop.time(), 0)
+            if waiting_agent:
+                # Until the agent is connected, only probe every MAX_DELAY
+                # seconds in case the image has no agent.
+                slow_tick = True
+                pause = min(remaining, random.uniform(MAX_DELAY / 2, MAX_DELAY))
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(asyncio.shield(agent), pause)
+                continue
+            await asyncio.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(delay * 2, MAX_DELAY)
+
+
+class AgentEvents:
+    """Futures resolved when the guest agent of a domain is connected.
+
+    connected() is thread-safe, it can be called from a libvirt event
+    callback.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._futures = {}
+
+    def future(self, name):
+        if name not in self._futures:
+            self._futures[name] = self.loop.create_future()
+        return self._futures[name]
+
+    def _set_connected(self, name):
+        future = self.future(name)
+        if not future.done():
+            future.set_result(True)
+
+    def connected(self, name):
+        self.loop.call_soon_threadsafe(self._set_connected, name)
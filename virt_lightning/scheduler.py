@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("virt_lightning")
+
+SYS_BLOCK_DIR = "/sys/block"
+KINDS = ("rpc", "cpu", "io")
+
+
+def count_disks():
+    # Only the block devices backed by a real device, not loop, zram or dm
+    try:
+        disks = [
+            d for d in pathlib.Path(SYS_BLOCK_DIR).iterdir() if (d / "device").exists()
+        ]
+    except OSError:
+        return 1
+    return max(len(disks), 1)
+
+
+def default_limits():
+    cpus = os.cpu_count() or 1
+    return {
+        # The RPC calls mostly wait for libvirtd
+        "rpc": min(4 * cpus, 64),
+        "cpu": cpus,
+        "io": 4 * count_disks(),
+    }
+
+
+class Scheduler:
+    """One thread pool per kind of work: libvirt RPC, CPU and disk I/O.
+
+    Each pool has its own limit, so a burst of disk copies does not delay
+    the RPC calls of the other VMs. The time spent in each pool is recorded
+    for stats().
+    """
+
+    def __init__(self, rpc=None, cpu=None, io=None):
+        defaults = default_limits()
+        self.limits = {
+            "rpc": rpc or defaults["rpc"],
+            "cpu": cpu or defaults["cpu"],
+            "io": io or defaults["io"],
+        }
+        self._executors = {
+            kind: ThreadPoolExecutor(
+                max_workers=limit, thread_name_prefix=f"vl-{kind}"
+            )
+            for kind, limit in self.limits.items()
+        }
+        self._lock = threading.Lock()
+        self._tasks = dict.fromkeys(KINDS, 0)
+        self._busy = dict.fromkeys(KINDS, 0.0)
+        self._running = dict.fromkeys(KINDS, 0)
+        self._peak = dict.fromkeys(KINDS, 0)
+        self._started = time.monotonic()
+
+    def _measure(self, kind, func, args):
+        def run():
+            with self._lock:
+                self._running[kind] += 1
+                self._peak[kind] = max(self._peak[kind], self._running[kind])
+            start = time.monotonic()
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._running[kind] -= 1
+                    self._tasks[kind] += 1
+                    self._busy[kind] += time.monotonic() - start
+
+        return run
+
+    def run(self, kind, func, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self._executors[kind], self._measure(kind, func, args)
+        )
+
+    def stats(self):
+        wall_time = time.monotonic() - self._started
+        with self._lock:
+            return {
+                kind: {
+                    "workers": self.limits[kind],
+                    "tasks": self._tasks[kind],
+                    "peak": self._peak[kind],
+                    "busy": self._busy[kind],
+                    "utilization": self._busy[kind]
+                    / (wall_time * self.limits[kind] or 1),
+                }
+                for kind in KINDS
+            }
+
+    def log_stats(self):
+        for kind, stats in self.stats().items():
+            logger.debug(
+                "%s: %d tasks, %d/%d workers at peak, %.1fs busy, %.0f%% utilization",
+                kind,
+                stats["tasks"],
+                stats["peak"],
+                stats["workers"],
+                stats["busy"],
+                stats["utilization"] * 100,
+            )
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
@@ -7,16 +7,20 @@ import pathlib
 import sys
 from importlib.metadata import version as get_version
 
-import libvirt
-import yaml
-
-import virt_lightning.api
-import virt_lightning.ui as ui
-import virt_lightning.virt_lightning as vl
+import virt_lightning.client
 from virt_lightning.configuration import Configuration
 from virt_lightning.symbols import get_symbols
 
 symbols = get_symbols()
+DAEMON_ACTIONS = (
+    "ansible_inventory",
+    "distro_list",
+    "images",
+    "ssh",
+    "ssh_config",
+    "status",
+    "storage_dir",
+)
 logger = logging.getLogger("virt_lightning")
 logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
@@ -51,12 +55,22 @@ def how_to_fix_auth_error():
 
 
 def console(configuration, name=None, **kwargs):
+    import libvirt
+
+    import virt_lightning.ui as ui
+    import virt_lightning.virt_lightning as vl
+
     conn = libvirt.open(configuration.libvirt_uri)
     hv = vl.LibvirtHypervisor(conn)
 
     def go_console(domain):
         os.execlp(
-            "virsh", "virsh", "-c", configuration.libvirt_uri, "console", domain.name
+            "virsh",
+            "virsh",
+            "-c",
+            configuration.libvirt_uri,
+            "console",
+            domain.dom.name(),
         )
 
     if name:
@@ -66,6 +80,11 @@ def console(configuration, name=None, **kwargs):
 
 
 def viewer(configuration, name=None, **kwargs):
+    import libvirt
+
+    import virt_lightning.ui as ui
+    import virt_lightning.virt_lightning as vl
+
     conn = libvirt.open(configuration.libvirt_uri)
     hv = vl.LibvirtHypervisor(conn)
 
@@ -90,7 +109,7 @@ def viewer(configuration, name=None, **kwargs):
                 "-c",
                 configuration.libvirt_uri,
                 "--domain-name",
-                domain.name,
+                domain.dom.name(),
             )
         else:
             sys.exit(0)
@@ -101,11 +120,33 @@ def viewer(configuration, name=None, **kwargs):
     ui.Selector(sorted(hv.list_domains()), go_viewer)
 
 
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return f"{size:.1f}{unit}"
+
+
+def describe_image(header):
+    """One line about a qcow2 image, as a YAML comment."""
+    allocated = os.stat(header.path).st_blocks * 512
+    return (
+        f"qcow2 v{header.version}, {format_size(header.virtual_size)} virtual, "
+        f"{format_size(allocated)} on disk, "
+        f"{format_size(header.cluster_size)} clusters"
+    )
+
+
 def progress_callback(cur, length):
-    done = int(cur / virt_lightning.api.MB)
+    from virt_lightning.api import MB
+
+    done = int(cur / MB)
     if length:
         percent = (cur * 100) / length
-        full = int(length / virt_lightning.api.MB)
+        full = int(length / MB)
         line = f"🌍 ➡️  💻 [{percent:06.2f}%]  {done:6}MB/{full}MB\r"
     else:
         line = f"🌍 ➡️  💻 {done:6}MB\r"
@@ -113,6 +154,8 @@ def progress_callback(cur, length):
 
 
 def list_from_yaml_file(value):
+    import yaml
+
     file_path = pathlib.PosixPath(value)
     if not file_path.exists():
         raise argparse.ArgumentTypeError(f"{value} does not exist.")
@@ -123,6 +166,18 @@ def list_from_yaml_file(value):
         return content
 
 
+def get_api(action, configuration):
+    # The read-only commands are answered by `vl daemon` when it's running,
+    # libvirt is not even imported then.
+    if action in DAEMON_ACTIONS:
+        client = virt_lightning.client.connect(configuration)
+        if client:
+            return client
+    import virt_lightning.api as api
+
+    return api
+
+
 def main():
     title = f"{symbols.LIGHTNING.value} Virt-Lightning {symbols.LIGHTNING.value}"
 
@@ -161,6 +216,9 @@ Commands:
     console             Open console on a VM
     viewer              Open VM with virt-viewer
     status              Get status of running VM's
+    daemon              Serve the read-only commands from a background process
+    warm_pool           Start the VMs of the warm pool
+    templates           List the booted templates and their restore times
     """
 
     vl_lightning_yaml_args = {
@@ -189,6 +247,12 @@ Commands:
         required=False,
         type=pathlib.PosixPath,
     )
+    main_parser.add_argument(
+        "--refresh-capabilities",
+        action="store_true",
+        default=False,
+        help="Probe the host capabilities again, e.g: kvm was installed",
+    )
     package_version = get_version("virt-lightning")
 
     main_parser.add_argument(
@@ -206,6 +270,16 @@ Commands:
     )
     up_parser.add_argument("--virt-lightning-yaml", **vl_lightning_yaml_args)
     up_parser.add_argument("--context", **context_args)
+    for kind, description in (
+        ("rpc", "libvirt calls"),
+        ("cpu", "CPU bound steps"),
+        ("io", "disk operations"),
+    ):
+        up_parser.add_argument(
+            f"--{kind}-workers",
+            help=f"maximum number of parallel {description} (default: auto)",
+            type=int,
+        )
 
     down_parser = action_subparsers.add_parser(
         "down",
@@ -234,6 +308,12 @@ Commands:
         dest="enable_console",
         default=True,
     )
+    start_parser.add_argument(
+        "--template",
+        help="Restore the VM from a booted template",
+        action="store_true",
+        default=False,
+    )
     start_parser.add_argument("distro", help="Name of the distro", type=str)
     start_parser.add_argument(
         "--disk",
@@ -254,12 +334,18 @@ Commands:
     )
     status_parser.add_argument("--context", **context_args)
 
-    action_subparsers.add_parser(
+    images_parser = action_subparsers.add_parser(
         "images",
         help="List all the images available locally",
         parents=[parent_parser],
         aliases=["distro_list"]
     )
+    images_parser.add_argument(
+        "--details",
+        help="Print the size and the backing files of the images",
+        action="store_true",
+        default=False,
+    )
     action_subparsers.add_parser(
         "remote_images",
         help="List all the images available from the remote images.json",
@@ -310,6 +396,22 @@ Commands:
         type=str,
     )
 
+    action_subparsers.add_parser(
+        "warm_pool",
+        help="Start the missing VMs of the warm pool",
+        parents=[parent_parser],
+    )
+    action_subparsers.add_parser(
+        "templates",
+        help="List the booted templates, with their cold boot and restore times",
+        parents=[parent_parser],
+    )
+    action_subparsers.add_parser(
+        "daemon",
+        help="Keep the libvirt connection open and answer the read-only commands",
+        parents=[parent_parser],
+    )
+
     args = main_parser.parse_args()
     if not args.action:
         print(title)  # noqa: T001
@@ -324,25 +426,36 @@ Commands:
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
+    if args.refresh_capabilities:
+        from virt_lightning.virt_lightning import HostCapabilities
+
+        HostCapabilities.clear_cache()
+
+    api = get_api(args.action, configuration)
+
     if args.action == "ansible_inventory":
         print(  # noqa: T001
-            virt_lightning.api.ansible_inventory(
-                configuration=configuration, **vars(args)
-            )
+            api.ansible_inventory(configuration=configuration, **vars(args))
         )
     elif args.action == "ssh_config":
-        print(  # noqa: T001
-            virt_lightning.api.ssh_config(configuration=configuration, **vars(args))
-        )
-    elif args.action in ["images", "distro_list"]:
-        for distro_name in virt_lightning.api.images(
+        print(api.ssh_config(configuration=configuration, **vars(args)))  # noqa: T001
+    elif args.action in ["images", "distro_list"] and args.details:
+        # Still a valid virt-lightning.yaml file
+        for distro_name, chain in api.images(
             configuration=configuration, **vars(args)
-        ):
+        ).items():
+            print(f"- distro: {distro_name}")  # noqa: T001
+            print(f"  # {describe_image(chain[0])}")  # noqa: T001
+            for header in chain[1:]:
+                print(f"  # backing: {header.path}")  # noqa: T001
+                print(f"  #   {describe_image(header)}")  # noqa: T001
+    elif args.action in ["images", "distro_list"]:
+        for distro_name in api.images(configuration=configuration, **vars(args)):
             print(f"- distro: {distro_name}")  # noqa: T001
     elif args.action == "remote_images":
         try:
             # Get the URL being used for display
-            remote_images = virt_lightning.api.list_remote_images(
+            remote_images = api.list_remote_images(
                 configuration=configuration, **vars(args)
             )
             print(f"\nAvailable images ({len(remote_images)} total):")  # noqa: T001
@@ -352,14 +465,10 @@ Commands:
             print(f"Error during the image download: {e}")  # noqa: T001
             exit(1)
     elif args.action == "storage_dir":
-        print(  # noqa: T001
-            virt_lightning.api.storage_dir(configuration=configuration, **vars(args))
-        )
+        print(api.storage_dir(configuration=configuration, **vars(args)))  # noqa: T001
     elif args.action == "status":
         results = {}
-        for status in virt_lightning.api.status(
-            configuration=configuration, **vars(args)
-        ):
+        for status in api.status(configuration=configuration, **vars(args)):
             results[status["name"]] = {
                 "name": status["name"],
                 "ipv4": status["ipv4"] or "waiting",
@@ -385,54 +494,102 @@ Commands:
         viewer(configuration=configuration, name=args.name)
     elif args.action == "ssh":
         if args.name:
-            virt_lightning.api.exec_ssh(configuration=configuration, name=args.name)
+            api.exec_ssh(configuration=configuration, name=args.name)
+
+        import virt_lightning.ui as ui
 
         def go_ssh(domain):
             domain.exec_ssh()
 
         ui.Selector(
-            virt_lightning.api.list_domains(configuration=configuration, **vars(args)),
+            api.list_domains(configuration=configuration, **vars(args)),
             go_ssh,
         )
+    elif args.action == "templates":
+        for template in api.templates(configuration=configuration, **vars(args)):
+            restore = template["restore"]
+            print(  # noqa: T001
+                f"{template['distro']:<20} {template['key']}   "
+                f"cold boot: {template['cold_boot']:.1f}s   restore: "
+                + (f"{restore:.1f}s (x{template['restores']})" if restore else "-")
+            )
+    elif args.action == "daemon":
+        from virt_lightning.client import InsecureSocketDirectoryError
+        from virt_lightning.daemon import Daemon, DaemonAlreadyRunningError
+
+        try:
+            Daemon(configuration).run()
+        except DaemonAlreadyRunningError as e:
+            print(f"vl daemon is already running on {e.path}")  # noqa: T001
+            exit(1)
+        except InsecureSocketDirectoryError as e:
+            print(  # noqa: T001
+                f"{e.path} must be a directory owned by you, with the mode 0700"
+            )
+            exit(1)
+        except api.CannotConnectToLibvirtError:
+            how_to_fix_auth_error()
     elif args.action in ["pull", "fetch"]:
         try:
-            virt_lightning.api.fetch(
+            api.fetch(
                 configuration=configuration,
                 progress_callback=progress_callback,
                 **vars(args),
             )
-        except virt_lightning.api.CannotConnectToLibvirtError:
+        except api.CannotConnectToLibvirtError:
             how_to_fix_auth_error()
-        except virt_lightning.api.ImageNotFoundUpstreamError:
+        except api.ImageNotFoundUpstreamError:
             if args.url:
                 print(f"Image cannot be downloaded from URL: {args.url}")  # noqa: T001
             else:
                 print(  # noqa: T001
                     f"Distro {args.distro} cannot be downloaded.\n"
-                    f"  Visit {virt_lightning.api.BASE_URL}/images/ "
+                    f"  Visit {api.BASE_URL}/images/ "
                     "or add a custom image list / private image hub "
                     "to get an up to date list."
                 )
             exit(1)
+        except api.ChecksumError as e:
+            print(f"The checksum of the image doesn't match: {e.name}")  # noqa: T001
+            exit(1)
     elif args.action in ["up", "start"]:
-        action_func = getattr(virt_lightning.api, args.action)
+        from virt_lightning.qcow2 import BackingFileError
+
+        action_func = getattr(api, args.action)
         try:
             action_func(configuration=configuration, **vars(args))
-        except virt_lightning.api.ImageNotFoundLocallyError as e:
+        except api.ImageNotFoundLocallyError as e:
             print(f"Image not found from url: {e.name}")  # noqa: T001
             exit(1)
-        except virt_lightning.api.CannotConnectToLibvirtError:
+        except api.CannotConnectToLibvirtError:
             how_to_fix_auth_error()
-        except virt_lightning.api.VMNotRunningError as e:
+        except api.VMNotRunningError as e:
             print(f"The following instance is not running: {e.name}")  # noqa: T001
             exit(1)
+        except api.VMNotReachableError as e:
+            print(f"The following instances are not reachable: {e.name}")  # noqa: T001
+            exit(1)
+        except api.TemplateError as e:
+            print(f"Cannot build or restore the template of: {e.name}")  # noqa: T001
+            exit(1)
+        except api.GoldenImageError as e:
+            print(f"Cannot build the golden image with: {e.name}")  # noqa: T001
+            exit(1)
+        except BackingFileError as e:
+            print(  # noqa: T001
+                f"The backing image is missing or is not a qcow2 image: {e.path}"
+            )
+            exit(1)
+        except api.ChecksumError as e:
+            print(f"The checksum of the image doesn't match: {e.name}")  # noqa: T001
+            exit(1)
     else:
         try:
-            action_func = getattr(virt_lightning.api, args.action)
+            action_func = getattr(api, args.action)
             action_func(configuration=configuration, **vars(args))
-        except virt_lightning.api.VMNotFoundError as e:
+        except api.VMNotFoundError as e:
             logger.error(f"VM {e.name} not found")
-        except virt_lightning.api.ImageNotFoundLocallyError as e:
+        except api.ImageNotFoundLocallyError as e:
             logger.error(
                 f"ℹ️ You may be able to download the image with the `vl pull {e.name}` command."
             )
@@ -9,6 +9,7 @@ DISK_XML = """
 DOMAIN_XML = """
 <domain type='kvm'>
   <name></name>
+  <uuid></uuid>
   <memory unit='KiB'>1048576</memory>
   <currentMemory unit='KiB'>1048576</currentMemory>
   <vcpu>2</vcpu>
@@ -73,7 +74,7 @@ NETWORK_XML = """
   <bridge name='virbr0' stp='off' delay='0'/>
   <ip address='192.168.123.1' netmask='255.255.255.0'>
   <dhcp>
-    <leasetime>10s</leasetime>
+    <leasetime unit='hours'>1</leasetime>
   </dhcp>
   </ip>
 </network>
@@ -96,10 +97,17 @@ network-interfaces: |
    iface eth0 inet static
    address {ipv4}
    network {network}
-   netmask 255.255.255.0
+   netmask {netmask}
    gateway {gateway}
 """
 
+META_DATA_ENI_IPV6 = """\
+   iface eth0 inet6 static
+   address {ipv6}
+   netmask {prefixlen}
+   gateway {gateway6}
+"""
+
 STORAGE_POOL_XML = """
 <pool type='dir'>
   <name></name>
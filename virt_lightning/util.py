@@ -1,3 +1,6 @@
+import copy
+
+
 def strtobool(value: str) -> bool:
     """Convert a range of string representations of a boolean to bool. Case insensitive.
 
@@ -20,3 +23,18 @@ def strtobool(value: str) -> bool:
         return False
     else:
         raise ValueError(f"Cannot convert to boolean {value!r}")
+
+
+def builder_host(host, name, excluded=()):
+    """Return a copy of host, to boot another VM with its configuration.
+
+    The addresses of the NICs are dropped, so the VM gets its own ones.
+    """
+    builder = copy.deepcopy(
+        {k: v for k, v in host.items() if k != "name" and k not in excluded}
+    )
+    for network in builder.get("networks", []):
+        for k in ("ipv4", "ipv6", "mac"):
+            network.pop(k, None)
+    builder["name"] = name
+    return builder
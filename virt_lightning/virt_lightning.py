@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import asyncio
+import contextlib
+import copy
 import getpass
+import hashlib
 import ipaddress
+import itertools
 import json
 import logging
 import math
@@ -12,20 +16,27 @@ import re
 import string
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 import uuid
 import xml.etree.ElementTree as ET  # noqa: N817
 
 import libvirt
+import libvirt_qemu
 import yaml
 
 from virt_lightning.symbols import get_symbols
 
+from . import qcow2
+from .ipam import IPAllocator
+from .iso import ISOImage
+from .readiness import SSHProber
 from .templates import (
     BRIDGE_XML,
     DISK_XML,
     DOMAIN_XML,
     META_DATA_ENI,
+    META_DATA_ENI_IPV6,
     NETWORK_DHCP_ENTRY,
     NETWORK_HOST_ENTRY,
     NETWORK_XML,
@@ -34,7 +45,15 @@ from .templates import (
     USER_CREATE_STORAGE_POOL_DIR,
 )
 
+DOMAIN_STATS = (
+    libvirt.VIR_DOMAIN_STATS_STATE
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+)
+
 DEFAULT_STORAGE_DIR = "/var/lib/virt-lightning/pool"
+CACHE_DIR = os.environ.get("XDG_CACHE_HOME", "~/.cache") + "/virt-lightning"
 QEMU_DIR = "/var/lib/libvirt/qemu/"
 KVM_BINARIES = (
     "/usr/bin/qemu-system-x86_64",
@@ -42,10 +61,14 @@ KVM_BINARIES = (
     "/usr/bin/kvm",
     "/usr/libexec/qemu-kvm",
 )
-ISO_BINARIES = (
-    "genisoimage",
-    "mkisofs",
-)
+KVM_DEVICE = "/dev/kvm"
+# Total size of the cached cloud-init seed images
+SEED_CACHE_MAX_SIZE = 64 * 1024**2
+METADATA_NS = "https://virt-lightning.org/xmlns/metadata/1.0"
+# The libvirt name of the VMs of the warm pool, they keep it once claimed
+POOL_PREFIX = "vl-pool-"
+AGENT_TIMEOUT = 10
+ET.register_namespace("vl", METADATA_NS)
 
 logger = logging.getLogger("virt_lightning")
 
@@ -62,6 +85,344 @@ def run_cmd(cmd, cwd=None):
     return outs
 
 
+class HostCapabilities:
+    """The host properties that are costly to probe.
+
+    They are probed once and kept in CACHE_DIR, the entries are keyed by
+    libvirt URI, hostname and libvirt version. A probe that didn't find a
+    kvm binary isn't kept, and one without the kvm domain type is probed
+    again once KVM_DEVICE exists, e.g: qemu-kvm was installed since.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._values = None
+
+    @staticmethod
+    def cache_file():
+        return pathlib.Path(CACHE_DIR).expanduser() / "capabilities.json"
+
+    @classmethod
+    def clear_cache(cls):
+        """Forget the capabilities of every host."""
+        cls.cache_file().unlink(missing_ok=True)
+
+    def _cache_key(self):
+        return "{uri} {hostname} {version}".format(
+            uri=self.conn.getURI(),
+            hostname=self.conn.getHostname(),
+            version=self.conn.getLibVersion(),
+        )
+
+    def _read_cache(self):
+        try:
+            return json.loads(self.cache_file().read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cache):
+        cache_file = self.cache_file()
+        temp_file = cache_file.with_suffix(".temp")
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file.write_text(json.dumps(cache, indent=2))
+            temp_file.replace(cache_file)
+        except OSError as e:
+            logger.debug("Cannot write %s: %s", cache_file, e)
+
+    @staticmethod
+    def _is_valid(values):
+        kvm_binary = values.get("kvm_binary")
+        if not kvm_binary or not pathlib.PosixPath(kvm_binary).exists():
+            return False
+        return values["domain_type"] == "kvm" or not os.path.exists(KVM_DEVICE)
+
+    @property
+    def values(self):
+        if self._values is None:
+            key = self._cache_key()
+            cache = self._read_cache()
+            values = cache.get(key)
+            if not values or not self._is_valid(values):
+                values = self.probe()
+                if values["kvm_binary"]:
+                    cache[key] = values
+                    self._write_cache(cache)
+            if values["domain_type"] != "kvm":
+                logger.warning("kvm mode not available!")
+            self._values = values
+        return self._values
+
+    def invalidate(self):
+        self._values = None
+        cache = self._read_cache()
+        if cache.pop(self._cache_key(), None):
+            self._write_cache(cache)
+
+    def probe(self):
+        root = ET.fromstring(self.conn.getCapabilities())
+        available = [
+            e.attrib["type"] for e in root.findall("./guest/arch/domain[@type]")
+        ]
+        if not available:
+            raise Exception("No domain type available!")
+        kvm_binary = next(
+            (i for i in KVM_BINARIES if pathlib.PosixPath(i).exists()), None
+        )
+        return {
+            "arch": root.find("./host/cpu/arch").text,
+            # Sorted to get kvm before qemu, assume there is no other type
+            "domain_type": sorted(available)[0],
+            "kvm_binary": kvm_binary,
+        }
+
+
+class SeedCache:
+    """The cloud-init seed volumes, indexed by the digest of their content.
+
+    The seed images are kept in the storage pool and shared by the domains
+    with the same documents, e.g: a VM created again with the same name and
+    address. The least recently used seeds are removed when the total size
+    goes above SEED_CACHE_MAX_SIZE.
+    """
+
+    def __init__(self, hv):
+        self.hv = hv
+        self.index_file = hv.get_storage_dir() / "upstream" / ".seed-cache.json"
+        # Only held to read or write the index
+        self._lock = threading.Lock()
+        # One lock per digest, so a seed is only uploaded once
+        self._uploads = {}
+
+    def _read_index(self):
+        try:
+            return json.loads(self.index_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        temp_file = self.index_file.with_suffix(".temp")
+        try:
+            temp_file.write_text(json.dumps(index, indent=2))
+            temp_file.replace(self.index_file)
+        except OSError as e:
+            logger.debug("Cannot write %s: %s", self.index_file, e)
+
+    def _lookup(self, volume_name):
+        try:
+            return self.hv.storage_pool_obj.storageVolLookupByName(volume_name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+        return None
+
+    def volumes(self):
+        with self._lock:
+            return {entry["volume"] for entry in self._read_index().values()}
+
+    def get(self, image):
+        digest = image.digest()
+        with self._lock:
+            upload_lock = self._uploads.setdefault(digest, threading.Lock())
+        with upload_lock:
+            with self._lock:
+                entry = self._read_index().get(digest)
+            volume = self._lookup(entry["volume"]) if entry else None
+            if volume:
+                logger.debug("Reusing the seed image %s", volume.name())
+            else:
+                name = f"seed-{digest[:32]}"
+                # A volume left behind by an interrupted upload
+                stale = self._lookup(f"{name}.qcow2")
+                if stale:
+                    stale.delete()
+                volume = self.hv.upload_iso(name, image)
+            with self._lock:
+                index = self._read_index()
+                index[digest] = {
+                    "volume": volume.name(),
+                    "size": image.size,
+                    "used": time.time(),
+                }
+                self._write_index(index)
+                total_size = sum(entry["size"] for entry in index.values())
+        if total_size > SEED_CACHE_MAX_SIZE:
+            self._evict(keep=digest)
+        return volume
+
+    def _evict(self, keep):
+        # The domains are listed without holding the lock
+        in_use = {
+            pathlib.PosixPath(disk).name
+            for record in self.hv.list_domain_records()
+            for disk in record.disks
+        }
+        evicted = []
+        with self._lock:
+            index = self._read_index()
+            total_size = sum(entry["size"] for entry in index.values())
+            for digest, entry in sorted(index.items(), key=lambda i: i[1]["used"]):
+                if total_size <= SEED_CACHE_MAX_SIZE:
+                    break
+                if digest == keep or entry["volume"] in in_use:
+                    continue
+                evicted.append(entry["volume"])
+                del index[digest]
+                total_size -= entry["size"]
+            self._write_index(index)
+        for volume_name in evicted:
+            logger.debug("Removing the seed image %s", volume_name)
+            volume = self._lookup(volume_name)
+            if volume:
+                volume.delete()
+
+
+class NetworkReservations:
+    """The DNS and DHCP host entries of a libvirt network.
+
+    The entries are read once from the network XML and kept in an index.
+    The changes are applied by flush(), or at the end of the outermost
+    batch(), as live updates of the network, so a transient network stays
+    transient. Only the entries this process changed are sent, another vl
+    process may have changed the others.
+    """
+
+    def __init__(self, network_obj):
+        self.network_obj = network_obj
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        root = ET.fromstring(network_obj.XMLDesc(0))
+        self._dns = {
+            host.attrib["ip"]: tuple(e.text for e in host.findall("./hostname"))
+            for host in root.findall("./dns/host[@ip]")
+        }
+        self._dhcp = {}
+        for host in root.findall("./ip/dhcp/host"):
+            key = host.attrib.get("ip") or host.attrib.get("mac")
+            if key:
+                self._dhcp[key] = dict(host.attrib)
+        self._applied_dns = dict(self._dns)
+        self._applied_dhcp = dict(self._dhcp)
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.flush()
+
+    def _changed(self):
+        with self._lock:
+            if not self._batch_depth:
+                self.flush()
+
+    def set_dns_host(self, ip, names):
+        with self._lock:
+            self._dns[str(ip)] = tuple(n for n in names if n)
+            self._changed()
+
+    def set_dhcp_host(self, ip, mac):
+        with self._lock:
+            for key, attrib in list(self._dhcp.items()):
+                if attrib.get("mac") == mac:
+                    del self._dhcp[key]
+            self._dhcp[str(ip)] = {"mac": mac, "ip": str(ip)}
+            self._changed()
+
+    def remove_hosts(self, ips, macs=()):
+        ips = {str(ip) for ip in ips}
+        with self._lock:
+            for ip in ips:
+                self._dns.pop(ip, None)
+            for key, attrib in list(self._dhcp.items()):
+                if attrib.get("ip") in ips or attrib.get("mac") in macs:
+                    del self._dhcp[key]
+            self._changed()
+
+    def mac_addresses(self):
+        with self._lock:
+            return {attrib["mac"] for attrib in self._dhcp.values() if "mac" in attrib}
+
+    @staticmethod
+    def _dns_xml(ip, names):
+        root = ET.fromstring(NETWORK_HOST_ENTRY)
+        root.attrib["ip"] = ip
+        for name in names:
+            ET.SubElement(root, "hostname").text = name
+        return root
+
+    @staticmethod
+    def _dhcp_xml(attrib):
+        root = ET.fromstring(NETWORK_DHCP_ENTRY)
+        root.attrib.update(attrib)
+        return root
+
+    def _update(self, command, section, element):
+        self.network_obj.update(
+            command,
+            section,
+            0,
+            ET.tostring(element).decode(),
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
+        )
+
+    def _delete(self, section, element):
+        try:
+            self._update(libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE, section, element)
+        except libvirt.libvirtError as e:
+            # e.g: already removed by another vl process
+            logger.debug("Cannot remove a network host entry: %s", e)
+
+    def _add(self, section, element):
+        add = libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST
+        try:
+            self._update(add, section, element)
+        except libvirt.libvirtError:
+            # A conflicting entry, e.g: added by another vl process
+            self._delete(section, element)
+            self._update(add, section, element)
+
+    def discard(self):
+        """Forget the pending changes, e.g: the network is about to be destroyed."""
+        with self._lock:
+            self._applied_dns = dict(self._dns)
+            self._applied_dhcp = dict(self._dhcp)
+
+    def flush(self):
+        with self._lock:
+            dns_removed = {
+                k: v for k, v in self._applied_dns.items() if self._dns.get(k) != v
+            }
+            dns_added = {
+                k: v for k, v in self._dns.items() if self._applied_dns.get(k) != v
+            }
+            dhcp_removed = {
+                k: v for k, v in self._applied_dhcp.items() if self._dhcp.get(k) != v
+            }
+            dhcp_added = {
+                k: v for k, v in self._dhcp.items() if self._applied_dhcp.get(k) != v
+            }
+            if not (dns_removed or dns_added or dhcp_removed or dhcp_added):
+                return
+            dns_section = libvirt.VIR_NETWORK_SECTION_DNS_HOST
+            dhcp_section = libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST
+            for ip, names in dns_removed.items():
+                self._delete(dns_section, self._dns_xml(ip, names))
+            for attrib in dhcp_removed.values():
+                self._delete(dhcp_section, self._dhcp_xml(attrib))
+            for ip, names in dns_added.items():
+                self._add(dns_section, self._dns_xml(ip, names))
+            for attrib in dhcp_added.values():
+                self._add(dhcp_section, self._dhcp_xml(attrib))
+            self._applied_dns = dict(self._dns)
+            self._applied_dhcp = dict(self._dhcp)
+
+
 class LibvirtHypervisor:
     def __init__(self, conn):
         if conn is None:
@@ -69,32 +430,48 @@ class LibvirtHypervisor:
             exit(1)
 
         self.conn = conn
-        self._last_free_ipv4 = None
+        self._ipam = {}
+        self._ipam_lock = threading.Lock()
+        self._mac_addresses = set()
+        self._mac_lock = threading.Lock()
+        self._seed_cache = None
         self.storage_pool_obj = None
         self.network_obj = None
+        self._reservations = None
         self.gateway = None
+        self.gateway6 = None
         self.dns = None
         self.network = None
+        self.network6 = None
+        self.host_capabilities = HostCapabilities(conn)
+
+    def clone(self, conn):
+        """Return a hypervisor on another connection, for a worker thread.
+
+        The IPAM, the network reservations and the seed cache are shared
+        with this instance, only the libvirt handles are looked up again.
+        """
+        if self.network_obj:
+            self.reservations  # noqa: B018
+        if self.storage_pool_obj:
+            self.seed_cache  # noqa: B018
+        hv = copy.copy(self)
+        hv.conn = conn
+        if self.network_obj:
+            hv.network_obj = conn.networkLookupByName(self.network_obj.name())
+        if self.storage_pool_obj:
+            hv.storage_pool_obj = conn.storagePoolLookupByName(
+                self.storage_pool_obj.name()
+            )
+        return hv
 
     @property
     def arch(self):
-        caps = self.conn.getCapabilities()
-        root = ET.fromstring(caps)
-        return root.find("./host/cpu/arch").text
+        return self.host_capabilities.values["arch"]
 
     @property
     def domain_type(self):
-        caps = self.conn.getCapabilities()
-        root = ET.fromstring(caps)
-        available = [
-            e.attrib["type"] for e in root.findall("./guest/arch/domain[@type]")
-        ]
-        if not available:
-            raise Exception("No domain type available!")
-        if "kvm" not in available:
-            logger.warning("kvm mode not available!")
-        # Sorted to get kvm before qemu, assume there is no other type
-        return sorted(available)[0]
+        return self.host_capabilities.values["domain_type"]
 
     def create_domain(self, name=None, distro=None):
         if not name:
@@ -102,14 +479,33 @@ class LibvirtHypervisor:
         root = ET.fromstring(DOMAIN_XML)
         root.attrib["type"] = self.domain_type
         root.find("./name").text = name
+        # Also the instance ID of cloud-init, a new domain with the name of
+        # a former one must get a new one, to be provisioned again.
+        root.find("./uuid").text = str(uuid.uuid4())
         root.find("./vcpu").text = str(self.conn.getInfo()[2])
         root.find("./devices/emulator").text = str(self.kvm_binary)
         root.find("./os/type").attrib["arch"] = self.arch
-        dom = self.conn.defineXML(ET.tostring(root).decode())
-        domain = LibvirtDomain(dom)
+        # The domain is only defined by LibvirtDomain.define(), once it's
+        # fully configured.
+        domain = LibvirtDomain(None, metadata={}, conn=self.conn, xml=root)
+        domain.allocate_mac_address = self.allocate_mac_address
         domain.distro = distro
         return domain
 
+    def allocate_mac_address(self, name, index):
+        """Return a MAC derived from the VM name and the NIC index.
+
+        It's hashed again if it's already used by a DHCP host entry of the
+        network, or by another NIC created by this process.
+        """
+        with self._mac_lock:
+            in_use = set(self._mac_addresses)
+            if self.network_obj:
+                in_use |= self.reservations.mac_addresses()
+            mac = _generate_mac_address(name, index, in_use)
+            self._mac_addresses.add(mac)
+        return mac
+
     def configure_domain(self, domain, user_config):
         config = {
             "groups": [],
@@ -162,39 +558,99 @@ class LibvirtHypervisor:
         )
         return config
 
-    def list_domains(self):
-        for i in self.conn.listAllDomains():
-            yield LibvirtDomain(i)
+    def _get_all_domain_stats(self, flags=0):
+        try:
+            return self.conn.getAllDomainStats(DOMAIN_STATS, flags)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+        return [(dom, {}) for dom in self.conn.listAllDomains(flags)]
+
+    def list_domains(self, context=None, flags=0):
+        for dom in self.conn.listAllDomains(flags):
+            if context is not None:
+                metadata = ET.fromstring(dom.XMLDesc(0)).find("./metadata")
+                if _parse_metadata(metadata).get("context") != context:
+                    continue
+            yield LibvirtDomain(dom)
+
+    def list_domain_records(self, context=None, flags=0):
+        """Yield a DomainRecord for each domain.
+
+        The state, vcpu, balloon and interface statistics of all the domains
+        are retrieved in one call, then each domain costs a single XMLDesc()
+        call, its context included.
+        """
+        for dom, stats in self._get_all_domain_stats(flags):
+            record = DomainRecord.from_xml(dom.XMLDesc(0), stats=stats)
+            if context is None or record.context == context:
+                yield record
 
     def get_domain_by_name(self, name):
         try:
             dom = self.conn.lookupByName(name)
             return LibvirtDomain(dom)
         except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return None
-            else:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
                 raise
-
-    def get_free_ipv4(self):
-        used_ips = [self.gateway]
-        for dom in self.list_domains():
-            ipstr = dom.get_metadata("ipv4")
-            if not ipstr:
+        # A running domain cannot be renamed, the name of a VM claimed from
+        # the warm pool is only in its metadata.
+        for dom in self.conn.listAllDomains(0):
+            if not dom.name().startswith(POOL_PREFIX):
                 continue
-            interface = ipaddress.ip_interface(ipstr)
-            used_ips.append(interface)
+            if _get_metadata(dom, "name") == name:
+                return LibvirtDomain(dom)
+        return None
+
+    def get_ipam(self, version=4):
+        with self._ipam_lock:
+            if version not in self._ipam:
+                key, network, gateway = {
+                    4: ("ipv4", self.network, self.gateway),
+                    6: ("ipv6", self.network6, self.gateway6),
+                }[version]
+                state_file = None
+                if self.storage_pool_obj:
+                    state_file = (
+                        self.get_storage_dir()
+                        / "upstream"
+                        / f".ipam-{self.network_obj.name()}-{key}.json"
+                    )
+                ipam = IPAllocator(network, state_file=state_file)
+                used_ips = [gateway.ip]
+                for record in self.list_domain_records():
+                    address = getattr(record, key)
+                    if address:
+                        used_ips.append(address.ip)
+                ipam.reconcile(used_ips)
+                self._ipam[version] = ipam
+            return self._ipam[version]
 
-        for ip in self.network:
-            cidr_ip = f"{ip}/24"
-            interface = ipaddress.IPv4Interface(cidr_ip)
-            if int(interface.ip.exploded.split(".")[3]) < 5:
-                continue
-            if self._last_free_ipv4 and self._last_free_ipv4 >= interface:
-                continue
-            if interface.ip not in [i.ip for i in used_ips]:
-                self._last_free_ipv4 = interface
-                return interface
+    @property
+    def seed_cache(self):
+        if not self._seed_cache:
+            self._seed_cache = SeedCache(self)
+        return self._seed_cache
+
+    def get_free_ipv4(self):
+        return self.get_ipam().allocate()
+
+    def get_free_ipv6(self):
+        if not self.network6:
+            return None
+        return self.get_ipam(version=6).allocate()
+
+    def get_network_interface(self, network_name, address):
+        """Add the prefix length of the network to an address without prefix."""
+        if isinstance(address, (ipaddress.IPv4Interface, ipaddress.IPv6Interface)):
+            return address
+        if "/" in address:
+            return ipaddress.ip_interface(address)
+        version = ipaddress.ip_address(address).version
+        gateway = self.get_network_gateway(network_name, version=version)
+        if not gateway:
+            return address
+        return ipaddress.ip_interface(f"{address}/{gateway.network.prefixlen}")
 
     def get_storage_dir(self):
         xml = self.storage_pool_obj.XMLDesc(0)
@@ -203,17 +659,25 @@ class LibvirtHypervisor:
         return pathlib.PosixPath(disk_source.text)
 
     def get_qcow_virtual_size(self, qcow_path):
-        qemu_img_info = run_cmd(["qemu-img", "info", "--output=json", str(qcow_path)])
-        return math.ceil(json.loads(qemu_img_info)["virtual-size"] / 1024**3)
+        try:
+            virtual_size = qcow2.read_header(qcow_path).virtual_size
+        except PermissionError:
+            # e.g: a volume of the pool, owned by the libvirt user
+            virtual_size = self.conn.storageVolLookupByPath(str(qcow_path)).info()[1]
+        return math.ceil(virtual_size / 1024**3)
 
-    def create_disk(self, name, size=None, backing_on=None):
-        backing_file = None
+    def create_disk(self, name, size=None, backing_on=None, backing_file=None):
         min_size = 0
         if backing_on:
             backing_file = pathlib.PosixPath(
                 f"{self.get_storage_dir()}/upstream/{backing_on}.qcow2"
             )
-            min_size = self.get_qcow_virtual_size(backing_file)
+        if backing_file:
+            try:
+                min_size = self.get_qcow_virtual_size(backing_file)
+            except (FileNotFoundError, qcow2.InvalidImageError):
+                # e.g: a raw image, libvirt would read it as a qcow2 one
+                raise qcow2.BackingFileError(backing_file) from None
         disk_path = pathlib.PosixPath(f"{self.get_storage_dir()}/{name}.qcow2")
 
         if "/" in name:
@@ -289,7 +753,7 @@ class LibvirtHypervisor:
                                 "gateway": str(gateway.ip),
                             }
                         ],
-                        "network_id": domain.dom.UUIDString(),
+                        "network_id": domain.uuid,
                         # Workaround for CloudInit, sources.helpers.openstack read the
                         # subnet DNS from ths dns_nameservers and ignore the
                         # services key.
@@ -306,217 +770,205 @@ class LibvirtHypervisor:
                         "id": f"private-ipv4-{i}",
                         "type": "ipv4_dhcp",
                         "link": f"interface{i}",
-                        "network_id": domain.dom.UUIDString(),
+                        "network_id": domain.uuid,
+                    }
+                )
+            if nic.get("ipv6"):
+                gateway6 = self.get_network_gateway(nic["network"], version=6)
+                openstack_network_data["networks"].append(
+                    {
+                        "id": f"private-ipv6-{i}",
+                        "type": "ipv6",
+                        "link": f"interface{i}",
+                        "ip_address": str(nic["ipv6"].ip),
+                        "netmask": str(nic["ipv6"].netmask.exploded),
+                        "routes": [
+                            {
+                                "network": "::",
+                                "netmask": "::",
+                                "gateway": str(gateway6.ip),
+                            }
+                        ],
+                        "network_id": domain.uuid,
                     }
                 )
 
         return openstack_network_data
 
     def prepare_cloud_init_openstack_iso(self, domain):
-        with tempfile.TemporaryDirectory() as base_temp_dir:
-            temp_dir = pathlib.Path(base_temp_dir)
-            cd_dir = temp_dir / "cd_dir"
-            cd_dir.mkdir()
-
-            openstack_meta_data = {
-                "availability_zone": "nova",
-                "files": [],
-                "hostname": domain.fqdn or domain.name,
-                "launch_index": 0,
-                "local-hostname": domain.name,
-                "name": domain.name,
-                "meta": {},
-                "public_keys": {"default": domain.ssh_key},
-                "uuid": domain.dom.UUIDString(),
-                "admin_pass": domain.root_password,
-            }
-
-            openstack_dir = cd_dir / "openstack" / "latest"
-            openstack_dir.mkdir(parents=True)
-            openstack_metadata_file = openstack_dir / "meta_data.json"
-            with openstack_metadata_file.open("w") as fd:
-                fd.write(json.dumps(openstack_meta_data))
-            openstack_networkdata_file = openstack_dir / "network_data.json"
-            with openstack_networkdata_file.open("w") as fd:
-                fd.write(json.dumps(self.get_openstack_network_data(domain)))
-            openstack_userdata_file = openstack_dir / "user_data"
-            with openstack_userdata_file.open("w") as fd:
-                fd.write("#cloud-config\n")
-                fd.write(yaml.dump(domain.user_data, Dumper=yaml.Dumper))
-
-            cidata_file = temp_dir / f"{domain.name}-cidata.iso"
-            run_cmd(
-                [
-                    str(self.iso_binary),
-                    "-output",
-                    cidata_file.name,
-                    "-ldots",
-                    "-allow-lowercase",
-                    "-allow-multidot",
-                    "-l",
-                    "-publisher",
-                    "virt-lighting",
-                    "-quiet",
-                    "-J",
-                    "-r",
-                    "-V",
-                    "config-2",
-                    str(cd_dir),
-                ],
-                cwd=str(temp_dir),
-            )
+        return self.upload_seed(domain, self.build_cloud_init_openstack_image(domain))
+
+    def build_cloud_init_openstack_image(self, domain):
+        openstack_meta_data = {
+            "availability_zone": "nova",
+            "files": [],
+            "hostname": domain.fqdn or domain.name,
+            "launch_index": 0,
+            "local-hostname": domain.name,
+            "name": domain.name,
+            "meta": {},
+            "public_keys": {"default": domain.ssh_key},
+            "uuid": domain.uuid,
+            "admin_pass": domain.root_password,
+        }
 
-            cdrom = self.create_disk(name=cidata_file.stem, size=1)
-            with cidata_file.open("br") as fd:
-                st = self.conn.newStream(0)
-                cdrom.upload(st, 0, 1024 * 1024)
-                st.send(fd.read())
-                st.finish()
-            return cdrom
+        image = ISOImage("config-2", publisher="virt-lightning")
+        image.add_file(
+            "openstack/latest/meta_data.json", json.dumps(openstack_meta_data)
+        )
+        image.add_file(
+            "openstack/latest/network_data.json",
+            json.dumps(self.get_openstack_network_data(domain)),
+        )
+        image.add_file(
+            "openstack/latest/user_data",
+            "#cloud-config\n" + yaml.dump(domain.user_data, Dumper=yaml.Dumper),
+        )
+        return image
 
     def prepare_cloud_init_nocloud_iso(self, domain):
+        return self.upload_seed(domain, self.build_cloud_init_nocloud_image(domain))
+
+    def build_cloud_init_nocloud_image(self, domain):
         self._network_meta = {"config": "disabled"}
         network_config = []
         for i, nic in enumerate(domain.nics):
             gateway = self.get_network_gateway(nic["network"])
             if nic["ipv4"]:
-                network_config.append(
+                subnets = [
                     {
-                        "type": "physical",
-                        "name": f"eth{i}",
-                        "mac_address": nic["mac"],
-                        "subnets": [
-                            {
-                                "type": "static",
-                                "address": str(nic["ipv4"]),
-                                "gateway": str(gateway.ip),
-                                "dns_nameservers": [str(gateway.ip)],
-                            }
-                        ],
+                        "type": "static",
+                        "address": str(nic["ipv4"]),
+                        "gateway": str(gateway.ip),
+                        "dns_nameservers": [str(gateway.ip)],
                     }
-                )
+                ]
             else:
-                network_config.append(
+                subnets = [{"type": "dhcp"}]
+            if nic.get("ipv6"):
+                gateway6 = self.get_network_gateway(nic["network"], version=6)
+                subnets.append(
                     {
-                        "type": "physical",
-                        "name": f"eth{i}",
-                        "mac_address": nic["mac"],
-                        "subnets": [{"type": "dhcp"}],
+                        "type": "static6",
+                        "address": str(nic["ipv6"]),
+                        "gateway": str(gateway6.ip),
                     }
                 )
+            network_config.append(
+                {
+                    "type": "physical",
+                    "name": f"eth{i}",
+                    "mac_address": nic["mac"],
+                    "subnets": subnets,
+                }
+            )
         domain._network_meta = {"version": 1, "config": network_config}
 
-        with tempfile.TemporaryDirectory() as base_temp_dir:
-            temp_dir = pathlib.Path(base_temp_dir)
-            cd_dir = temp_dir / "cd_dir"
-            cd_dir.mkdir()
-            user_data_file = cd_dir / "user-data"
-            with user_data_file.open("w") as fd:
-                fd.write("#cloud-config\n")
-                fd.write(yaml.dump(domain.user_data, Dumper=yaml.Dumper))
-            meta_data_file = cd_dir / "meta-data"
-            with meta_data_file.open("w") as fd:
-                fd.write(
-                    META_DATA_ENI.format(
-                        name=domain.name,
-                        ipv4=str(domain.ipv4.ip),
-                        gateway=str(self.gateway.ip),
-                        network=str(self.network),
-                    )
-                )
-            network_config_file = cd_dir / "network-config"
-            with network_config_file.open("w") as fd:
-                fd.write(yaml.dump(domain._network_meta, Dumper=yaml.Dumper))
-
-            cidata_file = temp_dir / f"{domain.name}-cidata.iso"
-            run_cmd(
-                [
-                    str(self.iso_binary),
-                    "-output",
-                    cidata_file.name,
-                    "-volid",
-                    "cidata",
-                    "-joliet",
-                    "-R",
-                    str(cd_dir),
-                ],
-                cwd=str(temp_dir),
+        image = ISOImage("cidata")
+        image.add_file(
+            "user-data",
+            "#cloud-config\n" + yaml.dump(domain.user_data, Dumper=yaml.Dumper),
+        )
+        meta_data = META_DATA_ENI.format(
+            name=domain.name,
+            ipv4=str(domain.ipv4.ip),
+            gateway=str(self.gateway.ip),
+            network=str(self.network.network_address),
+            netmask=str(self.network.netmask),
+        )
+        nic = domain.nics[0] if domain.nics else {}
+        if nic.get("ipv6"):
+            gateway6 = self.get_network_gateway(nic["network"], version=6)
+            meta_data += META_DATA_ENI_IPV6.format(
+                ipv6=str(nic["ipv6"].ip),
+                prefixlen=nic["ipv6"].network.prefixlen,
+                gateway6=str(gateway6.ip),
             )
-
-            cdrom = self.create_disk(name=cidata_file.stem, size=1)
-            with cidata_file.open("br") as fd:
-                st = self.conn.newStream(0)
-                cdrom.upload(st, 0, 1024 * 1024)
-                st.send(fd.read())
-                st.finish()
-            return cdrom
-
-    def start(self, domain, metadata_format):
+        image.add_file("meta-data", meta_data)
+        image.add_file(
+            "network-config", yaml.dump(domain._network_meta, Dumper=yaml.Dumper)
+        )
+        return image
+
+    def upload_iso(self, name, image):
+        cdrom = self.create_disk(name=name, size=1)
+        st = self.conn.newStream(0)
+        cdrom.upload(st, 0, image.size)
+        for chunk in image.chunks():
+            st.send(chunk)
+        st.finish()
+        return cdrom
+
+    def build_cloud_init_image(self, domain, metadata_format):
         if metadata_format.get("provider", "") == "nocloud":  # noqa: SIM114
-            cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
+            return self.build_cloud_init_nocloud_image(domain)
         elif domain.distro.startswith("rhel-6") or domain.distro.startswith("centos-6"):
-            cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
+            return self.build_cloud_init_nocloud_image(domain)
         else:  # OpenStack format is the default
-            cloud_init_iso = self.prepare_cloud_init_openstack_iso(domain)
+            return self.build_cloud_init_openstack_image(domain)
+
+    def upload_seed(self, domain, image):
+        """Return the seed volume of the domain.
 
+        A config-2 seed holds the UUID of the domain, its instance ID, so it
+        cannot be shared and it's removed with the domain.
+        """
+        if image.volume_id != "config-2":
+            return self.seed_cache.get(image)
+        name = f"{domain.name}-cidata"
+        try:
+            self.storage_pool_obj.storageVolLookupByName(f"{name}.qcow2").delete()
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+        return self.upload_iso(name, image)
+
+    def attach_seed(self, domain, image):
+        cloud_init_iso = self.upload_seed(domain, image)
         media_type = domain.meta_data_media_type
         domain.attach_disk(cloud_init_iso, device=media_type, disk_type="raw")
+
+    def attach_cloud_init(self, domain, metadata_format):
+        self.attach_seed(domain, self.build_cloud_init_image(domain, metadata_format))
+
+    def boot(self, domain):
+        domain.define()
         domain.dom.create()
-        self.remove_domain_from_network(domain)
-        self.add_domain_to_network(domain)
+        with self.reservations.batch():
+            self.remove_domain_from_network(domain)
+            self.add_domain_to_network(domain)
+
+    def start(self, domain, metadata_format):
+        self.attach_cloud_init(domain, metadata_format)
+        self.boot(domain)
+
+    @property
+    def reservations(self):
+        if not self._reservations:
+            self._reservations = NetworkReservations(self.network_obj)
+        return self._reservations
 
     def add_domain_to_network(self, domain):
-        self.set_dns_entry(domain.ipv4, [domain.name, domain.fqdn])
-        self.set_dhcp_entry(domain.ipv4, domain.nics[0]["mac"])
+        with self.reservations.batch():
+            self.set_dns_entry(domain.ipv4, [domain.name, domain.fqdn])
+            self.set_dhcp_entry(domain.ipv4, domain.nics[0]["mac"])
+            if domain.ipv6:
+                self.set_dns_entry(domain.ipv6, [domain.name, domain.fqdn])
 
     def remove_domain_from_network(self, domain):
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
         if not domain.ipv4:
             return
-        for host in root.findall("./dns/host[@ip]"):
-            if host.attrib["ip"] != str(domain.ipv4.ip):
-                continue
-            xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
-                libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
-                libvirt.VIR_NETWORK_SECTION_DNS_HOST,
-                0,
-                xml,
-                libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
-            )
-
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
-        for host in root.findall("./ip/dhcp/host[@ip]"):
-            if host.attrib["ip"] != str(domain.ipv4.ip):
-                continue
-            xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
-                libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
-                libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
-                0,
-                xml,
-                libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
-            )
-
-        domain_root = ET.fromstring(domain.dom.XMLDesc(0))
-        ifaces = domain_root.findall("./devices/interface/mac[@address]")
-        domain_macs = [iface.attrib["address"] for iface in ifaces]
-
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
-        for host in root.findall("./ip/dhcp/host[@mac]"):
-            if host.attrib["mac"] not in domain_macs:
-                continue
-            xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
-                libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
-                libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
-                0,
-                xml,
-                libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
-            )
+        domain_ips = [domain.ipv4.ip]
+        if domain.ipv6:
+            domain_ips.append(domain.ipv6.ip)
+        self.reservations.remove_hosts(domain_ips, macs=domain.mac_addresses)
 
     def clean_up(self, domain):
         self.remove_domain_from_network(domain)
+        if 4 in self._ipam and domain.ipv4:
+            self._ipam[4].release(domain.ipv4)
+        if 6 in self._ipam and domain.ipv6:
+            self._ipam[6].release(domain.ipv6)
         xml = domain.dom.XMLDesc(0)
         state, _ = domain.dom.state()
         if state != libvirt.VIR_DOMAIN_SHUTOFF:
@@ -527,8 +979,11 @@ class LibvirtHypervisor:
 
         self.storage_pool_obj.refresh()
         root = ET.fromstring(xml)
+        seed_volumes = self.seed_cache.volumes()
         for disk in root.findall("./devices/disk[@type='file']/source[@file]"):
             filepath = pathlib.PosixPath(disk.attrib["file"])
+            if filepath.name in seed_volumes:
+                continue
             if filepath.exists():
                 logger.debug("Purge volume: %s", str(filepath))
                 vol = self.storage_pool_obj.storageVolLookupByName(filepath.name)
@@ -536,28 +991,13 @@ class LibvirtHypervisor:
 
     @property
     def kvm_binary(self):
+        kvm_binary = self.host_capabilities.values["kvm_binary"]
+        if kvm_binary:
+            return pathlib.PosixPath(kvm_binary)
         paths = [pathlib.PosixPath(i) for i in KVM_BINARIES]
-        for i in paths:
-            if i.exists():
-                return i
         raise Exception("Failed to find the kvm binary in: ", paths)
 
-    @property
-    def iso_binary(self):
-        paths = [pathlib.PosixPath(i) for i in os.environ["PATH"].split(os.pathsep)]
-        for i in paths:
-            for binary in ISO_BINARIES:
-                exe = i / binary
-                if exe.exists():
-                    return exe
-        error_msg = (
-            f"Failed to find {' or '.join(ISO_BINARIES)} in "
-            f"{', '.join([x.as_posix() for x in paths])} "
-            "\nPlease install genisoimage tool"
-        )
-        raise Exception(error_msg)
-
-    def init_network(self, network_name, network_cidr):
+    def init_network(self, network_name, network_cidr, network_ipv6_cidr=None):
         try:
             self.network_obj = self.conn.networkLookupByName(network_name)
         except libvirt.libvirtError as e:
@@ -565,13 +1005,19 @@ class LibvirtHypervisor:
                 raise (e)
 
         if not self.network_obj:
-            self.network_obj = self.create_network(network_name, network_cidr)
+            self.network_obj = self.create_network(
+                network_name, network_cidr, network_ipv6_cidr
+            )
 
         if not self.network_obj.isActive():
             self.network_obj.create()
+        self._reservations = None
         self.gateway = self.get_network_gateway(network_name)
         self.dns = self.gateway
         self.network = self.gateway.network
+        self.gateway6 = self.get_network_gateway(network_name, version=6)
+        if self.gateway6:
+            self.network6 = self.gateway6.network
 
     def get_network_by_name(self, network_name):
         try:
@@ -580,12 +1026,15 @@ class LibvirtHypervisor:
             if e.get_error_code() != libvirt.VIR_ERR_NO_NETWORK:
                 raise (e)
 
-    def get_network_gateway(self, network_name):
+    def get_network_gateway(self, network_name, version=4):
         network_obj = self.get_network_by_name(network_name)
         xml = network_obj.XMLDesc(0)
         root = ET.fromstring(xml)
-        ip = root.find("./ip")
-        return ipaddress.IPv4Interface("{address}/{netmask}".format(**ip.attrib))
+        for ip in root.findall("./ip[@address]"):
+            if ip.attrib.get("family", "ipv4") != f"ipv{version}":
+                continue
+            prefix = ip.attrib.get("prefix") or ip.attrib.get("netmask")
+            return ipaddress.ip_interface(f"{ip.attrib['address']}/{prefix}")
 
     def reuse_mac_address(self, network_name, domain_name, ipv4):
         network_obj = self.get_network_by_name(network_name)
@@ -593,7 +1042,7 @@ class LibvirtHypervisor:
             if lease["hostname"] == domain_name and lease["ipaddr"] == str(ipv4.ip):
                 return lease["mac"]
 
-    def create_network(self, network_name, network_cidr):
+    def create_network(self, network_name, network_cidr, network_ipv6_cidr=None):
         network = ipaddress.ip_network(network_cidr)
         root = ET.fromstring(NETWORK_XML)
         root.find("./name").text = network_name
@@ -602,6 +1051,15 @@ class LibvirtHypervisor:
             "address": network[1].exploded,
             "netmask": network.netmask.exploded,
         }
+        if network_ipv6_cidr:
+            network6 = ipaddress.ip_network(network_ipv6_cidr)
+            ET.SubElement(
+                root,
+                "ip",
+                family="ipv6",
+                address=network6[1].compressed,
+                prefix=str(network6.prefixlen),
+            )
         xml = ET.tostring(root).decode()
         return self.conn.networkCreateXML(xml)
 
@@ -654,37 +1112,194 @@ class LibvirtHypervisor:
         return [path.stem for path in sorted(path.glob("*.qcow2"))]
 
     def set_dns_entry(self, ipv4, names=None):
-        root = ET.fromstring(NETWORK_HOST_ENTRY)
-        for name in names:
-            if name:
-                ET.SubElement(root, "hostname").text = name
-        root.attrib["ip"] = str(ipv4.ip)
-        xml = ET.tostring(root).decode()
-        self.network_obj.update(
-            libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
-            libvirt.VIR_NETWORK_SECTION_DNS_HOST,
-            0,
-            xml,
-            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
-        )
+        self.reservations.set_dns_host(ipv4.ip, names or [])
 
     def set_dhcp_entry(self, ipv4, mac=None):
-        root = ET.fromstring(NETWORK_DHCP_ENTRY)
-        root.attrib["mac"] = mac
-        root.attrib["ip"] = str(ipv4.ip)
-        xml = ET.tostring(root).decode()
-        self.network_obj.update(
-            libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
-            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
-            0,
-            xml,
-            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
+        self.reservations.set_dhcp_host(ipv4.ip, mac)
+
+
+def _get_legacy_metadata(dom, k):
+    try:
+        xml = dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, k)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return None
+        raise (e)
+    elt = ET.fromstring(xml)
+    return elt.attrib["name"]
+
+
+def _read_metadata(dom):
+    """Return the metadata of a domain, or None if it uses the per-key layout."""
+    try:
+        xml = dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, METADATA_NS)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return None
+        raise (e)
+    return dict(ET.fromstring(xml).attrib)
+
+
+def _get_metadata(dom, k):
+    values = _read_metadata(dom)
+    if values is None:
+        return _get_legacy_metadata(dom, k)
+    return values.get(k)
+
+
+def _parse_metadata(metadata):
+    """Extract the virt-lightning values from a <metadata> element.
+
+    The values are the attributes of a single element of the METADATA_NS
+    namespace. Older versions used one <vl:key name="value"/> element per key,
+    with the key as namespace URI.
+    """
+    values = {}
+    legacy_values = {}
+    if metadata is None:
+        return values
+    for elt in metadata:
+        ns, _, tag = elt.tag.lstrip("{").rpartition("}")
+        if ns == METADATA_NS:
+            values.update(elt.attrib)
+        elif ns == tag and "name" in elt.attrib:
+            # e.g: <vl:distro xmlns:vl="distro" name="fedora-41"/>
+            legacy_values[tag] = elt.attrib["name"]
+    return values or legacy_values
+
+
+def _parse_memory(memory):
+    unit = memory.attrib.get("unit", "KiB")
+    if unit == "KiB":
+        return int(int(memory.text) / 1024)
+    elif unit == "MiB":
+        return int(int(memory.text))
+
+
+class DomainRecord:
+    """Read-only view of a domain, built from a single XMLDesc() call."""
+
+    __slots__ = (
+        "active",
+        "additional_nics",
+        "context",
+        "disks",
+        "distro",
+        "fqdn",
+        "groups",
+        "ipv4",
+        "ipv6",
+        "mac_addresses",
+        "memory",
+        "name",
+        "python_interpreter",
+        "state",
+        "stats",
+        "username",
+        "uuid",
+        "vcpus",
+    )
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            object.__setattr__(self, k, kwargs.get(k))
+
+    def __setattr__(self, k, v):
+        raise AttributeError(f"DomainRecord is read-only, cannot set {k}")
+
+    @classmethod
+    def from_xml(cls, xml, stats=None):
+        root = ET.fromstring(xml)
+        stats = stats or {}
+        metadata = _parse_metadata(root.find("./metadata"))
+        vcpu = root.find("./vcpu")
+        ipv4 = metadata.get("ipv4")
+        ipv6 = metadata.get("ipv6")
+        groups = metadata.get("groups")
+        memory = _parse_memory(root.find("./memory"))
+        if "balloon.current" in stats:
+            memory = int(stats["balloon.current"] / 1024)
+        vcpus = int(vcpu.attrib.get("current", vcpu.text))
+        if "vcpu.current" in stats:
+            vcpus = stats["vcpu.current"]
+        state = stats.get("state.state")
+        if state is None:
+            state = (
+                libvirt.VIR_DOMAIN_RUNNING
+                if root.get("id") is not None
+                else libvirt.VIR_DOMAIN_SHUTOFF
+            )
+        return cls(
+            active=state != libvirt.VIR_DOMAIN_SHUTOFF,
+            additional_nics=metadata.get("additional_nics") or None,
+            context=metadata.get("context"),
+            disks=[
+                e.attrib["file"]
+                for e in root.findall("./devices/disk[@type='file']/source[@file]")
+            ],
+            distro=metadata.get("distro"),
+            fqdn=metadata.get("fqdn"),
+            groups=groups.split(",") if groups else [],
+            ipv4=ipaddress.IPv4Interface(ipv4) if ipv4 else None,
+            ipv6=ipaddress.IPv6Interface(ipv6) if ipv6 else None,
+            mac_addresses=[
+                e.attrib["address"]
+                for e in root.findall("./devices/interface/mac[@address]")
+            ],
+            memory=memory,
+            name=metadata.get("name") or root.find("./name").text,
+            python_interpreter=metadata.get("python_interpreter"),
+            state=state,
+            stats=stats,
+            username=metadata.get("username"),
+            uuid=root.find("./uuid").text,
+            vcpus=vcpus,
         )
 
+    def __gt__(self, other):
+        return self.name > other.name
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def exec_ssh(self):
+        os.execlp(
+            "ssh",
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            f"{self.username}@{self.ipv4.ip}",
+        )
+
+
+def _generate_mac_address(name, index, in_use=()):
+    # Only 24 bits, a collision is likely with a few thousands of NICs
+    for attempt in itertools.count():
+        key = f"{name}-{index}-{attempt}" if attempt else f"{name}-{index}"
+        digest = hashlib.sha256(key.encode()).digest()
+        mac = "52:54:00:" + ":".join(f"{b:02x}" for b in digest[0:3])
+        if mac not in in_use:
+            return mac
+
 
 class LibvirtDomain:
-    def __init__(self, dom):
+    """A libvirt domain.
+
+    A domain created by LibvirtHypervisor.create_domain() is not defined yet,
+    its configuration is assembled in memory and submitted to libvirt
+    with a single defineXML() call by define().
+    """
+
+    def __init__(self, dom, metadata=None, conn=None, xml=None):
         self.dom = dom
+        self._conn = conn
+        self._xml = xml
+        self._metadata = metadata
+        self._legacy_metadata_keys = []
+        self._metadata_dirty = False
+        self._metadata_batch = 0
         self.user_data = {
             "resize_rootfs": True,
             "disable_root": 0,
@@ -696,6 +1311,7 @@ class LibvirtDomain:
         self._ssh_key = None
         self.default_nic_model = None
         self.nics = []
+        self.allocate_mac_address = _generate_mac_address
         self.meta_data_media_type = None
         self.default_bus_type = None
 
@@ -789,14 +1405,53 @@ class LibvirtDomain:
 
         self.record_metadata("username", username)
 
+    def define(self):
+        if self.dom is not None:
+            return
+        self.flush_metadata()
+        self.dom = self._conn.defineXML(ET.tostring(self._xml).decode())
+        self._xml = None
+
+    def _config_root(self):
+        if self.dom is None:
+            return self._xml
+        return ET.fromstring(self.dom.XMLDesc(0))
+
+    def _attach_device(self, element):
+        if self.dom is None:
+            self._xml.find("./devices").append(element)
+        else:
+            xml = ET.tostring(element).decode()
+            self.dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
     @property
     def name(self):
-        return self.dom.name()
+        if self.dom is None:
+            return self._xml.find("./name").text
+        name = self.dom.name()
+        if name.startswith(POOL_PREFIX):
+            return self.get_metadata("name") or name
+        return name
 
     @name.setter
     def name(self, name):
         self.user_data["name"] = name
-        self.dom.rename(name, 0)
+        if self.dom is None:
+            self._xml.find("./name").text = name
+        else:
+            self.dom.rename(name, 0)
+
+    @property
+    def uuid(self):
+        if self.dom is None:
+            return self._xml.find("./uuid").text
+        return self.dom.UUIDString()
+
+    @property
+    def mac_addresses(self):
+        root = self._config_root()
+        ifaces = root.findall("./devices/interface/mac[@address]")
+        return [iface.attrib["address"] for iface in ifaces]
 
     @property
     def fqdn(self):
@@ -813,32 +1468,32 @@ class LibvirtDomain:
 
     @property
     def vcpus(self):
-        xml = self.dom.XMLDesc(0)
-        root = ET.fromstring(xml)
+        root = self._config_root()
         vcpu = root.findall("./vcpu")[0]
         return int(vcpu.attrib.get("current", vcpu.text))
 
     @vcpus.setter
     def vcpus(self, value=1):
-        self.dom.setVcpusFlags(value, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        if self.dom is None:
+            self._xml.find("./vcpu").attrib["current"] = str(value)
+        else:
+            self.dom.setVcpusFlags(value, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
 
     @property
     def memory(self):
-        xml = self.dom.XMLDesc(0)
-        root = ET.fromstring(xml)
-        memory = root.findall("./memory")[0]
-        unit = memory.attrib["unit"]
-
-        if unit == "KiB":
-            return int(int(memory.text) / 1024)
-        elif unit == "MiB":
-            return int(int(memory.text))
+        root = self._config_root()
+        return _parse_memory(root.findall("./memory")[0])
 
     @memory.setter
     def memory(self, value):
         if value < 256:
             logger.warning(f"low memory: {value}MB for VM {self.name}")
         value *= 1024
+        if self.dom is None:
+            for path in ("./memory", "./currentMemory"):
+                self._xml.find(path).attrib = {"unit": "KiB"}
+                self._xml.find(path).text = str(value)
+            return
         self.dom.setMemoryFlags(
             value, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_MEM_MAXIMUM
         )
@@ -850,25 +1505,67 @@ class LibvirtDomain:
             self.blockdev.reverse()
         return f"vd{self.blockdev.pop()}"
 
-    def record_metadata(self, k, v):
-        meta = f"<{k} name='{v}' />"
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            values = _read_metadata(self.dom)
+            if values is None:
+                root = ET.fromstring(self.dom.XMLDesc(0))
+                values = _parse_metadata(root.find("./metadata"))
+                self._legacy_metadata_keys = list(values)
+            self._metadata = values
+        return self._metadata
+
+    @contextlib.contextmanager
+    def batch_metadata(self):
+        """Write the metadata only once, when the outermost batch ends."""
+        self._metadata_batch += 1
+        try:
+            yield
+        finally:
+            self._metadata_batch -= 1
+        if not self._metadata_batch:
+            self.flush_metadata()
+
+    def flush_metadata(self):
+        if not self._metadata_dirty:
+            return
+        if self.dom is None:
+            metadata = self._xml.find("./metadata")
+            if metadata is None:
+                metadata = ET.SubElement(self._xml, "metadata")
+            for elt in metadata.findall(f"./{{{METADATA_NS}}}instance"):
+                metadata.remove(elt)
+            ET.SubElement(metadata, f"{{{METADATA_NS}}}instance", self.metadata)
+            self._metadata_dirty = False
+            return
+        root = ET.Element("instance", self.metadata)
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if self.dom.isActive():
+            # The live XML is the one listed, e.g: a claimed warm pool VM
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
         self.dom.setMetadata(
             libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-            meta,
+            ET.tostring(root).decode(),
             "vl",
-            k,
-            libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+            METADATA_NS,
+            flags,
         )
+        for k in self._legacy_metadata_keys:
+            self.dom.setMetadata(
+                libvirt.VIR_DOMAIN_METADATA_ELEMENT, None, None, k, flags
+            )
+        self._legacy_metadata_keys = []
+        self._metadata_dirty = False
+
+    def record_metadata(self, k, v):
+        self.metadata[k] = str(v)
+        self._metadata_dirty = True
+        if not self._metadata_batch:
+            self.flush_metadata()
 
     def get_metadata(self, k):
-        try:
-            xml = self.dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, k)
-        except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
-                return None
-            raise (e)
-        elt = ET.fromstring(xml)
-        return elt.attrib["name"]
+        return self.metadata.get(k)
 
     @property
     def context(self):
@@ -902,8 +1599,7 @@ class LibvirtDomain:
         disk_root.findall("./driver")[0].attrib = {"name": "qemu", "type": disk_type}
         disk_root.findall("./source")[0].attrib = {"file": volume.path()}
         disk_root.findall("./target")[0].attrib = {"dev": device_name, "bus": bus}
-        xml = ET.tostring(disk_root).decode()
-        self.dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        self._attach_device(disk_root)
         return device_name
 
     def attach_network(
@@ -911,6 +1607,7 @@ class LibvirtDomain:
         network=None,
         nic_model=None,
         ipv4=None,
+        ipv6=None,
         mac=None,
         bridge=None,
         virtualport_type=None,
@@ -930,9 +1627,10 @@ class LibvirtDomain:
         if virtualport_type:
             net_root.append(ET.Element("virtualport", type=virtualport_type))
 
-        if mac:
-            mac_el = ET.SubElement(net_root, "mac")
-            mac_el.attrib = {"address": mac}
+        if not mac:
+            mac = self.allocate_mac_address(self.name, len(self.nics))
+        mac_el = ET.SubElement(net_root, "mac")
+        mac_el.attrib = {"address": mac}
 
         if not ipv4:
             if not self.nics:
@@ -940,11 +1638,23 @@ class LibvirtDomain:
             ipv4_instance = None  # DHCP
         elif isinstance(ipv4, ipaddress.IPv4Interface):
             ipv4_instance = ipv4
-        elif ipv4 and "/" not in ipv4:
+        elif "/" not in ipv4:
+            # e.g: a bridge, or a libvirt network without <ip> element
+            logger.warning(
+                "%s: no prefix length for %s, assuming %s/24", self.name, ipv4, ipv4
+            )
             ipv4_instance = ipaddress.IPv4Interface(ipv4 + "/24")
-        elif ipv4:
+        else:
             ipv4_instance = ipaddress.IPv4Interface(ipv4)
-        self.nics.append({"network": network, "ipv4": ipv4_instance})
+        ipv6_instance = ipaddress.IPv6Interface(ipv6) if ipv6 else None
+        self.nics.append(
+            {
+                "network": network,
+                "ipv4": ipv4_instance,
+                "ipv6": ipv6_instance,
+                "mac": mac,
+            }
+        )
 
         # add metadata for the additional NICs
         if len(self.nics) > 1:
@@ -953,15 +1663,10 @@ class LibvirtDomain:
             self.additional_nics = add_nics
 
         self.ipv4 = self.nics[0]["ipv4"]
+        if len(self.nics) == 1 and ipv6_instance:
+            self.ipv6 = ipv6_instance
 
-        xml = ET.tostring(net_root).decode()
-        self.dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
-
-        xml = self.dom.XMLDesc(0)
-        root = ET.fromstring(xml)
-        ifaces = root.findall("./devices/interface/mac[@address]")
-        for i, iface in enumerate(ifaces):
-            self.nics[i]["mac"] = iface.attrib["address"]
+        self._attach_device(net_root)
 
     def add_root_disk(self, root_disk_path):
         self.attach_disk(root_disk_path)
@@ -975,6 +1680,15 @@ class LibvirtDomain:
     def ipv4(self, value):
         self.record_metadata("ipv4", value)
 
+    @property
+    def ipv6(self):
+        if self.get_metadata("ipv6"):
+            return ipaddress.IPv6Interface(self.get_metadata("ipv6"))
+
+    @ipv6.setter
+    def ipv6(self, value):
+        self.record_metadata("ipv6", value)
+
     @property
     def additional_nics(self):
         if self.get_metadata("additional_nics"):
@@ -1007,32 +1721,95 @@ class LibvirtDomain:
     def set_user_password(self, user, password):
         return self.dom.setUserPassword(user, password)
 
+    def add_authorized_keys(self, user, keys):
+        self.dom.authorizedSSHKeysSet(
+            user, keys, libvirt.VIR_DOMAIN_AUTHORIZED_SSH_KEYS_SET_APPEND
+        )
+
+    def _agent_command(self, execute, arguments):
+        command = {"execute": execute, "arguments": arguments}
+        return json.loads(
+            libvirt_qemu.qemuAgentCommand(
+                self.dom, json.dumps(command), AGENT_TIMEOUT, 0
+            )
+        )
+
+    def agent_exec(self, path, args):
+        return self._agent_command("guest-exec", {"path": path, "arg": args})
+
+    def agent_run(self, path, args, timeout=AGENT_TIMEOUT):
+        """Run a command through the guest agent, return its exit code.
+
+        None is returned if the command is still running after timeout.
+        """
+        pid = self.agent_exec(path, args)["return"]["pid"]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = self._agent_command("guest-exec-status", {"pid": pid})
+            if status["return"]["exited"]:
+                return status["return"].get("exitcode")
+            time.sleep(0.2)
+        return None
+
     def __gt__(self, other):
         return self.name > other.name
 
     def __lt__(self, other):
         return self.name < other.name
 
-    async def reachable(self):
-        while True:
-            try:
-                reader, _ = await asyncio.open_connection(str(self.ipv4.ip), 22)
-                data = await reader.read(10)
-                if data.decode().startswith("SSH"):
-                    logger.info(
-                        f"{symbols.COMPUTER.value} {self.name} found at {self.ipv4.ip}!"
-                    )
-                    return
-            except OSError:
-                pass
+    def get_agent_ipv4(self):
+        """Return the IPv4 of the first NIC, as reported by the guest agent."""
+        try:
+            interfaces = self.dom.interfaceAddresses(
+                libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT
+            )
+        except libvirt.libvirtError as e:
+            logger.debug("%s: cannot query the guest agent: %s", self.name, e)
+            return None
+        macs = self.mac_addresses[:1]
+        for interface in interfaces.values():
+            if interface.get("hwaddr") not in macs:
+                continue
+            for addr in interface.get("addrs") or []:
+                if addr["type"] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    return addr["addr"]
+        return None
+
+    async def reachable(self, prober=None, timeout=None, events=None):
+        prober = prober or SSHProber()
+        loop = asyncio.get_running_loop()
+
+        async def resolve():
+            return await loop.run_in_executor(None, self.get_agent_ipv4)
+
+        # Resolved once, the metadata are not read again by the probes
+        address = str(self.ipv4.ip) if self.ipv4 else None
+        result = await prober.wait(
+            self.name,
+            address,
+            timeout=timeout,
+            agent=events.future(self.name) if events else None,
+            resolve=resolve,
+        )
+        if result.ready:
+            logger.info(
+                f"{symbols.COMPUTER.value} {self.name} found at {result.address}! "
+                f"({result.elapsed:.1f}s)"
+            )
+        else:
+            logger.error(
+                "%s is not reachable at %s after %.0fs",
+                self.name,
+                result.address,
+                result.elapsed,
+            )
+        return result
+
+    def snapshot(self):
+        if self.dom is None:
+            self.flush_metadata()
+            return DomainRecord.from_xml(ET.tostring(self._xml).decode())
+        return DomainRecord.from_xml(self.dom.XMLDesc(0))
 
     def exec_ssh(self):
-        os.execlp(
-            "ssh",
-            "ssh",
-            "-o",
-            "StrictHostKeyChecking=no",
-            "-o",
-            "UserKnownHostsFile=/dev/null",
-            f"{self.username}@{self.ipv4.ip}",
-        )
+        self.snapshot().exec_ssh()
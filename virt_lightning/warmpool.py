@@ -0,0 +1,160 @@
+import contextlib
+import fcntl
+import logging
+import pathlib
+import re
+import subprocess
+import sys
+import threading
+import uuid
+
+import libvirt
+
+import virt_lightning.virt_lightning as vl
+from virt_lightning.symbols import get_symbols
+
+logger = logging.getLogger("virt_lightning")
+symbols = get_symbols()
+
+# The context of the VMs waiting in the pool
+POOL_CONTEXT = "vl-pool"
+# The keys of a host that can still be applied once the VM has booted
+CLAIMABLE_KEYS = {
+    "distro",
+    "groups",
+    "memory",
+    "name",
+    "root_password",
+    "ssh_key_file",
+    "username",
+}
+
+
+@contextlib.contextmanager
+def _flock(name, blocking=True):
+    path = pathlib.Path(vl.CACHE_DIR).expanduser() / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class WarmPool:
+    """Booted VMs of the distros of the warm_pool configuration key.
+
+    A VM of the pool is claimed by a host of the same distro and memory.
+    Since a running domain cannot be renamed, the host name is only an
+    alias in the metadata. The SSH key and the root password are applied
+    through the guest agent. The claimed VMs are replaced in the
+    background.
+    """
+
+    def __init__(self, hv, configuration):
+        self.hv = hv
+        self.configuration = configuration
+        self.pools = configuration.warm_pool
+        self.claimed = 0
+        self._lock = threading.Lock()
+
+    def members(self):
+        return [
+            record
+            for record in self.hv.list_domain_records(context=POOL_CONTEXT)
+            if record.active
+        ]
+
+    def missing(self):
+        """Return the hosts to start to fill the pool."""
+        count = {}
+        for record in self.members():
+            count[record.distro] = count.get(record.distro, 0) + 1
+        hosts = []
+        for distro, pool in self.pools.items():
+            prefix = vl.POOL_PREFIX + re.sub(r"[^a-zA-Z0-9-]+", "", distro)
+            for _ in range(pool["count"] - count.get(distro, 0)):
+                hosts.append(
+                    {
+                        "distro": distro,
+                        "name": f"{prefix}-{uuid.uuid4().hex[:6]}",
+                        "memory": pool["memory"],
+                    }
+                )
+        return hosts
+
+    def matches(self, host):
+        pool = self.pools.get(host.get("distro"))
+        if not pool or set(host) - CLAIMABLE_KEYS:
+            return False
+        return host.get("memory") in (None, pool["memory"])
+
+    def claim(self, host, context):
+        """Return a VM of the pool configured for the host, or None."""
+        if not self.matches(host):
+            return None
+        # Also locked between the vl processes
+        with self._lock, _flock("warm-pool.lock"):
+            for record in self.members():
+                if record.distro != host["distro"]:
+                    continue
+                if host.get("username") not in (None, record.username):
+                    continue
+                domain = self.hv.get_domain_by_name(record.name)
+                try:
+                    self._apply(domain, host, context)
+                except (OSError, libvirt.libvirtError) as e:
+                    logger.warning("Cannot claim %s: %s", record.name, e)
+                    continue
+                logger.info(
+                    "%s %s claimed from the warm pool (%s)",
+                    symbols.LIGHTNING.value,
+                    host["name"],
+                    record.name,
+                )
+                self.claimed += 1
+                return domain
+        return None
+
+    def _apply(self, domain, host, context):
+        name = host["name"]
+        ssh_key_file = host.get("ssh_key_file", self.configuration.ssh_key_file)
+        if ssh_key_file != self.configuration.ssh_key_file:
+            keys = pathlib.Path(ssh_key_file).expanduser().read_text().splitlines()
+            domain.add_authorized_keys(domain.username, keys)
+        root_password = host.get("root_password")
+        if root_password and root_password != domain.root_password:
+            domain.set_user_password("root", root_password)
+        try:
+            domain.agent_exec("hostnamectl", ["set-hostname", name])
+        except libvirt.libvirtError as e:
+            logger.debug("%s: cannot set the hostname: %s", name, e)
+        with domain.batch_metadata():
+            domain.record_metadata("name", name)
+            domain.context = context
+            domain.groups = host.get("groups") or []
+            if root_password:
+                domain.record_metadata("root_password", root_password)
+        self.hv.set_dns_entry(domain.ipv4, [name])
+
+    def refill_in_background(self):
+        command = [sys.executable, "-m", "virt_lightning.shell"]
+        if self.configuration.config_file:
+            command += ["--config", str(self.configuration.config_file)]
+        subprocess.Popen(
+            [*command, "warm_pool"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    @staticmethod
+    def filling():
+        """Lock held while the pool is filled, False if already taken."""
+        return _flock("warm-pool-fill.lock", blocking=False)
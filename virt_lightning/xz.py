@@ -0,0 +1,203 @@
+import itertools
+import lzma
+import struct
+import zlib
+
+HEADER_MAGIC = b"\xfd7zXZ\x00"
+FOOTER_MAGIC = b"YZ"
+HEADER_SIZE = 12
+FOOTER_SIZE = 12
+# The input fed to the decoder at once, and the maximum size of its output
+CHUNK_SIZE = 1024 * 1024
+
+
+class XzError(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def _crc32(data):
+    return struct.pack("<I", zlib.crc32(data))
+
+
+def _read_varint(data, pos):
+    value = 0
+    for i in range(9):
+        byte = data[pos + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise XzError("invalid integer")
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _pad4(size):
+    return (size + 3) & ~3
+
+
+def stream_header(check):
+    flags = bytes([0, check])
+    return HEADER_MAGIC + flags + _crc32(flags)
+
+
+def parse_stream_header(data):
+    """Return the check type of a stream header."""
+    if len(data) < HEADER_SIZE or data[:6] != HEADER_MAGIC:
+        raise XzError("not a .xz file")
+    if _crc32(data[6:8]) != data[8:12]:
+        raise XzError("corrupted stream header")
+    return data[7]
+
+
+def encode_index(records):
+    """Return the index of the (unpadded size, uncompressed size) records."""
+    index = b"\0" + _varint(len(records))
+    for unpadded_size, uncompressed_size in records:
+        index += _varint(unpadded_size) + _varint(uncompressed_size)
+    index += b"\0" * (_pad4(len(index)) - len(index))
+    return index + _crc32(index)
+
+
+def stream_footer(index_size, check):
+    data = struct.pack("<I", index_size // 4 - 1) + bytes([0, check])
+    return _crc32(data) + data + FOOTER_MAGIC
+
+
+def parse_stream_footer(data):
+    """Return the size of the index and the check type of a stream footer."""
+    if len(data) != FOOTER_SIZE or data[10:] != FOOTER_MAGIC:
+        raise XzError("no stream footer")
+    if _crc32(data[4:10]) != data[:4]:
+        raise XzError("corrupted stream footer")
+    (backward_size,) = struct.unpack_from("<I", data, 4)
+    return (backward_size + 1) * 4, data[9]
+
+
+class XzBlock:
+    def __init__(self, offset, unpadded_size, uncompressed_offset, uncompressed_size):
+        self.offset = offset
+        self.unpadded_size = unpadded_size
+        self.uncompressed_offset = uncompressed_offset
+        self.uncompressed_size = uncompressed_size
+
+    @property
+    def size(self):
+        """The size of the block in the file, with its padding."""
+        return _pad4(self.unpadded_size)
+
+
+class XzIndex:
+    """The blocks of a .xz stream.
+
+    A .xz stream is a header, a list of independent blocks, an index of the
+    sizes of the blocks, and a footer. With the index, a download can resume
+    from the start of any block.
+    """
+
+    def __init__(self, check, blocks, index_offset):
+        self.check = check
+        self.blocks = blocks
+        self.index_offset = index_offset
+
+    @property
+    def uncompressed_size(self):
+        return sum(block.uncompressed_size for block in self.blocks)
+
+
+def parse_index(data, check):
+    """Return the XzIndex of the index of a stream starting at offset 0."""
+    if data[0] != 0 or _crc32(data[:-4]) != data[-4:]:
+        raise XzError("corrupted index")
+    count, pos = _read_varint(data, 1)
+    blocks = []
+    offset = HEADER_SIZE
+    uncompressed_offset = 0
+    for _ in range(count):
+        unpadded_size, pos = _read_varint(data, pos)
+        uncompressed_size, pos = _read_varint(data, pos)
+        blocks.append(
+            XzBlock(offset, unpadded_size, uncompressed_offset, uncompressed_size)
+        )
+        offset += blocks[-1].size
+        uncompressed_offset += uncompressed_size
+    return XzIndex(check, blocks, offset)
+
+
+def read_index(read, length):
+    """Return the XzIndex of a file of length bytes.
+
+    read(offset, size) returns the bytes of the file at offset. Only the
+    files made of a single stream are supported.
+    """
+    if length < HEADER_SIZE + FOOTER_SIZE:
+        raise XzError("not a .xz file")
+    check = parse_stream_header(read(0, HEADER_SIZE))
+    index_size, footer_check = parse_stream_footer(
+        read(length - FOOTER_SIZE, FOOTER_SIZE)
+    )
+    index_offset = length - FOOTER_SIZE - index_size
+    if footer_check != check or index_offset < HEADER_SIZE:
+        raise XzError("several streams")
+    index = parse_index(read(index_offset, index_size), check)
+    if index.index_offset != index_offset:
+        raise XzError("several streams")
+    return index
+
+
+def decompress(chunks):
+    """Yield the uncompressed data of the concatenated .xz streams of chunks."""
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    # The null bytes after the last stream, a multiple of 4 between streams
+    padding = 0
+    for data in chunks:
+        while True:
+            if decompressor.eof:
+                stripped = data.lstrip(b"\0")
+                padding += len(data) - len(stripped)
+                if not stripped:
+                    break
+                if padding % 4:
+                    raise XzError("invalid stream padding")
+                padding = 0
+                data = stripped
+                decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+            # The output is bounded, a block of zeros is decompressed a lot
+            yield decompressor.decompress(data, max_length=CHUNK_SIZE)
+            data = decompressor.unused_data if decompressor.eof else b""
+            if decompressor.needs_input and not decompressor.eof:
+                break
+    if not decompressor.eof:
+        raise XzError("truncated stream")
+    if padding % 4:
+        raise XzError("invalid stream padding")
+
+
+class BlockDecoder:
+    """Decode a block on its own, as the single block of a new stream.
+
+    The check of the block is verified by lzma.
+    """
+
+    def __init__(self, block, check):
+        self.block = block
+        self.check = check
+
+    def decode(self, chunks):
+        """Yield the uncompressed data of the block, read from chunks."""
+        block = self.block
+        index = encode_index([(block.unpadded_size, block.uncompressed_size)])
+        trailer = index + stream_footer(len(index), self.check)
+        yield from decompress(
+            itertools.chain([stream_header(self.check)], chunks, [trailer])
+        )
+
+    def decode_bytes(self, data):
+        return b"".join(self.decode([data]))